@@ -3,30 +3,46 @@ SX-GPTアプリケーションメイン
 """
 
 import datetime
+import os
 
 import streamlit as st
 # pylint: disable=E0401,E0611
 from streamlit.components.v1 import html
 
 import app.streamlit.plugins as plugins
-from app.streamlit.utils.common import ParameterSession, hello
+from app.streamlit.utils.common import ParameterSession, hello, rerun_fragment
 from app.streamlit.utils.display import (clipboard_buttom_HTML,
                                          display_all_messages,
+                                         display_metrics_page,
                                          set_common_style)
 from app.streamlit.utils.sessions import CommonSession
 from sx_agents.utils import ChatMessage, Model
-from sx_agents.utils.common import crawring_message
+from sx_agents.utils.metrics import start_metrics_server
 
 set_common_style()
 params = ParameterSession.get()
 session = CommonSession.get()
+# Prometheus形式のメトリクスを公開 (METRICS_PORTを設定した場合のみ、プロセスで1度だけ起動)
+if os.getenv("METRICS_PORT"):
+    start_metrics_server(
+        int(os.environ["METRICS_PORT"]), os.getenv("METRICS_HOST", "127.0.0.1")
+    )
 
 
-def display_sidebar(is_disabled, placeholder_messages, placeholder_selector):
+def is_metrics_page() -> bool:
+    """管理者用のメトリクス画面へのアクセスかどうか
+    METRICS_ADMIN_TOKENを設定し、?metrics=<トークン>でアクセスした場合のみ表示する
+    """
+    token = os.getenv("METRICS_ADMIN_TOKEN")
+    return bool(token) and (st.query_params.get("metrics") == token)
+
+
+def display_sidebar(is_disabled):
     # Streamlit v1.30.0の時点ではwidgetのkeyによるsession_statは
     # page間遷移によって破壊され永続性がないため、手動でモデル選択の状態を保存
     #
     model = session.model
+    session.is_sidebar_rendered_disabled = is_disabled
     with st.container():
         st.title("SX版GPT & 文書要約")
         st.caption(f"ver. {params.VERSION}@{session.model.type}環境")
@@ -47,18 +63,16 @@ def display_sidebar(is_disabled, placeholder_messages, placeholder_selector):
 
         # モデル選択
         
-        available_models = [
-            model_name for model_name, config in params.MODEL_CONFIG.items()
-            if config.get("visible", True)
-        ]
         name = st.selectbox(
             "言語モデル",
-            available_models,
+            params.VISIBLE_MODELS,
             disabled=is_disabled,
         )
         if name != model.name:
             model_params = params.MODEL_CONFIG[name]
             session.model = Model(name=name, **model_params)
+            # 最初の回答を早めるため、選択した時点でAPIサーバへ接続しておく
+            session.model.warmup()
         # # ポータルへのリンク
         st.link_button(
             "ポータルへ戻る",
@@ -108,11 +122,24 @@ def download_message():
             session.status = "simplechat"
             session.is_selector_activate = True
             session.is_sidebar_disabled = False
-            st.rerun()
+            rerun_fragment()
 
 
+def rerun_if_sidebar_changed() -> None:
+    """サイドバーの有効・無効が表示中の状態と異なる場合はスクリプト全体を再実行する
+    フラグメント内のボタンのコールバックなどで状態が変わった場合に、サイドバーにも反映するため
+    """
+    if session.is_sidebar_disabled != session.is_sidebar_rendered_disabled:
+        st.rerun()
+
+
+@st.fragment
 def display_selector() -> None:
-    """プラグインセレクターを表示する"""
+    """プラグインセレクターを表示する
+    フラグメントとして、プラグインの選択ではセレクターのみ再実行する
+    """
+    # 実行ボタンでプラグインが選択された場合は画面全体を切り替える
+    rerun_if_sidebar_changed()
 
     placeholder = st.empty()
     with placeholder:
@@ -121,7 +148,7 @@ def display_selector() -> None:
             col_l, col_r = st.columns([0.7, 0.3])
             with col_l:
                 # プラグインセレクター
-                aveilable_plugins = session.plugins[session.model.name]
+                aveilable_plugins = session.plugins.get(session.model.name, ())
                 selector_message = (
                     "プラグイン選択..."
                     if aveilable_plugins
@@ -160,13 +187,42 @@ def copy_button():
     html(clipboard_buttom_HTML(message_assistant), height=40, width=150)
 
 
-def index():
-    """SX-GPTアプリケーションメイン"""
-    # -------------------------------------------------------------------------
-    # 画面構成の初期化
-    # -------------------------------------------------------------------------
-    # サイドバー設定
-    placeholder_sidebar = st.sidebar.empty()
+@st.fragment
+def display_plugin_panel(plugin_name: str) -> None:
+    """プラグインの画面を表示して実行する
+    フラグメントとして、プラグイン内の状態遷移ではこの画面のみ再実行する
+    Args:
+        plugin_name (str): プラグインのモジュール名
+    """
+    # キャンセルなどでプラグインが終了・切り替わった場合は画面全体を切り替える
+    rerun_if_sidebar_changed()
+    if session.status != plugin_name:
+        st.rerun()
+    # プラグイン実行用の画面
+    placeholder_plugin = st.empty()
+    module = getattr(plugins, plugin_name)
+
+    # プラグインの実行
+    module.execute(
+        placeholder_plugin, session.memory, session.model, **session.kwargs
+    )
+
+    # プラグイン実行終了処理
+    placeholder_plugin.empty()
+    session.is_selector_activate = True
+    session.is_sidebar_disabled = False
+    session.status = "simplechat"
+    session.prompt = ""
+    # サイドバーを有効に戻すため全体を再実行
+    st.rerun()
+
+
+@st.fragment
+def display_chat_area() -> None:
+    """メッセージ・プラグイン・セレクター・プロンプト入力を表示する
+    フラグメントとして、チャットの送信やダウンロードの選択ではサイドバーを再実行しない
+    """
+    rerun_if_sidebar_changed()
     # -------------------------------------------------------------------------
     # メッセージ表示用のplaceholderを作成
     placeholder_messages = st.empty()
@@ -176,26 +232,6 @@ def index():
     # プロンプト入力用のplaceholderを作成
     placeholder_prompt = st.empty()
 
-    if session.status == "reset":
-        # セッションがリセットされた場合は、メッセージとセレクターを空にする
-        placeholder_messages.empty()
-        placeholder_selector.empty()
-        placeholder_prompt.empty()
-        session.delete()
-        for key in st.session_state.keys():
-            del st.session_state[key]
-        st.rerun()
-
-    # -------------------------------------------------------------------------
-    # サイドバーの表示
-    # -------------------------------------------------------------------------
-    with placeholder_sidebar:
-        display_sidebar(
-            session.is_sidebar_disabled,
-            placeholder_messages,
-            placeholder_selector,
-        )
-
     # -------------------------------------------------------------------------
     # メッセージの表示
     # -------------------------------------------------------------------------
@@ -203,14 +239,10 @@ def index():
         with placeholder_messages:
             message_container = st.container()
             with message_container:
-                # 初回のみウェルカムメッセージを表示
+                # 初回のみウェルカムメッセージを表示 (待ち時間なしで全文を表示)
                 if session.is_wellcom_message_enable:
                     with st.chat_message("assistant"):
-                        st.write_stream(
-                            crawring_message(
-                                params.WELLCOME_MESSAGE.format(hello=hello())
-                            )
-                        )
+                        st.markdown(params.WELLCOME_MESSAGE.format(hello=hello()))
                     session.is_wellcom_message_enable = False
                 # メッセージを表示
                 display_all_messages(session.memory.messages[1:])
@@ -232,22 +264,8 @@ def index():
         placeholder_prompt.chat_input(
             f"{session.status}を実行中", disabled=True
         )
-        # プラグイン実行用の画面
-        placeholder_plugin = message_container.empty()
-        module = getattr(plugins, session.status)
-
-        # プラグインの実行
-        module.execute(
-            placeholder_plugin, session.memory, session.model, **session.kwargs
-        )
-
-        # プラグイン実行終了処理
-        placeholder_plugin.empty()
-        session.is_selector_activate = True
-        session.is_sidebar_disabled = False
-        session.status = "simplechat"
-        session.prompt = ""
-        st.rerun()
+        with message_container:
+            display_plugin_panel(session.status)
 
     # デフォルトのシンプルチャット実行
     if session.status == "simplechat":
@@ -265,10 +283,10 @@ def index():
                 session.memory,
                 prompt,
             )
-            # 終了後の処理
+            # 終了後の処理 (サイドバーは変わらないためチャット画面のみ再実行)
             session.is_selector_activate = True
             session.prompt = None
-            st.rerun()
+            rerun_fragment()
 
     # テキストダウンロードを実行
     elif session.status == "download":
@@ -287,5 +305,35 @@ def index():
             display_selector()
 
 
+def index():
+    """SX-GPTアプリケーションメイン"""
+    if is_metrics_page():
+        display_metrics_page()
+        st.stop()
+    # -------------------------------------------------------------------------
+    # 画面構成の初期化
+    # -------------------------------------------------------------------------
+    # サイドバー設定
+    placeholder_sidebar = st.sidebar.empty()
+
+    if session.status == "reset":
+        # セッションがリセットされた場合は、セッションを削除して再実行する
+        session.delete()
+        for key in st.session_state.keys():
+            del st.session_state[key]
+        st.rerun()
+
+    # -------------------------------------------------------------------------
+    # サイドバーの表示
+    # -------------------------------------------------------------------------
+    with placeholder_sidebar:
+        display_sidebar(session.is_sidebar_disabled)
+
+    # -------------------------------------------------------------------------
+    # チャット画面の表示 (画面内の操作ではこの部分のみ再実行)
+    # -------------------------------------------------------------------------
+    display_chat_area()
+
+
 if __name__ == "__main__":
     index()
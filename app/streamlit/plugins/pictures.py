@@ -1,25 +1,30 @@
 import os
 import time
 import traceback
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from PIL import UnidentifiedImageError
 
-import PIL
-import PIL.Image
 import streamlit as st
 from streamlit.delta_generator import DeltaGenerator
 
+from app.streamlit.utils.common import rerun_fragment
 from app.streamlit.utils.logger import logger_error, logger_info
 from app.streamlit.utils.sessions import PluginSession
 from sx_agents.utils import ChatMemory, Model
 from sx_agents.utils.common import (
-    to_normalized_pic,
-    to_thumbnail_pic,
+    AsyncStream,
+    PreparedPic,
+    coalesce_stream,
+    image_pool,
+    prepare_pic,
 )
-
-type Image = PIL.Image.Image
+from sx_agents.utils.handler import AgentTalkCallbackHandler
+from sx_agents.utils.memory import CANCELLED_LABEL
+from sx_agents.utils.metrics import REQUEST_LATENCY
 
 WHITE_LIST = ["all"]
 
@@ -33,8 +38,8 @@ class PictureSession(PluginSession):
     status = "upload"
     filename: str = ""
     suffix: str = ""
-    image: Image | None = None
-    thumbnail: Image | None = None
+    image: PreparedPic | None = None  # 送信用に変換済みの画像
+    thumbnail: bytes | None = None  # サムネイル画像 (PNG)
     docs: list[str] = []
 
 
@@ -64,14 +69,21 @@ def upload_files(placeholder: DeltaGenerator):
         st.stop()
 
 
-def preprocessing(placeholder: DeltaGenerator, uploaded_file: BytesIO):
+def preprocessing(
+    placeholder: DeltaGenerator, uploaded_file: BytesIO, memory: ChatMemory
+):
     with placeholder.container():
         with st.chat_message("assistant"):
             with st.status("読込んだファイルの前処理を行っています...", expanded=True):
                 suffix = os.path.splitext(uploaded_file.name)[-1]
                 filename = uploaded_file.name
-                images_ = PIL.Image.open(uploaded_file)
-                rawdata = to_normalized_pic(images_)
+                # デコード・縮小・エンコードはワーカープロセスで行う
+                rawdata = image_pool.run(
+                    prepare_pic,
+                    uploaded_file.getvalue(),
+                    memory.THUMBNAIL_WIDTH,
+                    memory.THUMBNAIL_BG_COLOR,
+                )
         placeholder_cancel = st.empty()
         with placeholder_cancel:
             st.button(
@@ -84,7 +96,7 @@ def preprocessing(placeholder: DeltaGenerator, uploaded_file: BytesIO):
     return filename, suffix, rawdata
 
 
-def input_prompt(placeholder: DeltaGenerator, thumbnail: Image):
+def input_prompt(placeholder: DeltaGenerator, thumbnail: bytes):
     with placeholder.container():
         st.image(thumbnail)
         with st.chat_message("assistant"):
@@ -116,9 +128,11 @@ def output_streaming(
     memory: ChatMemory,
     model: Model,
     prompt: str,
-    image: Image | None,
-    thumbnail: Image | None,
+    image: PreparedPic | None,
+    thumbnail: bytes | None,
+    handler: AgentTalkCallbackHandler | None = None,
 ):
+    callbacks = [handler] if handler is not None else []
     with placeholder:
 
         with st.container():
@@ -128,14 +142,23 @@ def output_streaming(
                     if thumbnail:
                         st.image(thumbnail)
             with st.spinner("プロンプトを準備しています...", show_time=True):
-                messages = memory.prompt_with_all_messages("user", prompt, image)
+                message = memory.create_message("user", prompt, image)
+                if not model.is_less_than_token_limit_from_memory(
+                    memory, message, with_history=False, vision=True
+                ):
+                    memory.append_warning("プロンプトが長すぎます")
+                    rerun_fragment()
+                # トークン制限を超える古いターンは削除
+                messages, num_dropped = model.prompt_with_memory(
+                    memory, message, vision=True
+                )
                 prompts = ChatPromptTemplate.from_messages(messages)
                 llm = model.create_langchain_chat()
                 chain = prompts | llm | StrOutputParser()
-                # messages = model.reduce_messages(messages)
-                if len(messages) < 2:
-                    memory.append_warning("プロンプトが長すぎます")
-                    st.rerun()
+            if num_dropped:
+                st.caption(
+                    f"会話が長いため、古いやり取り{num_dropped}件を除いて送信しました。"
+                )
             with st.chat_message("assistant"):
 
                 placeholder_streaming = st.empty()
@@ -151,9 +174,24 @@ def output_streaming(
                     # full_response = st.write_stream(
                     #     crawring_message_from_response(response_chunks)
                     # )
-                    full_response = st.write_stream(chain.stream({}))
+                    stream = AsyncStream(
+                        lambda: chain.astream({}, config={"callbacks": callbacks})
+                    )
+                    try:
+                        full_response = st.write_stream(
+                            coalesce_stream(
+                                model.stream_with_cache(messages, lambda: stream)
+                            )
+                        )
+                    finally:
+                        # Cancelで再実行された場合は生成を止めて途中までの回答を残す
+                        if stream.cancel():
+                            memory.append_message(message)
+                            memory.append_assistant(
+                                stream.text, label=CANCELLED_LABEL
+                            )
             st.markdown(full_response)
-    return full_response
+    return full_response, message
 
 
 def execute(placeholder: DeltaGenerator, memory: ChatMemory, model: Model, **kwargs):
@@ -165,19 +203,35 @@ def execute(placeholder: DeltaGenerator, memory: ChatMemory, model: Model, **kwa
         # セッション終了
         placeholder.empty()
         session.exit_plugin()
-        st.rerun()
+        rerun_fragment()
 
     if session.status == "upload":
         # ファイルのアップロード
         uploaded_file = upload_files(placeholder)
-        session.filename, session.suffix, rawdata = preprocessing(
-            placeholder, uploaded_file
-        )
+        try:
+            session.filename, session.suffix, rawdata = preprocessing(
+                placeholder, uploaded_file, memory
+            )
+        except (TimeoutError, BrokenProcessPool, UnidentifiedImageError) as e:
+            if isinstance(e, TimeoutError):
+                msg = "画像の処理に時間がかかりすぎたため中断しました。"
+            elif isinstance(e, UnidentifiedImageError):
+                msg = "画像ファイルとして読み込めませんでした。"
+            else:
+                msg = "画像の処理中にエラーが発生しました。もう一度お試しください。"
+            logger_error(
+                __name__,
+                msg=f"{msg} Error: {e!r}",
+                traceback=traceback.format_exc(),
+            )
+            memory.append_error(msg)
+            PictureSession.exit_plugin()
+            rerun_fragment()
         session.image = rawdata
-        session.thumbnail = to_thumbnail_pic(rawdata)
+        session.thumbnail = rawdata.thumbnail
         placeholder.empty()
         session.status = "input"
-        st.rerun()
+        rerun_fragment()
 
     if session.status == "input":
         # プロンプト入力待ち
@@ -185,13 +239,15 @@ def execute(placeholder: DeltaGenerator, memory: ChatMemory, model: Model, **kwa
         if prompt:
             try:
                 stime = time.time()
-                full_response = output_streaming(
+                handler = AgentTalkCallbackHandler(request_time=stime)
+                full_response, message = output_streaming(
                     placeholder,
                     memory,
                     model,
                     prompt,
                     session.image,
                     session.thumbnail,
+                    handler=handler,
                 )
                 etime = time.time()
             except Exception as e:
@@ -205,10 +261,12 @@ def execute(placeholder: DeltaGenerator, memory: ChatMemory, model: Model, **kwa
                     model_type=model.type,
                 )
                 PictureSession.exit_plugin()
-                st.rerun()
+                rerun_fragment()
             # 終了処理
             tdiff = etime - stime
-            memory.append_user(prompt, session.image)
+            REQUEST_LATENCY.observe(tdiff, plugin="pictures", model=model.name)
+            # エンコード済みの画像とトークン数を再利用するため送信したメッセージを記録
+            memory.append_message(message)
             memory.append_assistant(str(full_response))
             logger_info(
                 __name__,
@@ -218,7 +276,12 @@ def execute(placeholder: DeltaGenerator, memory: ChatMemory, model: Model, **kwa
                 model_name=model.name,
                 model_type=model.type,
                 real_time=tdiff,
+                llm=(
+                    handler.last_llm_metrics.to_dict()
+                    if handler.last_llm_metrics is not None
+                    else None
+                ),
             )
             session.status = "exit"
-            st.rerun()
+            rerun_fragment()
     st.stop()
@@ -11,8 +11,14 @@ from langchain_core.prompts import ChatPromptTemplate
 # pylint: disable=E0401,E0611
 from streamlit.delta_generator import DeltaGenerator
 
+from app.streamlit.utils.common import rerun_fragment
+from app.streamlit.utils.display import display_similar_cache_caption
 from app.streamlit.utils.logger import logger_error, logger_info
 from sx_agents.utils import ChatMemory, Model
+from sx_agents.utils.common import AsyncStream, coalesce_stream
+from sx_agents.utils.handler import AgentTalkCallbackHandler
+from sx_agents.utils.memory import CANCELLED_LABEL, SIMILAR_CACHE_LABEL
+from sx_agents.utils.metrics import REQUEST_LATENCY
 # from sx_agents.utils.common import crawring_message_from_response
 
 
@@ -29,28 +35,38 @@ def execute(
         memory (ChatMemory): チャットのメモリ
         prompt (str): プロンプト
     """
+    # 待ち時間の起点を記録 (LLM呼び出しの計測用)
+    handler = AgentTalkCallbackHandler(request_time=time.time())
     with placeholder:
         with st.spinner("プロンプトを調整中..."):
-            prompt_w_sys_role = memory.prompt_with_system_role(
-                "user", prompt, vision=model.vision
-            )
-            # 長すぎるプロンプトはエラー
-            if not model.is_less_than_token_limit(prompt_w_sys_role):
+            message = memory.create_message("user", prompt)
+            # 長すぎるプロンプトはエラー (システムロールはキャッシュ済みのトークン数を使う)
+            if not model.is_less_than_token_limit_from_memory(
+                memory, message, with_history=False
+            ):
                 memory.append_error("プロンプトが長すぎます。")
-                st.rerun()
-            # メッセージ作成
-            messages = memory.prompt_with_all_messages(
-                "user", prompt, vision=model.vision
+                rerun_fragment()
+            # メッセージ作成 (トークン制限を超える古いターンは削除)
+            messages, num_dropped = model.prompt_with_memory(memory, message)
+            # 単発の質問は表記ゆれのある同じ質問の回答を再利用
+            similar_hit = model.find_similar_response(messages)
+            similar_cache_metadata = (
+                [{"similarity": similar_hit.similarity}]
+                if similar_hit is not None
+                else []
             )
             prompts = ChatPromptTemplate.from_messages(messages)
             llm = model.create_langchain_chat()
             chain = prompts | llm | StrOutputParser()
-            # messages = model.reduce_messages(messages)
     #
     with placeholder:
         with st.container():
             with st.chat_message("user"):
                 st.markdown(prompt)
+                if num_dropped:
+                    st.caption(
+                        f"会話が長いため、古いやり取り{num_dropped}件を除いて送信しました。"
+                    )
             with st.spinner("回答しています...", show_time=True):
                 with st.chat_message("assistant"):
                     with st.container():
@@ -65,7 +81,34 @@ def execute(
                             # )
                             # etime = time.time()
                             stime = time.time()
-                            full_response = st.write_stream(chain.stream({}))
+                            if similar_hit is not None:
+                                full_response = similar_hit.response
+                                st.markdown(full_response)
+                                display_similar_cache_caption(similar_cache_metadata)
+                            else:
+                                stream = AsyncStream(
+                                    lambda: chain.astream(
+                                        {}, config={"callbacks": [handler]}
+                                    )
+                                )
+                                try:
+                                    full_response = st.write_stream(
+                                        coalesce_stream(
+                                            model.stream_with_cache(
+                                                messages, lambda: stream
+                                            )
+                                        )
+                                    )
+                                finally:
+                                    # 再実行などで中断された場合は生成を止めて途中までの回答を残す
+                                    if stream.cancel():
+                                        memory.append_message(message)
+                                        memory.append_assistant(
+                                            stream.text, label=CANCELLED_LABEL
+                                        )
+                                model.store_similar_response(
+                                    messages, str(full_response)
+                                )
                             etime = time.time()
 
                         except Exception as e:
@@ -79,11 +122,20 @@ def execute(
                                 model_name=model.name,
                                 model_type=model.type,
                             )
-                            st.rerun()
+                            rerun_fragment()
 
     # 終了処理
-    memory.append_user(prompt)
-    memory.append_assistant(str(full_response))
+    memory.append_message(message)
+    if similar_hit is not None:
+        # 再実行後の表示でも再利用した回答だと分かるようにラベルを残す
+        memory.append_assistant(
+            str(full_response),
+            label=SIMILAR_CACHE_LABEL,
+            metadata=similar_cache_metadata,
+        )
+    else:
+        memory.append_assistant(str(full_response))
+    REQUEST_LATENCY.observe(etime - stime, plugin="simplechat", model=model.name)
     logger_info(
         __name__,
         prompt=prompt,
@@ -91,4 +143,18 @@ def execute(
         model_name=model.name,
         model_type=model.type,
         real_time=(etime - stime),
+        cache=(
+            {
+                "type": "similar",
+                "similarity": similar_hit.similarity,
+                "cached_prompt": similar_hit.prompt,
+            }
+            if similar_hit is not None
+            else None
+        ),
+        llm=(
+            handler.last_llm_metrics.to_dict()
+            if handler.last_llm_metrics is not None
+            else None
+        ),
     )
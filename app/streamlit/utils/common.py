@@ -1,12 +1,17 @@
 import os
 import re
-from dataclasses import dataclass
+import threading
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Self
+from types import MappingProxyType
+from typing import Any, Self
 from zoneinfo import ZoneInfo
 
 import streamlit as st
 from PIL import Image
+from streamlit.errors import StreamlitAPIException
 from sx_agents.utils import load_jsonc
 from sx_agents.utils.common import crawring_message, to_thumbnail_pic
 from sx_agents.utils.handler import Color, TalkSender
@@ -15,41 +20,121 @@ from sx_agents.utils.handler import Color, TalkSender
 # ------------------------------------------------------------------------------
 # Parameter設定
 # ------------------------------------------------------------------------------
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "../config.jsonc")
+# config.jsoncの更新を確認する間隔 (秒)
+CONFIG_CHECK_INTERVAL = 1.0
+
+
 @dataclass(frozen=True)
 class ParameterSession:
     """
     グローバルパラメータを保持するクラス
     config.jsoncを読み込み、環境変数に応じて上書きする
+    プロセス内で1つのスナップショットを全セッションが共有し、ファイルの更新時刻が変わった時だけ再読込する
     """
 
     VERSION: str
     DEFUALT_ENV: str
     WELLCOME_MESSAGE: str
     SYSTEM_ROLE: str
-    PLUGINS: dict
-    MODEL_CONFIG: dict
+    PLUGINS: Mapping[str, str]
+    MODEL_CONFIG: Mapping[str, Mapping[str, Any]]
     DISPLAY_PIC_HEIGHT: int
     DISPLAY_PIC_BACKGROUND_COLOR: tuple[int, int, int]
+    MEMORY_MAX_BYTES: int
+    # 読込時に計算する値
+    VISIBLE_MODELS: tuple[str, ...] = ()  # UIに表示するモデル
+    AVAILABLE_PLUGINS: Mapping[str, tuple[str, ...]] = field(
+        default_factory=dict
+    )  # モデルごとに利用できるプラグイン
 
     @classmethod
     def get(cls) -> Self:
         """
-        Parametersのセッションステートを取得する
+        Parametersのスナップショットを取得する
         """
-        if "parameter" not in st.session_state:
-            file_path = os.path.join(
-                os.path.dirname(__file__), "../config.jsonc"
-            )
-            data = load_jsonc(file_path)
-            TARGET = os.getenv("TARGET", "dev")
-            # ENVに依存する変数は上書き
-            data["PLUGINS"] = data["PLUGINS"][TARGET]
-            data["DISPLAY_PIC_BACKGROUND_COLOR"] = tuple(
-                data["DISPLAY_PIC_BACKGROUND_COLOR"]
-            )
-
-            st.session_state["parameter"] = cls(**data)
-        return st.session_state["parameter"]
+        global _parameter_snapshot  # pylint: disable=W0603
+        now = time.monotonic()
+        snapshot = _parameter_snapshot
+        if (snapshot is not None) and (now - snapshot[2] < CONFIG_CHECK_INTERVAL):
+            return snapshot[0]
+        with _parameter_lock:
+            snapshot = _parameter_snapshot
+            mtime = os.stat(CONFIG_PATH).st_mtime_ns
+            if (snapshot is not None) and (snapshot[1] == mtime):
+                parameter = snapshot[0]
+            else:
+                try:
+                    parameter = cls.load(CONFIG_PATH)
+                except (ValueError, KeyError, TypeError):
+                    # 編集途中などで読み込めない場合は直前の設定を使い続ける
+                    if snapshot is None:
+                        raise
+                    parameter = snapshot[0]
+            _parameter_snapshot = (parameter, mtime, now)
+        return parameter
+
+    @classmethod
+    def load(cls, file_path: str) -> Self:
+        """
+        config.jsoncを読み込み、変更できないParametersを作成する
+        """
+        data = load_jsonc(file_path)
+        TARGET = os.getenv("TARGET", "dev")
+        # ENVに依存する変数は上書き
+        data["PLUGINS"] = data["PLUGINS"][TARGET]
+        data["DISPLAY_PIC_BACKGROUND_COLOR"] = tuple(
+            data["DISPLAY_PIC_BACKGROUND_COLOR"]
+        )
+        data["VISIBLE_MODELS"] = tuple(
+            model_name
+            for model_name, config in data["MODEL_CONFIG"].items()
+            if config.get("visible", True)
+        )
+        data["AVAILABLE_PLUGINS"] = get_available_plugins(
+            data["PLUGINS"], list(data["MODEL_CONFIG"].keys())
+        )
+        return cls(**{k: _freeze(v) for k, v in data.items()})
+
+
+# (Parameters, config.jsoncの更新時刻, 最後に確認した時刻)
+_parameter_snapshot: tuple[ParameterSession, int, float] | None = None
+_parameter_lock = threading.Lock()
+
+
+def get_available_plugins(
+    plugin_config: dict[str, str], model_names: list[str]
+) -> dict[str, tuple[str, ...]]:
+    """モデルごとに利用できるプラグインの一覧を作成する
+    Args:
+        plugin_config (dict[str, str]): プラグイン名とモジュール名
+        model_names (list[str]): モデル名
+    Returns:
+        dict[str, tuple[str, ...]]: モデル名ごとのプラグイン名
+    """
+    # pylint: disable=C0415
+    from app.streamlit import plugins
+
+    available_plugins = {}
+    for model_name in model_names:
+        available_plugins[model_name] = []
+        for plugin_name, module_name in plugin_config.items():
+            module = getattr(plugins, module_name, None)
+            if module is None:
+                continue
+            if hasattr(module, "WHITE_LIST"):
+                if ("all" in module.WHITE_LIST) or (model_name in module.WHITE_LIST):
+                    available_plugins[model_name].append(plugin_name)
+            else:
+                available_plugins[model_name].append(plugin_name)
+    return {k: tuple(v) for k, v in available_plugins.items()}
+
+
+def _freeze(value: Any) -> Any:
+    """辞書を読み取り専用に変換する (セッション間で共有するため)"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
 
 
 class StreamlitTalkSender(TalkSender):
@@ -66,7 +151,7 @@ class StreamlitTalkSender(TalkSender):
         message_, code = extract_message_and_code(message_)
         with st.container():
             with st.status(name, expanded=True):
-                st.write_stream(crawring_message(message_, sleep=0.001))
+                st.write_stream(crawring_message(message_))
             if code:
                 with st.status("pythonコード", expanded=False):
                     st.code(code, language="python")
@@ -90,6 +175,17 @@ def extract_message_and_code(text: str) -> tuple[str, str | None]:
     return pre + post, code
 
 
+def rerun_fragment() -> None:
+    """表示を更新するために再実行する
+    フラグメントの再実行中はそのフラグメントのみ、それ以外 (スクリプト全体の実行中) は
+    スクリプト全体を再実行する
+    """
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
 def hello():
     now = datetime.now(ZoneInfo("Asia/Tokyo")).hour
     if now < 5:
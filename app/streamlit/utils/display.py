@@ -1,8 +1,12 @@
 from html import escape
+from typing import Any
 import pandas as pd
 import streamlit as st
 
 from sx_agents.utils import ChatMessage
+from sx_agents.utils.cache import llm_response_cache, similar_response_cache
+from sx_agents.utils.memory import CANCELLED_LABEL, SIMILAR_CACHE_LABEL
+from sx_agents.utils.metrics import metrics_registry
 
 # css = """
 # <style>
@@ -25,43 +29,129 @@ def set_common_style():
     st.markdown(CSS_STYLE, unsafe_allow_html=True)
 
 
+# 会話履歴の表示設定
+HISTORY_WINDOW_TURNS = 10  # 常に表示する直近のターン数 (ユーザの発話から次の発話まで)
+HISTORY_PAGE_TURNS = 10  # 「以前のメッセージ」を1回で追加表示するターン数
+HISTORY_PAGES_KEY = "history_pages"  # 追加表示したページ数を保存するsession_stateのキー
+
+
 # ------------------------------------------------------------------------------
 # @st.cache_data
-def display_all_messages(messages: list[ChatMessage]) -> None:
-    """メモリ内のメッセージを全て表示する
+def display_all_messages(
+    messages: list[ChatMessage], window: int = HISTORY_WINDOW_TURNS
+) -> None:
+    """メモリ内のメッセージを表示する
+    直近のwindowターンのみ表示し、それより前のメッセージはボタンを押した場合のみ
+    ページ単位で表示する (再実行ごとの描画と送信量を会話の長さによらず一定にするため)
     Args:
         messages (list[ChatMemory]): メッセージのリスト
+        window (int): 常に表示する直近のターン数
     Returns:
         None
     """
+    split = _turn_start_index(messages, window)
+    if split > 0:
+        display_earlier_messages(messages[:split])
     # メモリ内にあるメッセージを表示
-    for message in messages:
-        if message.role == "system":
-            continue
-        elif message.role in ["error", "warning", "info", "success"]:
-            display_attention(message.role, message.content)
-        elif message.role == "status":
-            with st.status(message.label, expanded=False, state="complete"):
+    for message in messages[split:]:
+        display_message(message)
+
+
+def display_earlier_messages(messages: list[ChatMessage]) -> None:
+    """直近のターンより前のメッセージを表示する
+    Args:
+        messages (list[ChatMemory]): 直近のターンより前のメッセージのリスト
+    Returns:
+        None
+    """
+    pages = st.session_state.get(HISTORY_PAGES_KEY, 0)
+    start = _turn_start_index(messages, pages * HISTORY_PAGE_TURNS)
+    num_hidden = sum(1 for m in messages[:start] if m.role == "user")
+
+    def event_show_more():
+        st.session_state[HISTORY_PAGES_KEY] = pages + 1
+
+    def event_collapse():
+        st.session_state[HISTORY_PAGES_KEY] = 0
+
+    col_l, col_r = st.columns([0.8, 0.2])
+    if num_hidden:
+        col_l.button(
+            f"以前のメッセージを表示 (残り{num_hidden}件の質問)",
+            key="history_show_more",
+            on_click=event_show_more,
+        )
+    if pages:
+        col_r.button("折りたたむ", key="history_collapse", on_click=event_collapse)
+    for message in messages[start:]:
+        display_message(message)
+
+
+def display_message(message: ChatMessage) -> None:
+    """メッセージを1件表示する
+    Args:
+        message (ChatMessage): メッセージ
+    Returns:
+        None
+    """
+    if message.role == "system":
+        return
+    elif message.role in ["error", "warning", "info", "success"]:
+        display_attention(message.role, message.content)
+    elif message.role == "status":
+        with st.status(message.label, expanded=False, state="complete"):
+            st.markdown(message.content, unsafe_allow_html=message.unsafe_allow_html)
+    else:
+        # ディスクへ退避したメッセージは参照のたびに読み込むため、各項目を1回だけ読む
+        thumbnails = message.thumbnail_bytes
+        metadata = message.metadata
+        with st.chat_message(message.role):
+            with st.container():
                 st.markdown(
-                    message.content, unsafe_allow_html=message.unsafe_allow_html
+                    message.content,
+                    unsafe_allow_html=message.unsafe_allow_html,
                 )
-        else:
-            with st.chat_message(message.role):
-                with st.container():
-                    st.markdown(
-                        message.content,
-                        unsafe_allow_html=message.unsafe_allow_html,
-                    )
-                    if message.thumbnails:
-                        for image in message.thumbnails:
-                            st.image(image)
-                    elif message.images:
-                        for image in message.images:
-                            st.image(image)
-                    if message.metadata:
-                        for mdata in message.metadata:
-                            if isinstance(mdata, pd.DataFrame):
-                                st.dataframe(mdata)
+                # 画像は圧縮したバイト列のままデコードせずに表示
+                for image in thumbnails or message.image_bytes:
+                    st.image(image)
+                for mdata in metadata:
+                    if isinstance(mdata, pd.DataFrame):
+                        st.dataframe(mdata)
+                if message.label == CANCELLED_LABEL:
+                    st.caption("回答の生成は中断されました。")
+                elif message.label == SIMILAR_CACHE_LABEL:
+                    display_similar_cache_caption(metadata)
+
+
+def display_similar_cache_caption(metadata: list[Any]) -> None:
+    """類似した質問の回答を再利用したことを表示する
+    Args:
+        metadata (list[Any]): メッセージのメタデータ (類似度を含む辞書)
+    Returns:
+        None
+    """
+    text = "キャッシュ: 類似した質問の回答を再利用しました"
+    for mdata in metadata:
+        if isinstance(mdata, dict) and ("similarity" in mdata):
+            text += f" (類似度 {mdata['similarity']:.2f})"
+            break
+    st.caption(text)
+
+
+def _turn_start_index(messages: list[ChatMessage], turns: int) -> int:
+    """直近のturnsターンの先頭 (ユーザの発話) のインデックスを取得する
+    Args:
+        messages (list[ChatMemory]): メッセージのリスト
+        turns (int): ターン数
+    Returns:
+        int: インデックス (ターン数が足りない場合は0、turnsが0の場合はlen(messages))
+    """
+    if turns <= 0:
+        return len(messages)
+    user_indices = [i for i, m in enumerate(messages) if m.role == "user"]
+    if len(user_indices) <= turns:
+        return 0
+    return user_indices[-turns]
 
 
 def display_attention(role: str, content: str) -> None:
@@ -82,6 +172,33 @@ def display_attention(role: str, content: str) -> None:
         st.success(content)
 
 
+# ------------------------------------------------------------------------------
+# 管理者用のメトリクス画面
+# ------------------------------------------------------------------------------
+def display_metrics_page() -> None:
+    """プロセス内のメトリクスとキャッシュの状況を表示する"""
+    st.title("メトリクス")
+    st.button("更新")
+    st.dataframe(pd.DataFrame(metrics_registry.collect()), use_container_width=True)
+
+    st.header("キャッシュ")
+    st.markdown(
+        f"- レスポンス: {len(llm_response_cache)}件 "
+        f"(ヒット {llm_response_cache.hits} / ミス {llm_response_cache.misses})\n"
+        f"- 類似プロンプト: {len(similar_response_cache)}件 "
+        f"(ヒット率 {similar_response_cache.hit_rate:.1%})"
+    )
+    # 類似プロンプトのキャッシュの誤ヒット確認用
+    if similar_response_cache.recent_hits:
+        st.dataframe(
+            pd.DataFrame(list(similar_response_cache.recent_hits)),
+            use_container_width=True,
+        )
+
+    with st.expander("Prometheus形式"):
+        st.code(metrics_registry.render(), language="text")
+
+
 # ------------------------------------------------------------------------------
 # クリップボードへコピーするボタンを作成
 # ------------------------------------------------------------------------------
@@ -1,13 +1,29 @@
 """
-ロギングの設定を行い、ログをGoogle Cloud Loggingに送信するためのハンドラを追加するモジュール"""
+ロギングの設定を行い、ログをGoogle Cloud Loggingに送信するためのハンドラを追加するモジュール
+ログはキューに積んで別スレッドでまとめて出力し、スクリプトのスレッドを待たせない"""
 
+import atexit
+import hashlib
 import json
 import os
+import queue
+import random
+import threading
+from typing import Any
 
 # ------------------------------------------------------------------------------
 # logger設定
 # ------------------------------------------------------------------------------
 PLATFORM = os.getenv("PLATFORM")
+# プロンプトとレスポンスの記録方法 (full: 全文, truncate: 先頭のみ, hash: ハッシュ値のみ)
+LOG_PAYLOAD_MODE = os.getenv("LOG_PAYLOAD_MODE", "truncate")
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+# infoログを出力する割合 (エラーは常に出力)
+LOG_INFO_SAMPLE_RATE = float(os.getenv("LOG_INFO_SAMPLE_RATE", "1.0"))
+# バックグラウンド出力の設定
+LOG_QUEUE_SIZE = 10000  # キューの上限 (超えた分は破棄してスクリプトを待たせない)
+LOG_BATCH_SIZE = 100  # 1回にまとめて出力する最大件数
+LOG_FLUSH_INTERVAL = 1.0  # まとめて出力するまでの最大待ち時間 (秒)
 if PLATFORM in ["GCP", "local"]:
     from google.cloud.logging.handlers import StructuredLogHandler
     from google.cloud.logging_v2.handlers import setup_logging
@@ -34,6 +50,130 @@ if PLATFORM in ["GCP", "local"]:
     logger_.addHandler(handler)
 
 
+# ------------------------------------------------------------------------------
+# バックグラウンド出力
+# ------------------------------------------------------------------------------
+class _JsonPayload:
+    """ログの内容 (JSONへの変換と本文の切り詰めは出力スレッドで行う)"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: dict[str, Any]):
+        self.data = data
+
+    def __str__(self) -> str:
+        data = {
+            k: reduce_payload(v) if (k in ("prompt", "response")) and v else v
+            for k, v in self.data.items()
+        }
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.Handler):
+    """レコードをキューに積むだけのハンドラ (キューが一杯なら破棄する)"""
+
+    def __init__(self, queue_: queue.Queue):
+        super().__init__()
+        self.queue = queue_
+        self.dropped = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _BatchWriter:
+    """キューのレコードをまとめてハンドラへ出力するスレッド
+    Args:
+        queue_ (queue.Queue): レコードのキュー
+        handlers (list[logging.Handler]): 出力先のハンドラ
+    """
+
+    _STOP = object()
+
+    def __init__(self, queue_: queue.Queue, handlers: list[logging.Handler]):
+        self.queue = queue_
+        self.handlers = handlers
+        self._thread = threading.Thread(
+            target=self._run, name="sxgpt-logger", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            record = self.queue.get()
+            batch = [] if record is self._STOP else [record]
+            stop = record is self._STOP
+            # 少し待って届いたレコードをまとめる
+            while (not stop) and (len(batch) < LOG_BATCH_SIZE):
+                try:
+                    record = self.queue.get(timeout=LOG_FLUSH_INTERVAL)
+                except queue.Empty:
+                    break
+                if record is self._STOP:
+                    stop = True
+                else:
+                    batch.append(record)
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _write(self, records: list[logging.LogRecord]) -> None:
+        for handler in self.handlers:
+            records_ = [r for r in records if r.levelno >= handler.level]
+            try:
+                if isinstance(handler, logging.StreamHandler):
+                    # 1回の書き込みとflushでまとめて出力
+                    text = "".join(
+                        handler.format(r) + handler.terminator
+                        for r in records_
+                        if handler.filter(r)
+                    )
+                    with handler.lock:
+                        handler.stream.write(text)
+                        handler.flush()
+                else:
+                    for record in records_:
+                        handler.handle(record)
+            except Exception:  # pylint: disable=W0718
+                # ログ出力の失敗でアプリを止めない
+                pass
+
+    def stop(self) -> None:
+        """キューに残ったレコードを出力して終了する"""
+        if self._thread.is_alive():
+            self.queue.put(self._STOP)
+            self._thread.join(timeout=10.0)
+
+
+_log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+# 出力先がない場合はこれまでと同様にlastResort (WARNING以上をstderr) へ出力
+_writer = _BatchWriter(_log_queue, list(logger_.handlers) or [logging.lastResort])
+_queue_handler = _QueueHandler(_log_queue)
+logger_.handlers = [_queue_handler]
+# 終了時 (StreamlitはSIGTERMで正常終了する) にキューに残ったログを出力
+atexit.register(_writer.stop)
+
+
+def reduce_payload(text: str) -> str:
+    """プロンプトやレスポンスをLOG_PAYLOAD_MODEに従って短くする
+    Args:
+        text (str): 本文
+    Returns:
+        str: 記録する文字列
+    """
+    if LOG_PAYLOAD_MODE == "hash":
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"sha256:{digest} ({len(text)} chars)"
+    if (LOG_PAYLOAD_MODE == "truncate") and (len(text) > LOG_PAYLOAD_MAX_CHARS):
+        rest = len(text) - LOG_PAYLOAD_MAX_CHARS
+        return f"{text[:LOG_PAYLOAD_MAX_CHARS]}...(+{rest} chars)"
+    return text
+
+
 # logger wrapper
 def logger_info(
     source: str,
@@ -43,7 +183,12 @@ def logger_info(
     model_type: str | None = None,
     files: str | None = None,
     real_time: float | None = None,
+    cache: dict | None = None,
+    llm: dict | None = None,
 ):
+    # infoログは設定した割合だけ出力する (集計時はsample_rateで補正する)
+    if (LOG_INFO_SAMPLE_RATE < 1.0) and (random.random() >= LOG_INFO_SAMPLE_RATE):
+        return
     data_dict = {
         "app": "sxgpt",
         "source": source,
@@ -53,8 +198,11 @@ def logger_info(
         "model": model_name,
         "files": files,
         "real_time": get_str_hms_from(real_time) if real_time else None,
+        "cache": cache,  # キャッシュを使った場合 (類似キャッシュの誤ヒット確認用)
+        "llm": llm,  # LLM呼び出しの計測結果 (TTFT・出力速度・トークン数など)
+        "sample_rate": LOG_INFO_SAMPLE_RATE,
     }
-    logger_.info(json.dumps(data_dict, ensure_ascii=False))
+    logger_.info("%s", _JsonPayload(data_dict))
 
 
 def logger_error(
@@ -76,9 +224,9 @@ def logger_error(
         "prompt": prompt,
         "traceback": f"{traceback}",
         "files": files,
-        real_time: get_str_hms_from(real_time) if real_time else None,
+        "real_time": get_str_hms_from(real_time) if real_time else None,
     }
-    logger_.error(json.dumps(data_dict, ensure_ascii=False))
+    logger_.error("%s", _JsonPayload(data_dict))
 
 
 def get_str_hms_from(sec: float):
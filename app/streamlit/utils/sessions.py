@@ -1,14 +1,16 @@
 """Streamlitのセッション管理を行うモジュール"""
 
+import weakref
 from abc import ABCMeta
+from collections.abc import Mapping
 from dataclasses import dataclass
 from typing import Any, Self
 
 import streamlit as st
 
-from app.streamlit import plugins
 from app.streamlit.utils.common import ParameterSession
 from sx_agents.utils import ChatMemory, Model
+from sx_agents.utils.metrics import ACTIVE_SESSIONS
 
 
 # ------------------------------------------------------------------------------
@@ -20,12 +22,13 @@ class CommonSession:
     memory: ChatMemory
     status: str = "simplechat"
     #
-    plugins: dict[str, list[str]]
     prompt: str = ""
     kwargs: dict[str, Any] = {}
     #
     is_selector_activate: bool = True
     is_sidebar_disabled: bool = False
+    # 表示中のサイドバーの状態 (フラグメントの再実行で変わった場合は全体を再実行する)
+    is_sidebar_rendered_disabled: bool = False
     idx_selected_plugin: int = 0
     is_selector_activate: bool = True
     is_wellcom_message_enable: bool = True
@@ -40,7 +43,11 @@ class CommonSession:
             params.SYSTEM_ROLE,
             params.DISPLAY_PIC_HEIGHT,
             params.DISPLAY_PIC_BACKGROUND_COLOR,
+            max_bytes=params.MEMORY_MAX_BYTES,
         )
+        # セッションが破棄されたら (ブラウザを閉じた・リセットした) 数から除く
+        ACTIVE_SESSIONS.inc()
+        weakref.finalize(self, ACTIVE_SESSIONS.dec)
 
     @classmethod
     def get(cls) -> Self:
@@ -64,23 +71,13 @@ class CommonSession:
         return list(params.MODEL_CONFIG.keys())
 
     @property
-    def available_plugins(self) -> dict[str, list[str]]:
-        params = ParameterSession.get()
-        available_plugins = {}
-        for model_name in self.available_models:
-            available_plugins[model_name] = []
-            for plugin_name, module_name in params.PLUGINS.items():
-                module = getattr(plugins, module_name, None)
-                if module is None:
-                    continue
-                if hasattr(module, "WHITE_LIST"):
-                    if ("all" in module.WHITE_LIST) or (
-                        model_name in module.WHITE_LIST
-                    ):
-                        available_plugins[model_name].append(plugin_name)
-                else:
-                    available_plugins[model_name].append(plugin_name)
-        return available_plugins
+    def available_plugins(self) -> Mapping[str, tuple[str, ...]]:
+        # 読込時に計算済みの一覧をプロセス内で共有する
+        return ParameterSession.get().AVAILABLE_PLUGINS
+
+    @property
+    def plugins(self) -> Mapping[str, tuple[str, ...]]:
+        return self.available_plugins
 
     def set_env(self, env: str):
         # params = ParameterSession.get()
@@ -92,7 +89,6 @@ class CommonSession:
         # self.set_model(name)
         # params = ParameterSession.get()
         self.env = env
-        self.plugins = self.available_plugins
         name = self.available_models[0]
         self.set_model(name)
 
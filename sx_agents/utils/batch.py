@@ -0,0 +1,450 @@
+"""スプレッドシートの行ごとのプロンプトをまとめて実行するモジュール
+
+共有のイベントループで複数行を同時に実行し、デプロイのRPM/TPMの上限を超えないように送信を調整する
+同じプロンプトの行は1回だけ実行し、結果はチェックポイントファイルに保存する
+(再実行やプロセスの異常終了後は、保存済みの行を飛ばして続きから実行する)
+
+実行例:
+    executor = BatchExecutor(model, checkpoint_path="outputs/sheet.ckpt")
+    for result in executor.run_dataframe(df, "{質問}に答えてください", "回答", "out.csv"):
+        progress.progress(executor.progress)
+"""
+
+import asyncio
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any
+
+import openai
+
+from .cache import make_cache_key
+from .common import get_event_loop
+from .model import Model
+from .storage import DiskStore
+
+# ------------------------------------------------------------------------------
+#   Parameter設定
+# ------------------------------------------------------------------------------
+BATCH_MAX_CONCURRENCY = 16  # 同時に実行するリクエスト数
+BATCH_MAX_RETRIES = 5  # 1行あたりの再試行回数
+BATCH_BACKOFF_BASE = 1.0  # 再試行の待ち時間の初期値 (秒、再試行ごとに2倍)
+BATCH_BACKOFF_MAX = 60.0  # 再試行の待ち時間の上限 (秒)
+BATCH_CSV_FLUSH_EVERY = 50  # CSVに書き出す間隔 (完了した行数)
+# 再試行するエラー (レート制限・接続エラー・タイムアウト・5xx)
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+# ------------------------------------------------------------------------------
+# レート制限
+# ------------------------------------------------------------------------------
+class RateLimiter:
+    """RPM/TPMのトークンバケット (共有のイベントループ上で使う)
+    1分あたりの上限まで貯まるバケットからリクエスト数とトークン数を取り出し、足りない場合は待つ
+    Args:
+        rpm (int | None): 1分あたりのリクエスト数の上限 (Noneの場合は制限なし)
+        tpm (int | None): 1分あたりのトークン数の上限 (Noneの場合は制限なし)
+    """
+
+    def __init__(self, rpm: int | None = None, tpm: int | None = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm or 0)
+        self._tokens = float(tpm or 0)
+        self._updated = time.monotonic()
+        self._lock: asyncio.Lock | None = None
+
+    async def acquire(self, tokens: int) -> None:
+        """リクエスト1回分とトークンを取り出す (足りない場合は貯まるまで待つ)
+        Args:
+            tokens (int): 使用するトークン数の見積もり
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # 待っているリクエストを順番に通す (後から来た小さいリクエストに追い越させない)
+        async with self._lock:
+            if self.tpm:
+                tokens = min(tokens, self.tpm)
+            while True:
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+    def refund(self, tokens: int) -> None:
+        """見積もりより少なかったトークンをバケットに戻す
+        Args:
+            tokens (int): 戻すトークン数 (負の場合は追加で消費する)
+        """
+        if self.tpm:
+            self._refill()
+            self._tokens = min(self._tokens + tokens, float(self.tpm))
+
+    def penalize(self, seconds: float) -> None:
+        """レート制限のエラーを受けた場合に、指定の秒数だけ送信を止める
+        Args:
+            seconds (float): 止める秒数
+        """
+        self._refill()
+        if self.rpm:
+            self._requests = min(self._requests, -self.rpm * seconds / 60.0)
+        if self.tpm:
+            self._tokens = min(self._tokens, -self.tpm * seconds / 60.0)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self._requests + elapsed * self.rpm / 60.0, self.rpm)
+        if self.tpm:
+            self._tokens = min(self._tokens + elapsed * self.tpm / 60.0, self.tpm)
+
+    def _wait_time(self, tokens: int) -> float:
+        self._refill()
+        wait = 0.0
+        if self.rpm and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+        if self.tpm and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60.0 / self.tpm)
+        return wait
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: Model) -> RateLimiter:
+    """デプロイごとに共有するレート制限を取得する (同じデプロイを使う全セッションで共有)
+    Args:
+        model (Model): モデル設定
+    Returns:
+        RateLimiter: レート制限
+    """
+    config = model.resolve_config()
+    key = f"{config.get('base_url', '')}:{config.get('model_name', model.name)}"
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if (limiter is None) or (limiter.rpm, limiter.tpm) != (
+            model.rpm_limit,
+            model.tpm_limit,
+        ):
+            limiter = RateLimiter(model.rpm_limit, model.tpm_limit)
+            _rate_limiters[key] = limiter
+        return limiter
+
+
+# ------------------------------------------------------------------------------
+# バッチ実行
+# ------------------------------------------------------------------------------
+@dataclass
+class BatchResult:
+    """1行分の実行結果
+    Args:
+        index (Any): 行のインデックス
+        output (str | None): LLMの出力 (失敗した場合はNone)
+        error (str | None): 再試行しても失敗した場合のエラー
+        cached (bool): チェックポイントまたは同じプロンプトの行の結果を使ったかどうか
+    """
+
+    index: Any
+    output: str | None = None
+    error: str | None = None
+    cached: bool = False
+
+
+@dataclass
+class _PromptGroup:
+    """同じプロンプトの行 (まとめて1回だけ実行する)"""
+
+    messages: list[dict[str, Any]]
+    indices: list[Any]
+    estimated: int = 0  # トークン数の見積もり
+    output: str | None = None  # チェックポイントに保存済みの出力
+
+
+class BatchExecutor:
+    """行ごとのプロンプトを同時に実行するクラス
+    Args:
+        model (Model): モデル設定
+        system_role (str | None): システムロール
+        checkpoint_path (str | None): チェックポイントファイルのパス (Noneの場合は保存しない)
+        max_concurrency (int): 同時に実行するリクエスト数
+        max_retries (int): 1行あたりの再試行回数
+        **kwargs: クライアントのその他のパラメータ
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        system_role: str | None = None,
+        checkpoint_path: str | None = None,
+        max_concurrency: int = BATCH_MAX_CONCURRENCY,
+        max_retries: int = BATCH_MAX_RETRIES,
+        **kwargs,
+    ):
+        self.model = model
+        self.system_role = system_role
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.kwargs = kwargs
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint: DiskStore | None = None
+        self.total = 0  # 実行する行数
+        self.done = 0  # 完了した行数 (失敗を含む)
+        self.cancelled = False
+        self._future: Future | None = None
+        self._results: queue.Queue[BatchResult | BaseException | None] = queue.Queue()
+
+    @property
+    def progress(self) -> float:
+        """進捗 (0.0〜1.0)"""
+        return self.done / self.total if self.total else 1.0
+
+    def make_messages(self, prompt: str) -> list[dict[str, Any]]:
+        """プロンプトからOpenAI API形式のメッセージリストを作成する
+        Args:
+            prompt (str): 行のプロンプト
+        Returns:
+            list[dict[str, Any]]: メッセージリスト
+        """
+        messages = [{"role": "user", "content": prompt}]
+        if self.system_role:
+            messages.insert(0, {"role": "system", "content": self.system_role})
+        return messages
+
+    def run(self, prompts: dict[Any, str]) -> Iterator[BatchResult]:
+        """行ごとのプロンプトを実行し、完了した順に結果を返す
+        結果は呼び出し元のスレッドで返すため、Streamlitの表示の更新に使える
+        Args:
+            prompts (dict[Any, str]): 行のインデックスとプロンプト
+        Yields:
+            BatchResult: 1行分の実行結果
+        """
+        self.total, self.done, self.cancelled = len(prompts), 0, False
+        self._results = queue.Queue()
+        self._future = asyncio.run_coroutine_threadsafe(
+            self._run(prompts, self._results.put), get_event_loop()
+        )
+        try:
+            while True:
+                result = self._results.get()
+                if self.cancelled:
+                    return
+                if result is None:
+                    return
+                if isinstance(result, BaseException):
+                    raise result
+                self.done += 1
+                yield result
+        finally:
+            # 読み込みを途中でやめた場合は実行中のリクエストも止める
+            self.cancel()
+
+    def run_dataframe(
+        self,
+        df,
+        template: str,
+        output_column: str,
+        csv_path: str | None = None,
+        flush_every: int = BATCH_CSV_FLUSH_EVERY,
+    ) -> Iterator[BatchResult]:
+        """DataFrameの行ごとにテンプレートからプロンプトを作成して実行し、結果を列に書き込む
+        Args:
+            df (pandas.DataFrame): 入力のDataFrame (結果の列が追加される)
+            template (str): プロンプトのテンプレート (列名を{列名}で参照する)
+            output_column (str): 結果を書き込む列名
+            csv_path (str | None): 途中結果を書き出すCSVファイルのパス
+            flush_every (int): CSVに書き出す間隔 (完了した行数)
+        Yields:
+            BatchResult: 1行分の実行結果
+        """
+        prompts = {
+            index: template.format(**{str(k): v for k, v in row.items()})
+            for index, row in df.iterrows()
+        }
+        if output_column not in df.columns:
+            df[output_column] = None
+        count = 0
+        try:
+            for result in self.run(prompts):
+                df.at[result.index, output_column] = (
+                    result.output if result.error is None else f"ERROR: {result.error}"
+                )
+                count += 1
+                if csv_path and (count % flush_every == 0):
+                    _write_csv(df, csv_path)
+                yield result
+        finally:
+            if csv_path:
+                _write_csv(df, csv_path)
+
+    def cancel(self) -> bool:
+        """実行を中断する (完了した行はチェックポイントに残る)
+        Returns:
+            bool: 実行中のバッチを中断した場合はTrue
+        """
+        if (self._future is None) or self._future.done() or self.cancelled:
+            return False
+        self.cancelled = True
+        self._future.cancel()
+        self._results.put(None)
+        return True
+
+    # --------------------------------------------------------------------------
+    # イベントループ上の処理
+    # --------------------------------------------------------------------------
+    async def _run(self, prompts: dict[Any, str], put: Callable[[Any], None]) -> None:
+        try:
+            # SQLiteの読込とトークン数の計算で共有のイベントループを止めないよう別スレッドで行う
+            groups = await asyncio.to_thread(self._prepare, prompts)
+            chat = self.model.create_langchain_chat(max_retries=0, **self.kwargs)
+            limiter = get_rate_limiter(self.model)
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+
+            async def run_group(key: str, group: _PromptGroup) -> None:
+                output, error = group.output, None
+                restored = output is not None
+                if not restored:
+                    try:
+                        async with semaphore:
+                            output, error = await self._invoke(
+                                chat, limiter, group.messages, group.estimated
+                            )
+                        if error is None:
+                            await asyncio.to_thread(self._save_checkpoint, key, output)
+                    except Exception as e:  # pylint: disable=W0718
+                        # 想定外のエラーもその行の結果とし、他の行の実行は続ける
+                        output, error = None, f"{type(e).__name__}: {e}"
+                for i, index in enumerate(group.indices):
+                    put(BatchResult(index, output, error, cached=restored or i > 0))
+
+            await asyncio.gather(
+                *(run_group(key, group) for key, group in groups.items())
+            )
+        except Exception as e:  # pylint: disable=W0718
+            put(e)
+            return
+        finally:
+            if self.checkpoint is not None:
+                checkpoint, self.checkpoint = self.checkpoint, None
+                await asyncio.to_thread(checkpoint.close)
+        put(None)
+
+    def _prepare(self, prompts: dict[Any, str]) -> dict[str, _PromptGroup]:
+        """同じプロンプトの行をまとめ、保存済みの出力とトークン数の見積もりを求める
+        (別スレッドで実行する)
+        Args:
+            prompts (dict[Any, str]): 行のインデックスとプロンプト
+        Returns:
+            dict[str, _PromptGroup]: キーごとの行
+        """
+        if self.checkpoint_path is not None:
+            os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+            self.checkpoint = DiskStore(filepath=self.checkpoint_path)
+        groups: dict[str, _PromptGroup] = {}
+        for index, prompt in prompts.items():
+            messages = self.make_messages(prompt)
+            # クライアントのパラメータ (温度など) が違う場合は別の結果として扱う
+            key = make_cache_key(
+                self.model.type, dict(self.model.config), self.kwargs, messages
+            )
+            if key in groups:
+                groups[key].indices.append(index)
+            else:
+                groups[key] = _PromptGroup(messages, [index])
+        for key, group in groups.items():
+            group.output = self._load_checkpoint(key)
+            if group.output is None:
+                group.estimated = self.model.count_tokens_from_message(
+                    group.messages
+                ) + (self.model.max_response_token or 0)
+        return groups
+
+    async def _invoke(
+        self,
+        chat,
+        limiter: RateLimiter,
+        messages: list[dict[str, Any]],
+        estimated: int,
+    ) -> tuple[str | None, str | None]:
+        """1リクエストを実行する (再試行可能なエラーは待ってから再試行する)
+        Args:
+            chat: Langchainのクライアント
+            limiter (RateLimiter): レート制限
+            messages (list[dict[str, Any]]): メッセージリスト
+            estimated (int): トークン数の見積もり
+        Returns:
+            str | None: 出力
+            str | None: 再試行しても失敗した場合のエラー
+        """
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire(estimated)
+            try:
+                response = await chat.ainvoke(messages)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    return None, f"{type(e).__name__}: {e}"
+                delay = _backoff(attempt, e)
+                if isinstance(e, openai.RateLimitError):
+                    limiter.penalize(delay)
+                await asyncio.sleep(delay)
+                continue
+            except openai.APIStatusError as e:
+                # リクエストの内容によるエラー (400など) は再試行しない
+                return None, f"{type(e).__name__}: {e}"
+            usage = getattr(response, "usage_metadata", None) or {}
+            if usage.get("total_tokens"):
+                limiter.refund(estimated - usage["total_tokens"])
+            return str(response.content), None
+        return None, "max retries exceeded"
+
+    def _load_checkpoint(self, key: str) -> str | None:
+        if self.checkpoint is None:
+            return None
+        try:
+            return self.checkpoint.get(key)
+        except KeyError:
+            return None
+
+    def _save_checkpoint(self, key: str, output: str) -> None:
+        if self.checkpoint is not None:
+            self.checkpoint.put(key, output)
+
+
+def _backoff(attempt: int, error: Exception) -> float:
+    """再試行までの待ち時間 (Retry-Afterがあればそれに従い、なければ指数的に増やす)"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), BATCH_BACKOFF_MAX)
+    except ValueError:
+        pass
+    delay = min(BATCH_BACKOFF_BASE * 2**attempt, BATCH_BACKOFF_MAX)
+    # 同時に失敗したリクエストが同時に再試行しないようにばらつかせる
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _write_csv(df, csv_path: str) -> None:
+    """DataFrameをCSVに書き出す (書き込み途中のファイルを読まれないよう一時ファイルから置き換える)"""
+    dirpath = os.path.dirname(csv_path) or "."
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirpath, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8-sig", newline="") as f:
+        df.to_csv(f)
+    os.replace(tmp_path, csv_path)
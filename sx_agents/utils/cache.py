@@ -0,0 +1,356 @@
+"""LLMのレスポンスをキャッシュするモジュール"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+from .metrics import CACHE_REQUESTS
+from .storage import DiskStore
+
+# ------------------------------------------------------------------------------
+#   Parameter設定
+# ------------------------------------------------------------------------------
+RESPONSE_CACHE_MAX_ENTRIES = 512  # メモリに保持するレスポンス数の上限
+RESPONSE_CACHE_TTL = 3600.0  # レスポンスを再利用する秒数
+# ディスクのキャッシュの保存先 (未設定の場合はメモリのみ)
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR")
+# 類似プロンプトのキャッシュ設定
+SIMILAR_CACHE_THRESHOLD = 0.9  # 再利用するJaccard類似度の下限
+SIMILAR_CACHE_NUM_PERM = 64  # MinHashの署名の長さ
+SIMILAR_CACHE_BANDS = 16  # LSHのバンド数 (NUM_PERMを割り切れる数)
+SIMILAR_CACHE_SHINGLE_SIZE = 3  # 文字n-gramのn
+
+
+def make_cache_key(*parts: Any) -> str:
+    """JSONに変換した値から安定したハッシュキーを生成する
+    Args:
+        *parts (Any): キーに含める値 (メッセージ、モデル設定など)
+    Returns:
+        str: キー
+    """
+    text = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """完全一致したリクエストのレスポンスを再利用するキャッシュ (プロセス内で共有)
+    メモリはLRUと有効期限で削除し、dirpathを指定した場合はディスクにも保存する
+    Args:
+        max_entries (int): メモリに保持するレスポンス数の上限
+        ttl (float): レスポンスを再利用する秒数
+        dirpath (str): ディスクのキャッシュの保存先 (Noneの場合はメモリのみ)
+        name (str): メトリクスのラベル (用途ごとにヒット率を分けて集計する)
+        filename (str): ディスクのキャッシュのファイル名 (用途ごとに分ける)
+    """
+
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        dirpath: str | None = None,
+        name: str = "response",
+        filename: str = "response_cache.sqlite3",
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self._data: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = None
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+            self._store = DiskStore(filepath=os.path.join(dirpath, filename))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> str | None:
+        """レスポンスを取得する (見つからないか期限切れの場合はNone)
+        Args:
+            key (str): キー
+        Returns:
+            str | None: レスポンス
+        """
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                if item[1] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                    return item[0]
+                del self._data[key]
+        if self._store is not None:
+            try:
+                value, expires_at = self._store.get(key)
+            except KeyError:
+                pass
+            else:
+                if expires_at > now:
+                    self._put_memory(key, value, expires_at)
+                    with self._lock:
+                        self.hits += 1
+                    CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                    return value
+                self._store.delete(key)
+        with self._lock:
+            self.misses += 1
+        CACHE_REQUESTS.inc(cache=self.name, result="miss")
+        return None
+
+    def put(self, key: str, value: str) -> None:
+        """レスポンスを保存する
+        Args:
+            key (str): キー
+            value (str): レスポンス
+        """
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, value, expires_at)
+        if self._store is not None:
+            self._store.put(key, (value, expires_at))
+
+    def clear(self) -> None:
+        """メモリのキャッシュを全て削除する"""
+        with self._lock:
+            self._data.clear()
+
+    def _put_memory(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+# プロセス内で共有するレスポンスのキャッシュ
+llm_response_cache = ResponseCache(dirpath=RESPONSE_CACHE_DIR)
+
+
+# ------------------------------------------------------------------------------
+# 類似プロンプトのキャッシュ
+# ------------------------------------------------------------------------------
+_re_ignored = re.compile(r"[\W_]+")
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = np.random.default_rng(20240401)  # プロセス間で同じ署名になるよう固定
+_PERM_A = _rng.integers(1, 1 << 32, size=SIMILAR_CACHE_NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 1 << 32, size=SIMILAR_CACHE_NUM_PERM, dtype=np.uint64)
+
+
+def normalize_prompt(text: str) -> str:
+    """表記ゆれを吸収するためにプロンプトを正規化する
+    全角/半角の統一 (NFKC)、小文字化、空白と句読点・記号の除去を行う
+    Args:
+        text (str): プロンプト
+    Returns:
+        str: 正規化したプロンプト
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _re_ignored.sub("", text)
+
+
+def minhash_signature(
+    text: str, shingle_size: int = SIMILAR_CACHE_SHINGLE_SIZE
+) -> np.ndarray:
+    """文字n-gramの集合からMinHashの署名を計算する
+    Args:
+        text (str): 正規化したテキスト
+        shingle_size (int): 文字n-gramのn
+    Returns:
+        np.ndarray: 署名 (SIMILAR_CACHE_NUM_PERM個のuint64)
+    """
+    n = max(1, len(text) - shingle_size + 1)
+    shingles = {text[i : i + shingle_size] for i in range(n)}
+    hashes = np.fromiter(
+        (
+            int.from_bytes(
+                hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(),
+                "little",
+            )
+            for shingle in shingles
+        ),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    # (a * h + b) mod p を全ての順列でまとめて計算 (a, b, h は32bitなので桁あふれしない)
+    values = (_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return values.min(axis=1)
+
+
+@dataclass(frozen=True)
+class SimilarHit:
+    """類似プロンプトのキャッシュのヒット結果"""
+
+    response: str  # 保存されていたレスポンス
+    prompt: str  # 保存されていたプロンプト
+    similarity: float  # 推定Jaccard類似度
+
+
+@dataclass
+class _SimilarEntry:
+    namespace: str
+    prompt: str
+    normalized: str
+    signature: np.ndarray
+    response: str
+    expires_at: float
+    band_keys: list[tuple]
+
+
+class SimilarResponseCache:
+    """表記ゆれのある同じプロンプトのレスポンスを再利用するキャッシュ (プロセス内で共有)
+    MinHashとLSHで候補を絞り込み、類似度が閾値以上のものを返す (外部APIや埋め込みは使わない)
+    Args:
+        threshold (float): 再利用するJaccard類似度の下限
+        max_entries (int): 保持するレスポンス数の上限
+        ttl (float): レスポンスを再利用する秒数
+        bands (int): LSHのバンド数
+        review_size (int): 誤ヒット確認用に保持する直近のヒット数
+    """
+
+    lookups: int = 0
+    hits: int = 0
+
+    def __init__(
+        self,
+        threshold: float = SIMILAR_CACHE_THRESHOLD,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        bands: int = SIMILAR_CACHE_BANDS,
+        review_size: int = 100,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bands = bands
+        self._rows = SIMILAR_CACHE_NUM_PERM // bands
+        self._entries: OrderedDict[int, _SimilarEntry] = OrderedDict()
+        self._index: dict[tuple, set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.recent_hits: deque[dict[str, Any]] = deque(maxlen=review_size)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        """ヒット率"""
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def lookup(
+        self, namespace: str, prompt: str, threshold: float | None = None
+    ) -> SimilarHit | None:
+        """類似したプロンプトのレスポンスを検索する
+        Args:
+            namespace (str): モデルやシステムロールなど完全一致が必要な条件のキー
+            prompt (str): プロンプト
+            threshold (float): 類似度の下限 (Noneの場合はキャッシュの設定値)
+        Returns:
+            SimilarHit | None: ヒットした場合はレスポンスと類似度
+        """
+        threshold = self.threshold if threshold is None else threshold
+        normalized = normalize_prompt(prompt)
+        signature = minhash_signature(normalized)
+        now = time.time()
+        best: tuple[float, int] | None = None
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band_key in self._band_keys(namespace, signature):
+                candidates |= self._index.get(band_key, set())
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry.expires_at <= now:
+                    continue
+                if entry.normalized == normalized:
+                    similarity = 1.0
+                else:
+                    similarity = float(np.mean(entry.signature == signature))
+                if (similarity >= threshold) and (
+                    (best is None) or (similarity > best[0])
+                ):
+                    best = (similarity, entry_id)
+            if best is None:
+                CACHE_REQUESTS.inc(cache="similar", result="miss")
+                return None
+            similarity, entry_id = best
+            entry = self._entries[entry_id]
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache="similar", result="hit")
+            self.recent_hits.append(
+                {
+                    "time": now,
+                    "prompt": prompt,
+                    "cached_prompt": entry.prompt,
+                    "similarity": similarity,
+                }
+            )
+        return SimilarHit(entry.response, entry.prompt, similarity)
+
+    def put(self, namespace: str, prompt: str, response: str) -> None:
+        """レスポンスを保存する
+        Args:
+            namespace (str): モデルやシステムロールなど完全一致が必要な条件のキー
+            prompt (str): プロンプト
+            response (str): レスポンス
+        """
+        normalized = normalize_prompt(prompt)
+        signature = minhash_signature(normalized)
+        band_keys = self._band_keys(namespace, signature)
+        entry = _SimilarEntry(
+            namespace,
+            prompt,
+            normalized,
+            signature,
+            response,
+            time.time() + self.ttl,
+            band_keys,
+        )
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = entry
+            for band_key in band_keys:
+                self._index.setdefault(band_key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """全てのレスポンスを削除する"""
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def _band_keys(self, namespace: str, signature: np.ndarray) -> list[tuple]:
+        rows = self._rows
+        return [
+            (namespace, i, signature[i * rows : (i + 1) * rows].tobytes())
+            for i in range(self.bands)
+        ]
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        for band_key in entry.band_keys:
+            ids = self._index.get(band_key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._index[band_key]
+
+
+# プロセス内で共有する類似プロンプトのキャッシュ
+similar_response_cache = SimilarResponseCache()
@@ -0,0 +1,246 @@
+"""LLMのストリーミング応答を記録・再生するモジュール (性能の回帰試験用)
+
+記録モードでは実際のAPIの応答を差分の区切りと到着間隔ごとにカセットファイルへ保存し、
+再生モードではネットワークに接続せずに同じ差分を同じ間隔 (または倍速・待ち時間なし) で返す
+
+環境変数で有効にする:
+    LLM_CASSETTE_MODE   record / replay (未設定の場合は無効)
+    LLM_CASSETTE_DIR    カセットファイルの保存先 (既定: ./cassettes)
+    LLM_CASSETTE_SPEED  再生速度の倍率 (1: 記録時と同じ, 10: 10倍速, 0: 待ち時間なし)
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections.abc import AsyncIterator, Iterator
+from dataclasses import dataclass
+from typing import Any
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.chat_models import (
+    BaseChatModel,
+    agenerate_from_stream,
+    generate_from_stream,
+)
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+# ------------------------------------------------------------------------------
+#   Parameter設定
+# ------------------------------------------------------------------------------
+CASSETTE_MODES = ("record", "replay")
+DEFAULT_CASSETTE_DIR = "cassettes"
+
+
+class CassetteNotFoundError(LookupError):
+    """再生モードでリクエストに対応するカセットがない場合の例外"""
+
+
+@dataclass(frozen=True)
+class CassetteConfig:
+    """カセットの設定
+    Args:
+        mode (str): record (記録) または replay (再生)
+        dirpath (str): カセットファイルの保存先
+        speed (float): 再生速度の倍率 (0の場合は待ち時間なし)
+    """
+
+    mode: str
+    dirpath: str = DEFAULT_CASSETTE_DIR
+    speed: float = 1.0
+
+    def __post_init__(self):
+        if self.mode not in CASSETTE_MODES:
+            raise ValueError(f"cassette mode must be one of {CASSETTE_MODES}")
+
+    @classmethod
+    def from_env(cls) -> "CassetteConfig | None":
+        """環境変数から設定を読み込む (LLM_CASSETTE_MODEが未設定の場合はNone)"""
+        mode = os.getenv("LLM_CASSETTE_MODE")
+        if not mode:
+            return None
+        return cls(
+            mode=mode,
+            dirpath=os.getenv("LLM_CASSETTE_DIR", DEFAULT_CASSETTE_DIR),
+            speed=float(os.getenv("LLM_CASSETTE_SPEED", "1.0")),
+        )
+
+
+class CassetteChatModel(BaseChatModel):
+    """カセットを記録・再生するチャットモデル
+    記録モードではinnerのストリーミング応答をそのまま返しながら保存する
+    再生モードではinnerを使わずにカセットの内容を返す
+    """
+
+    cassette: CassetteConfig
+    model_name: str = ""  # カセットのキーに含めるモデル名
+    inner: BaseChatModel | None = None  # 記録モードで呼び出す実際のクライアント
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cassette-{self.cassette.mode}"
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        # コールバックの計測結果をモデル名で集計できるようにする
+        return {"model_name": self.model_name}
+
+    # --------------------------------------------------------------------------
+    # カセットファイル
+    # --------------------------------------------------------------------------
+    def cassette_key(
+        self, messages: list[BaseMessage], stop: list[str] | None = None
+    ) -> str:
+        """リクエストからカセットのキーを生成する
+        Args:
+            messages (list[BaseMessage]): メッセージ
+            stop (list[str]): 停止文字列
+        Returns:
+            str: キー
+        """
+        data = {
+            "model": self.model_name,
+            "messages": [[m.type, m.content] for m in messages],
+            "stop": stop,
+        }
+        text = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def cassette_path(self, key: str) -> str:
+        """カセットファイルのパス"""
+        return os.path.join(self.cassette.dirpath, f"{key}.json")
+
+    def _load(self, key: str) -> list[dict[str, Any]]:
+        path = self.cassette_path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)["chunks"]
+        except FileNotFoundError as e:
+            raise CassetteNotFoundError(
+                f"No cassette for this request ({path}). Record it first."
+            ) from e
+
+    def _save(self, key: str, chunks: list[dict[str, Any]]) -> None:
+        os.makedirs(self.cassette.dirpath, exist_ok=True)
+        data = {"key": key, "model": self.model_name, "chunks": chunks}
+        # 書き込み途中のファイルを再生しないよう一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.cassette.dirpath, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.cassette_path(key))
+
+    def _delay(self, recorded: float) -> float:
+        speed = self.cassette.speed
+        return recorded / speed if speed > 0 else 0.0
+
+    # --------------------------------------------------------------------------
+    # BaseChatModelの実装
+    # --------------------------------------------------------------------------
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(
+            self._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(
+            self._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        key = self.cassette_key(messages, stop)
+        if self.cassette.mode == "replay":
+            for data in self._load(key):
+                time.sleep(self._delay(data["delay"]))
+                chunk = _to_chunk(data)
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            return
+        recorded = []
+        last = time.perf_counter()
+        # 公開APIで呼び出し、innerのコールバック・トレースも通常どおり動かす
+        # (呼び出し元のコールバックには、このモデルの実行として受信した時刻に通知する)
+        for message in self.inner.stream(messages, stop=stop, **kwargs):
+            now = time.perf_counter()
+            chunk = ChatGenerationChunk(message=message)
+            recorded.append(_from_chunk(chunk, now - last))
+            last = now
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        # 最後まで受信できた応答のみ保存
+        self._save(key, recorded)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        key = self.cassette_key(messages, stop)
+        if self.cassette.mode == "replay":
+            for data in self._load(key):
+                await asyncio.sleep(self._delay(data["delay"]))
+                chunk = _to_chunk(data)
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            return
+        recorded = []
+        last = time.perf_counter()
+        async for message in self.inner.astream(messages, stop=stop, **kwargs):
+            now = time.perf_counter()
+            chunk = ChatGenerationChunk(message=message)
+            recorded.append(_from_chunk(chunk, now - last))
+            last = now
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        # ファイルの書き込みで共有のイベントループを止めないよう別スレッドで保存する
+        await asyncio.to_thread(self._save, key, recorded)
+
+
+def _from_chunk(chunk: ChatGenerationChunk, delay: float) -> dict[str, Any]:
+    """差分を保存する形式に変換する (delayは前の差分からの秒数、最初はリクエストから)"""
+    message = chunk.message
+    return {
+        "delay": delay,
+        "content": message.content,
+        "usage": getattr(message, "usage_metadata", None),
+        "response_metadata": message.response_metadata or None,
+    }
+
+
+def _to_chunk(data: dict[str, Any]) -> ChatGenerationChunk:
+    """保存した差分を復元する"""
+    message = AIMessageChunk(
+        content=data["content"],
+        usage_metadata=data.get("usage"),
+        response_metadata=data.get("response_metadata") or {},
+    )
+    return ChatGenerationChunk(message=message)
@@ -1,13 +1,25 @@
 """共通処理を定義するモジュール"""
 
+import asyncio
 import base64
 import json
+import multiprocessing
+import os
+import queue
 import re
+import struct
+import threading
 import time
+from collections import OrderedDict
+from collections.abc import AsyncIterable, Callable, Iterable, Iterator
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import lru_cache
 from io import BytesIO
 from math import ceil
 from typing import Any
-from PIL import Image, ImageOps
+from PIL import ExifTags, Image
 import tiktoken
 from openai import Stream
 from openai.types.chat import (
@@ -26,35 +38,277 @@ config_pic_params = {
     "base_token": 85,
     "extra_token": 170,
 }
+# トークン数計算の設定 (OpenAIのマニュアル参考)
+TOKENS_PER_MESSAGE = 4  # <im_start>{role/name}\n{content}<im_end>\n
+TOKENS_REPLY_PRIMING = 2  # <im_start>assistant
+# エンコード済み画像URLのキャッシュ上限 (プロセス全体のバイト数)
+IMAGE_URL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# ストリーミング表示で差分をまとめて画面へ送る間隔 (秒)
+STREAM_FRAME_INTERVAL = 0.04
+# 画像の縮小で整数倍の縮小 (reduce) を先に行う目安 (3以上でLANCZOSのみと見分けがつかない)
+RESIZE_REDUCING_GAP = 3.0
+# 画像処理のワーカープロセス数 (環境変数IMAGE_POOL_WORKERSで変更、0の場合は呼び出し元で実行)
+IMAGE_POOL_MAX_WORKERS = int(
+    os.getenv("IMAGE_POOL_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+IMAGE_POOL_MAX_PENDING = 32  # 実行中と待ちを合わせたタスク数の上限
+IMAGE_POOL_TIMEOUT = 60.0  # 空き待ちと処理結果の待ち時間の上限 (秒)
+# EXIFのOrientationごとの向きの補正 (ImageOps.exif_transposeと同じ)
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
 
 
-def crawring_message(message: str, sleep=0.01):
-    """メッセージを1文字ずつストリーミング
+def crawring_message(
+    message: str, sleep: float = 0.0, interval: float = STREAM_FRAME_INTERVAL
+):
+    """メッセージをストリーミング
+    sleepが0の場合は待たずに全文を出力し、指定した場合もフレーム間隔ごとにまとめて出力する
     Args:
         message (str): メッセージ
-        sleep (float): スリープ時間
+        sleep (float): 1文字あたりのスリープ時間
+        interval (float): 画面へ出力する間隔
     Yields:
-            str: メッセージの1文字"""
-    for w in message:
+            str: メッセージの一部"""
+    if sleep <= 0.0:
+        yield message
+        return
+    n = max(1, int(interval / sleep))
+    for i in range(0, len(message), n):
+        w = message[i : i + n]
         yield w
-        time.sleep(sleep)
+        time.sleep(sleep * len(w))
 
 
 def crawring_message_from_response(
-    response: ChatCompletion | Stream[ChatCompletionChunk], sleep=0.01
+    response: ChatCompletion | Stream[ChatCompletionChunk],
+    interval: float = STREAM_FRAME_INTERVAL,
 ):
-    """ChatGPTのレスポンスから1文字ずつストリーミング
+    """ChatGPTのレスポンスからフレーム間隔ごとにまとめてストリーミング
     Args:
         response (ChatCompletionChunk): ChatGPTのレスポンス
-        sleep (float): スリープ時間
+        interval (float): 画面へ出力する間隔
+    Yields:
+        str: メッセージの差分
+    """
+
+    def deltas():
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content is not None:  # type: ignore
+                yield chunk.choices[0].delta.content  # type: ignore
+
+    yield from coalesce_stream(deltas(), interval)
+
+
+_END_OF_STREAM = object()
+
+
+def coalesce_stream(
+    chunks: Iterable[Any], interval: float = STREAM_FRAME_INTERVAL
+) -> Iterator[Any]:
+    """ストリーミングの差分をフレーム間隔ごとにまとめて出力する
+    上流は別スレッドで読み込み、前回の出力から間隔が空いていれば届いた差分をすぐに出力するため、
+    上流が遅い場合に待ち時間は追加されない
+    Args:
+        chunks (Iterable[Any]): 上流のストリーム (文字列以外はまとめずにそのまま出力)
+        interval (float): 画面へ出力する間隔
     Yields:
-        str: メッセージの1文字
+        Any: まとめた差分
+    """
+    q: queue.Queue[tuple[Any, BaseException | None]] = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                q.put((chunk, None))
+        except BaseException as e:  # pylint: disable=W0718
+            q.put((None, e))
+            return
+        q.put((_END_OF_STREAM, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    buffer: list[str] = []
+    last_flush = 0.0
+    try:
+        while True:
+            timeout = None
+            if buffer:
+                timeout = max(0.0, last_flush + interval - time.monotonic())
+            try:
+                chunk, error = q.get(timeout=timeout)
+            except queue.Empty:
+                # フレーム間隔が経過したのでまとめた差分を出力
+                yield "".join(buffer)
+                buffer.clear()
+                last_flush = time.monotonic()
+                continue
+            if (error is not None) or (chunk is _END_OF_STREAM):
+                if buffer:
+                    yield "".join(buffer)
+                if error is not None:
+                    raise error
+                return
+            if not isinstance(chunk, str):
+                if buffer:
+                    yield "".join(buffer)
+                    buffer.clear()
+                yield chunk
+                last_flush = time.monotonic()
+                continue
+            if chunk:
+                buffer.append(chunk)
+            if buffer and (time.monotonic() - last_flush >= interval):
+                yield "".join(buffer)
+                buffer.clear()
+                last_flush = time.monotonic()
+    finally:
+        stop.set()
+
+
+# ------------------------------------------------------------------------------
+# 非同期ストリーミング
+# ------------------------------------------------------------------------------
+_event_loop: asyncio.AbstractEventLoop | None = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """プロセス内で共有するイベントループを取得する (専用スレッドで実行し続ける)
+    非同期HTTPクライアントの接続プールはループに紐づくため、全セッションで同じループを使う
+    Returns:
+        asyncio.AbstractEventLoop: イベントループ
+    """
+    global _event_loop  # pylint: disable=W0603
+    with _event_loop_lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="sx_agents-event-loop", daemon=True
+            ).start()
+            _event_loop = loop
+        return _event_loop
+
+
+class AsyncStream:
+    """非同期ストリームを同期的に読むイテレータ
+    共有のイベントループで受信し、cancel()で受信中のタスクを中断してHTTP接続を閉じる
+    Args:
+        factory (Callable[[], AsyncIterable[Any]]): 非同期ストリームの生成関数 (chain.astreamなど)
+    """
+
+    def __init__(self, factory: Callable[[], AsyncIterable[Any]]):
+        self._factory = factory
+        self._queue: queue.Queue[tuple[Any, BaseException | None]] = queue.Queue()
+        self._future: Future | None = None
+        self.chunks: list[Any] = []  # 受信した差分
+        self.finished = False  # 最後まで受信したか、エラーで終了したか
+        self.cancelled = False
+
+    @property
+    def text(self) -> str:
+        """受信済みのテキスト"""
+        return "".join(str(chunk) for chunk in self.chunks)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self._future is None:
+            self._future = asyncio.run_coroutine_threadsafe(
+                self._consume(), get_event_loop()
+            )
+        try:
+            while True:
+                chunk, error = self._queue.get()
+                if self.cancelled:
+                    # 途中までのレスポンスをキャッシュなどに保存させないため例外にする
+                    raise CancelledError()
+                if error is not None:
+                    self.finished = True
+                    raise error
+                if chunk is _END_OF_STREAM:
+                    self.finished = True
+                    return
+                self.chunks.append(chunk)
+                yield chunk
+        finally:
+            # 読み込みを途中でやめた場合も生成を止める
+            self.cancel()
+
+    def cancel(self) -> bool:
+        """受信中の生成を中断する
+        Returns:
+            bool: 生成中のリクエストを中断した場合はTrue
+        """
+        if self.finished or self.cancelled or (self._future is None):
+            return False
+        self.cancelled = True
+        # タスクのキャンセルはイベントループ上で実行され、ストリームのHTTP接続が閉じられる
+        self._future.cancel()
+        self._queue.put((_END_OF_STREAM, None))
+        return True
+
+    async def _consume(self) -> None:
+        try:
+            async for chunk in self._factory():
+                self._queue.put((chunk, None))
+        except Exception as e:  # pylint: disable=W0718
+            self._queue.put((None, e))
+            return
+        self._queue.put((_END_OF_STREAM, None))
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-3.5-turbo-0301") -> tiktoken.Encoding:
+    """モデル名からtiktokenのエンコーディングを取得する (プロセス内でキャッシュ)
+    Args:
+        model (str): モデル名
+    Returns:
+        tiktoken.Encoding: エンコーディング
     """
-    for chunk in response:
-        if chunk.choices and chunk.choices[0].delta.content is not None:  # type: ignore
-            for w in chunk.choices[0].delta.content or " ":  # type: ignore
-                yield w
-                time.sleep(sleep)
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_message(
+    message: dict[str, Any],
+    encoding: tiktoken.Encoding,
+    config_pic: dict | None = None,
+) -> int:
+    """1メッセージ分のトークン数をカウントする (返信のプライミング分は含まない)
+    Args:
+        message (dict): メッセージ
+        encoding (tiktoken.Encoding): エンコーディング
+        config_pic (dict): 画像の設定
+    Returns:
+        int: トークン数
+    """
+    config_pic_ = config_pic or config_pic_params
+    #
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        if (key == "content") and (isinstance(value, list)):
+            for data in value:
+                if data["type"] == "image_url":
+                    num_tokens += num_toke_from_pic_url(
+                        data["image_url"]["url"], **config_pic_
+                    )
+                else:
+                    k = data["type"]
+                    num_tokens += len(encoding.encode(data[k]))
+        else:
+            num_tokens += len(encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+    return num_tokens
 
 
 def num_tokens_from_messages(
@@ -68,36 +322,83 @@ def num_tokens_from_messages(
     Returns:
         int: トークン数
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    #
-    config_pic_ = config_pic or config_pic_params
+    encoding = get_encoding(model)
     #
     num_tokens = 0
     for message in messages:
-        num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-        for key, value in message.items():
-            if (key == "content") and (isinstance(value, list)):
-                for data in value:
-                    if data["type"] == "image_url":
-                        num_tokens += num_toke_from_pic_url(
-                            data["image_url"]["url"], **config_pic_
-                        )
-                    else:
-                        k = data["type"]
-                        num_tokens += len(encoding.encode(data[k]))
-            else:
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += (
-                        -1
-                    )  # role is always required and always 1 token
-    num_tokens += 2  # every reply is primed with <im_start>assistant
+        num_tokens += num_tokens_from_message(message, encoding, config_pic)
+    num_tokens += TOKENS_REPLY_PRIMING
     return num_tokens
 
 
+def find_trim_index(
+    num_tokens: list[int],
+    token_budget: int,
+    is_boundary: list[bool] | None = None,
+    num_head: int = 1,
+) -> int:
+    """先頭と最新のメッセージを残してトークン予算に収まる開始位置を求める
+    末尾から累積トークン数を1回だけ走査し、予算内に収まる最も古い区切り位置を返す
+    Args:
+        num_tokens (list[int]): メッセージごとのトークン数
+        token_budget (int): メッセージ全体に使えるトークン数
+        is_boundary (list[bool]): 切り取り可能な位置 (ターンの先頭) かどうか
+        num_head (int): 必ず残す先頭のメッセージ数 (システムロール)
+    Returns:
+        int: 残すメッセージの開始位置 (num_tokens[:num_head] + num_tokens[index:])
+    """
+    n = len(num_tokens)
+    if is_boundary is None:
+        is_boundary = [True] * n
+    budget = token_budget - sum(num_tokens[:num_head])
+    # 最新のメッセージは予算を超えていても必ず残す
+    index = max(n - 1, num_head)
+    suffix = 0
+    for i in range(n - 1, num_head - 1, -1):
+        suffix += num_tokens[i]
+        if suffix > budget:
+            break
+        if is_boundary[i]:
+            index = i
+    return index
+
+
+def trim_messages(
+    messages: list[dict[str, Any]],
+    model: str = "gpt-3.5-turbo-0301",
+    token_limit: int = 4097,
+    safety_factor: float = 0.9,
+    max_response_token: int = 500,
+) -> tuple[list[dict[str, Any]], int]:
+    """システムロールと最新のメッセージを残して古いターンから削減する
+    Args:
+        messages (list[dict]): メッセージリスト
+        model (str): モデル名
+        token_limit (int): トークン最大数
+        safety_factor (float): 安全率
+        max_response_token (int): レスポンス最大トークン数
+    Returns:
+        list[dict]: 削減後のメッセージリスト
+        int: 削除したターン数
+    """
+    encoding = get_encoding(model)
+    num_tokens = [num_tokens_from_message(message, encoding) for message in messages]
+    num_head = 1 if messages and messages[0].get("role") == "system" else 0
+    is_boundary = [
+        (i == num_head) or (message.get("role") == "user")
+        for i, message in enumerate(messages)
+    ]
+    token_budget = (
+        int(token_limit * safety_factor)
+        - max_response_token
+        - TOKENS_REPLY_PRIMING
+        - 1
+    )
+    index = find_trim_index(num_tokens, token_budget, is_boundary, num_head)
+    num_dropped = sum(is_boundary[num_head:index])
+    return messages[:num_head] + messages[index:], num_dropped
+
+
 def reduce_messages(
     messages: list[dict[str, str]],
     model: str = "gpt-3.5-turbo-0301",
@@ -115,14 +416,10 @@ def reduce_messages(
     Returns:
         list[dict]: メッセージリスト
     """
-    itoken = num_tokens_from_messages(messages)
-    token_limit = int(token_limit * safety_factor)
-    while (itoken + max_response_token) >= token_limit:
-        del messages[1]
-        if len(messages) < 3:
-            break
-        itoken = num_tokens_from_messages(messages, model)
-    return messages
+    messages_, _ = trim_messages(
+        messages, model, token_limit, safety_factor, max_response_token
+    )
+    return messages_
 
 
 pattern = r"data:image/[a-zA-Z0-9]+;base64,(?P<base64_data>[a-zA-Z0-9+/=]+)"
@@ -148,12 +445,7 @@ def num_toke_from_pic_url(
     Returns:
         int: トークン数
     """
-    #    image_base64 = re_base64.match(image_url)
-    image_base64 = image_url.split(",")[-1]
-    image_data = base64.b64decode(image_base64)
-    image = Image.open(BytesIO(image_data))
-
-    width, height = image.size
+    width, height = get_pic_size_from_url(image_url)
 
     num = num_token_from_pic(
         width,
@@ -167,6 +459,74 @@ def num_toke_from_pic_url(
     return num
 
 
+# JPEGのSOFマーカー (幅と高さを含むフレームヘッダー)
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF,
+}  # fmt: skip
+
+
+def get_pic_size_from_header(data: bytes) -> tuple[int, int] | None:
+    """画像のヘッダー部分のバイト列から幅と高さを取得する (PNG, GIF, JPEG)
+    Args:
+        data (bytes): 画像ファイルの先頭のバイト列
+    Returns:
+        tuple[int, int] | None: 幅, 高さ (ヘッダーが不足しているか未対応の形式の場合はNone)
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) >= 24 and data[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", data[16:24])
+            return width, height
+        return None
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        if len(data) >= 10:
+            width, height = struct.unpack("<HH", data[6:10])
+            return width, height
+        return None
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 <= len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            if marker == 0xFF:  # フィルバイト
+                i += 1
+                continue
+            if (marker == 0x01) or (0xD0 <= marker <= 0xD8):  # 長さを持たないマーカー
+                i += 2
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+                return width, height
+            (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+            i += 2 + length
+    return None
+
+
+def get_pic_size_from_url(image_url: str, chunk_size: int = 64) -> tuple[int, int]:
+    """画像URL (data URL) から幅と高さを取得する
+    画像全体をデコードせず、ヘッダーが読めるまで先頭から少しずつBase64デコードする
+    Args:
+        image_url (str): 画像URL
+        chunk_size (int): 最初にデコードするBase64の文字数 (4の倍数)
+    Returns:
+        tuple[int, int]: 幅, 高さ
+    """
+    image_base64 = image_url.split(",")[-1]
+    n = chunk_size
+    while True:
+        image_header = base64.b64decode(image_base64[:n])
+        size = get_pic_size_from_header(image_header)
+        if size is not None:
+            return size
+        if n >= len(image_base64):
+            break
+        n *= 8
+    # ヘッダーから読めない形式はPILで開く (画素データはデコードされない)
+    image = Image.open(BytesIO(image_header))
+    return image.size
+
+
 def num_token_from_pic(
     width: int,
     height: int,
@@ -256,9 +616,9 @@ def get_normalized_pic_size(
     r = 1.0
     if ratio > 1.0:
         if width > one_side_limit:
-            r = width / float(one_side_limit)
+            r = one_side_limit / float(width)
         if height * r > short_side_limit:
-            r *= one_side_limit / (r * height)
+            r *= short_side_limit / (r * height)
     else:
         if height > one_side_limit:
             r = one_side_limit / float(height)
@@ -271,17 +631,56 @@ def get_normalized_pic_size(
 
 
 def resize_pic(image: Image.Image, size):
-
-    image_ = ImageOps.fit(
-        image, size, method=Image.Resampling.LANCZOS, centering=(0.5, 0.5)
+    """中央を基準に縦横比を合わせて切り抜き、指定サイズに縮小する (ImageOps.fitと同じ結果)
+    縮小率が大きい場合は整数倍の縮小 (reduce) をしてからLANCZOSで仕上げる
+    Args:
+        image (Image.Image): 画像
+        size (tuple[int, int]): 幅, 高さ
+    Returns:
+        Image.Image: 縮小した画像
+    """
+    width, height = image.size
+    ratio, ratio_ = width / height, size[0] / size[1]
+    box = (0.0, 0.0, float(width), float(height))
+    if ratio > ratio_:
+        crop_width = ratio_ * height
+        left = (width - crop_width) * 0.5
+        box = (left, 0.0, left + crop_width, float(height))
+    elif ratio < ratio_:
+        crop_height = width / ratio_
+        top = (height - crop_height) * 0.5
+        box = (0.0, top, float(width), top + crop_height)
+    image_ = image.resize(
+        size,
+        Image.Resampling.LANCZOS,
+        box=box,
+        reducing_gap=RESIZE_REDUCING_GAP,
     )
     return image_
 
 
-def to_normalized_pic(image: Image.Image):
+def to_normalized_pic(image: Image.Image, draft: bool = False):
+    """ChatGPT画像インプットの適正サイズに縮小する
+    EXIFの向きは縮小後の画像に1回だけ適用する
+    Args:
+        image (Image.Image): 画像
+        draft (bool): 読込前のJPEGを縮小してデコードするかどうか
+            (渡した画像自体のサイズが変わるため、この関数内で開いた画像の場合のみTrueにする)
+    Returns:
+        Image.Image: 縮小した画像 (向きを補正済み)
+    """
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
     width, height = image.size
     size = get_normalized_pic_size(width, height)
+    if draft:
+        # JPEGは要求サイズ以上で最も小さい1/2, 1/4, 1/8の解像度でデコードする
+        # (読込済みの画像やJPEG以外では何もしない)
+        image.draft(None, size)
     image_ = resize_pic(image, size)
+    if orientation in EXIF_TRANSPOSE:
+        image_ = image_.transpose(EXIF_TRANSPOSE[orientation])
+    # 向きを補正済みのため、再度補正されないようEXIFは引き継がない
+    image_.info.pop("exif", None)
     return image_
 
 
@@ -317,17 +716,248 @@ def convert_byte_to_image(
     """
     image = Image.open(BytesIO(image_byte))
     if normalization:
-        image = to_normalized_pic(image)
+        image = to_normalized_pic(image, draft=True)
     return image
 
 
+def convert_image_to_bytes(image: Image.Image, format: str = "png") -> bytes:
+    """画像データを圧縮したバイナリデータに変換する
+    Args:
+        image (Image.Image): 画像
+        format (str): 画像フォーマット
+    Returns:
+        bytes: バイナリデータ
+    """
+    image_buffer = BytesIO()
+    image.save(image_buffer, format=format)
+    return image_buffer.getvalue()
+
+
 def convert_image_to_url(image: Image.Image) -> str:
     """画像データをBase64エンコードしてURLに変換する
     Returns:
         str: 画像URL
     """
-    image_buffer = BytesIO()
-    image.save(image_buffer, format="png")
-    image_byte = image_buffer.getvalue()
+    image_byte = convert_image_to_bytes(image)
     image_base64 = base64.b64encode(image_byte).decode("utf-8")
     return image_base64
+
+
+# ------------------------------------------------------------------------------
+# エンコード済みデータのキャッシュ
+# ------------------------------------------------------------------------------
+class BytesLRUCache:
+    """合計バイト数に上限を持つLRUキャッシュ (プロセス内の全セッションで共有)
+    Args:
+        max_bytes (int): 保持する値の合計バイト数の上限
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: OrderedDict[str, str | bytes] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def nbytes(self) -> int:
+        """保持している値の合計バイト数"""
+        return self._nbytes
+
+    def get(self, key: str) -> str | bytes | None:
+        """値を取得する (見つからない場合はNone)
+        Args:
+            key (str): キー
+        Returns:
+            str | bytes | None: 値
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str | bytes) -> None:
+        """値を保存し、上限を超えた分は古いものから削除する
+        Args:
+            key (str): キー
+            value (str | bytes): 値
+        """
+        nbytes = len(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._nbytes -= len(self._data.pop(key))
+            self._data[key] = value
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._nbytes -= len(evicted)
+
+    def discard(self, *keys: str) -> None:
+        """値を削除する (存在しないキーは無視)
+        Args:
+            *keys (str): キー
+        """
+        with self._lock:
+            for key in keys:
+                value = self._data.pop(key, None)
+                if value is not None:
+                    self._nbytes -= len(value)
+
+    def clear(self) -> None:
+        """全ての値を削除する"""
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+
+
+# ChatMessage.to_image_url用のキャッシュ
+image_url_cache = BytesLRUCache(IMAGE_URL_CACHE_MAX_BYTES)
+
+
+# ------------------------------------------------------------------------------
+# 画像処理のワーカープロセス
+# ------------------------------------------------------------------------------
+@dataclass(frozen=True)
+class PreparedPic:
+    """送信・表示用に変換済みの画像
+    Args:
+        image (bytes): 正規化した画像 (PNG)
+        size (tuple[int, int]): 正規化後の画像サイズ (幅, 高さ)
+        thumbnail (bytes | None): サムネイル画像 (PNG)
+    """
+
+    image: bytes
+    size: tuple[int, int]
+    thumbnail: bytes | None = None
+
+    def __len__(self) -> int:
+        # BytesLRUCacheで容量を数えるための合計バイト数
+        return len(self.image) + len(self.thumbnail or b"")
+
+
+def prepare_pic(
+    image: bytes | Image.Image,
+    thumbnail_height: int | None = 180,
+    thumbnail_bg_color: tuple[int, int, int] | None = None,
+) -> PreparedPic:
+    """画像を正規化してPNGに変換し、サムネイルを作成する (ワーカープロセスで実行する)
+    Args:
+        image (bytes | Image.Image): 画像ファイルのバイト列または画像
+        thumbnail_height (int | None): サムネイルの高さ (Noneの場合は作成しない)
+        thumbnail_bg_color (tuple[int, int, int]): サムネイルの背景色
+    Returns:
+        PreparedPic: 変換済みの画像
+    """
+    # 呼び出し元の画像は変更しないため、縮小デコードはバイト列から開いた場合のみ
+    draft = isinstance(image, bytes)
+    if draft:
+        image = Image.open(BytesIO(image))
+    image_ = to_normalized_pic(image, draft=draft)
+    thumbnail = None
+    if thumbnail_height:
+        thumbnail = convert_image_to_bytes(
+            to_thumbnail_pic(image_, thumbnail_height, thumbnail_bg_color)
+        )
+    return PreparedPic(convert_image_to_bytes(image_), image_.size, thumbnail)
+
+
+class ProcessWorkerPool:
+    """CPU負荷の高い処理を別プロセスで実行するプール (プロセス内の全セッションで共有)
+    Streamlitのスクリプトスレッドで画像を処理すると、GILにより他のセッションの描画も遅れるため
+    Args:
+        max_workers (int): ワーカープロセス数 (0の場合は呼び出し元のスレッドで実行)
+        max_pending (int): 実行中と待ちを合わせたタスク数の上限
+        timeout (float): 空き待ちと処理結果の待ち時間の上限 (秒)
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, timeout: float):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        """処理を登録する (fnと引数はpickle可能であること)
+        待ちが上限に達している場合は空くまで待ち、timeout秒を過ぎたらTimeoutError
+        ワーカーの異常終了で使えなくなったプールは作り直してから登録する
+        Args:
+            fn (Callable): モジュールのトップレベルに定義した関数
+            *args, **kwargs: fnの引数
+        Returns:
+            Future: 処理結果
+        """
+        if self.max_workers <= 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:  # pylint: disable=W0718
+                future.set_exception(e)
+            return future
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("The image worker pool is busy.")
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                # ワーカーが異常終了したプールは作り直して1回だけ再試行する
+                self._reset(executor)
+                future = self._get_executor().submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        timeout: float | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        """処理を実行して結果を待つ
+        Args:
+            fn (Callable): モジュールのトップレベルに定義した関数
+            *args, **kwargs: fnの引数
+            timeout (float | None): 結果の待ち時間の上限 (省略時はプールの設定)
+        Returns:
+            Any: fnの戻り値
+        """
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except TimeoutError:
+            # 開始前なら取り消す (開始済みの処理は終わるまで枠を使い続ける)
+            future.cancel()
+            raise
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # スレッドを多く使うStreamlitのプロセスからforkしないようspawnで起動する
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _reset(self, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            # 他のスレッドが既に作り直したプールは止めない
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 画像の前処理とエンコード用のプール
+image_pool = ProcessWorkerPool(
+    IMAGE_POOL_MAX_WORKERS, IMAGE_POOL_MAX_PENDING, IMAGE_POOL_TIMEOUT
+)
@@ -3,11 +3,16 @@ import sys
 import time
 import uuid
 from abc import ABCMeta, abstractmethod
+from dataclasses import asdict, dataclass, field
 from enum import Enum
+from typing import Any
 
 from langchain.callbacks.base import BaseCallbackHandler, BaseCallbackManager
+from langchain_core.outputs import LLMResult
 from PIL import Image
 
+from .metrics import LLM_CALLS, LLM_DURATION, LLM_INFLIGHT, LLM_TOKENS, LLM_TTFT
+
 
 class Color(Enum):
     DEFAULT = 1
@@ -88,22 +93,105 @@ class StdOutTalkSender(TalkSender):
         sys.stdout.flush()
 
 
+@dataclass
+class LLMMetrics:
+    """LLM呼び出し1回分の計測結果 (時間は秒)"""
+
+    model: str = ""
+    queue_time: float | None = None  # リクエスト受付からLLM呼び出し開始まで
+    ttft: float | None = None  # 呼び出し開始から最初のトークンまで
+    total_time: float | None = None  # 呼び出し開始から終了まで
+    itl_p50: float | None = None  # トークン間隔の50パーセンタイル
+    itl_p90: float | None = None  # トークン間隔の90パーセンタイル
+    itl_p99: float | None = None  # トークン間隔の99パーセンタイル
+    tokens_per_sec: float | None = None  # 最初のトークン以降の出力速度
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    total_tokens: int | None = None
+    num_chunks: int = 0  # 受信した差分の数
+    error: str | None = None  # エラーまたはキャンセルで終了した場合の例外名
+
+    def to_dict(self) -> dict[str, Any]:
+        """ログ出力用の辞書に変換する (小数はミリ秒単位まで丸める)"""
+        return {
+            k: round(v, 4) if isinstance(v, float) else v
+            for k, v in asdict(self).items()
+        }
+
+
+@dataclass
+class _LLMRun:
+    """計測中のLLM呼び出し"""
+
+    model: str
+    queue_time: float | None
+    start: float = field(default_factory=time.perf_counter)
+    token_times: list[float] = field(default_factory=list)
+
+    def finish(
+        self, usage: dict[str, int] | None = None, error: str | None = None
+    ) -> LLMMetrics:
+        end = time.perf_counter()
+        times = self.token_times
+        intervals = sorted(b - a for a, b in zip(times, times[1:]))
+        usage = usage or {}
+        completion_tokens = usage.get("completion_tokens")
+        metrics = LLMMetrics(
+            model=self.model,
+            queue_time=self.queue_time,
+            total_time=end - self.start,
+            num_chunks=len(times),
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=completion_tokens,
+            total_tokens=usage.get("total_tokens"),
+            error=error,
+        )
+        if times:
+            metrics.ttft = times[0] - self.start
+            # 使用量が返らない場合は差分の数をトークン数の近似とする
+            num_tokens = completion_tokens or len(times)
+            if end > times[0]:
+                metrics.tokens_per_sec = num_tokens / (end - times[0])
+        if intervals:
+            metrics.itl_p50 = _percentile(intervals, 50)
+            metrics.itl_p90 = _percentile(intervals, 90)
+            metrics.itl_p99 = _percentile(intervals, 99)
+        return metrics
+
+
 class AgentTalkCallbackHandler(BaseCallbackHandler):
-    """Agentのトークとデバッグ時に手動ログ記録もできるカスタムコールバック"""
+    """Agentのトークとデバッグ時に手動ログ記録もできるカスタムコールバック
+    LLM呼び出しごとの待ち時間・最初のトークンまでの時間・出力速度も計測する
+    """
 
     chain_start_time: float | None = None  # チェーン開始時刻
     llm_start_time: float | None = None  # LLM開始時刻
+    request_time: float | None = None  # リクエストの受付時刻 (待ち時間の起点)
     trace_id: str = ""  # トレースID
     sender: TalkSender  # トーク送信クラス
     debug: bool = False  # デバッグモード on/off
     color = Color
+    run_inline = True  # トークンの到着時刻を記録するため非同期実行時もその場で呼び出す
 
-    def __init__(self, debug=False, sender: TalkSender = StdOutTalkSender()):
+    def __init__(
+        self,
+        debug=False,
+        sender: TalkSender = StdOutTalkSender(),
+        request_time: float | None = None,
+    ):
         self.debug = debug
         self.chain_start_time = None
         self.llm_start_time = None
+        self.request_time = time.time() if request_time is None else request_time
         self.trace_id = str(uuid.uuid4())  # 実行ごとの一意な ID
         self.sender = sender
+        self.llm_metrics: list[LLMMetrics] = []  # 終了したLLM呼び出しの計測結果
+        self._llm_runs: dict[uuid.UUID, _LLMRun] = {}
+
+    @property
+    def last_llm_metrics(self) -> LLMMetrics | None:
+        """最後に終了したLLM呼び出しの計測結果"""
+        return self.llm_metrics[-1] if self.llm_metrics else None
 
     def _timestamp(self):
         return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -164,6 +252,60 @@ class AgentTalkCallbackHandler(BaseCallbackHandler):
             self.sender.send(f"{outputs["messages"][-1]}\n", self.color.GREEN)
             self.sender.send("-" * 72 + "\n")
 
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start_llm_run(run_id, kwargs)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        # 未定義の場合はメッセージ (画像を含む) を文字列化してon_llm_startが呼ばれるため定義する
+        self._start_llm_run(run_id, kwargs)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._llm_runs.get(run_id)
+        if (run is not None) and token:
+            run.token_times.append(time.perf_counter())
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        run = self._llm_runs.pop(run_id, None)
+        if run is not None:
+            self._finish_llm_run(run, usage=_token_usage(response))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._llm_runs.pop(run_id, None)
+        if run is not None:
+            self._finish_llm_run(run, error=type(error).__name__)
+
+    def _start_llm_run(self, run_id: uuid.UUID, kwargs: dict[str, Any]) -> None:
+        self.llm_start_time = time.time()
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model") or params.get("model_name") or ""
+        self._llm_runs[run_id] = _LLMRun(
+            model=model, queue_time=self.llm_start_time - self.request_time
+        )
+        LLM_INFLIGHT.inc(model=model)
+
+    def _finish_llm_run(
+        self,
+        run: _LLMRun,
+        usage: dict[str, int] | None = None,
+        error: str | None = None,
+    ) -> None:
+        metrics = run.finish(usage, error)
+        self.llm_metrics.append(metrics)
+        # プロセス全体のメトリクスへ反映
+        model = metrics.model
+        LLM_INFLIGHT.dec(model=model)
+        LLM_CALLS.inc(model=model, status="error" if error else "ok")
+        LLM_DURATION.observe(metrics.total_time, model=model)
+        if metrics.ttft is not None:
+            LLM_TTFT.observe(metrics.ttft, model=model)
+        if metrics.prompt_tokens:
+            LLM_TOKENS.inc(metrics.prompt_tokens, model=model, kind="prompt")
+        if metrics.completion_tokens:
+            LLM_TOKENS.inc(metrics.completion_tokens, model=model, kind="completion")
+        if self.debug:
+            self.sender.send(f"[{self._timestamp()}] LLM End\n", self.color.BLUE)
+            self.sender.send(f"Metrics: {metrics.to_dict()}\n")
+
     @staticmethod
     def speaks(
         callbacks: (
@@ -195,6 +337,32 @@ class AgentTalkCallbackHandler(BaseCallbackHandler):
             )
 
 
+def _percentile(sorted_values: list[float], q: float) -> float:
+    """ソート済みの値から線形補間でパーセンタイルを計算する"""
+    pos = (len(sorted_values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    weight = pos - lower
+    return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+
+
+def _token_usage(response: LLMResult) -> dict[str, int] | None:
+    """LLMの結果からトークン使用量を取得する
+    ストリーミングではメッセージのusage_metadata、それ以外はllm_outputに入る
+    """
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            usage = getattr(message, "usage_metadata", None)
+            if usage:
+                return {
+                    "prompt_tokens": usage.get("input_tokens"),
+                    "completion_tokens": usage.get("output_tokens"),
+                    "total_tokens": usage.get("total_tokens"),
+                }
+    return (response.llm_output or {}).get("token_usage") or None
+
+
 def _extract_AgentTalkCallbackHandler(
     callbacks: list[BaseCallbackHandler] | None,
 ) -> list[AgentTalkCallbackHandler]:
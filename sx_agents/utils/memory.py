@@ -1,10 +1,25 @@
 """メモリ操作とプロンプト作成用モジュール"""
 
 import base64
+import sys
+import uuid
+import weakref
 from typing import Any
 from io import BytesIO
 from PIL import Image
-from sx_agents.utils.common import to_thumbnail_pic, to_normalized_pic
+import tiktoken
+from sx_agents.utils.common import (
+    TOKENS_PER_MESSAGE,
+    TOKENS_REPLY_PRIMING,
+    PreparedPic,
+    config_pic_params,
+    find_trim_index,
+    image_pool,
+    image_url_cache,
+    num_token_from_pic,
+    prepare_pic,
+)
+from sx_agents.utils.storage import DiskStore
 
 SYSTEM_ROLE: str = (
     "I'm a consultant and prefer logical answers. "
@@ -12,10 +27,22 @@ SYSTEM_ROLE: str = (
     "Explanation of basic knowledge may be omitted from the answer. "
     "If there are no instructions, please answer in Japanese."
 )
+# ChatGPTクライアントへ送信するロール
+CHAT_ROLES: list[str] = ["user", "assistant", "system"]
+# 生成を中断した回答のラベル
+CANCELLED_LABEL: str = "cancelled"
+# 類似した質問の回答を再利用した回答のラベル (metadataに類似度を保存する)
+SIMILAR_CACHE_LABEL: str = "similar_cache"
+# ディスクへ退避するメッセージ本文の最小サイズ (UTF-8のバイト数、これより短い本文はメモリに残す)
+SPILL_MIN_CONTENT_BYTES: int = 4096
+# ディスクへ退避済みであることを示す値
+_SPILLED: Any = object()
 
 
 class ChatMessage:
     """メッセージを保持するクラス
+    画像とサムネイルはPNG圧縮したバイト列で保持し、PIL画像が必要な時だけデコードする
+    spillでディスクへ退避したデータは参照時にディスクから読み込む
     Args:
         role (str): System, User, Assistantもしくはerror, warning, info, successのステータスを含む
         content (str): メッセージの内容
@@ -23,13 +50,34 @@ class ChatMessage:
         label (str): 画面表示するときのタグのラベル
     """
 
-    role: str = ""
-    content: str = ""
-    images: list[Image.Image] = []
-    metadata: list[Any] = []
-    label: str = ""
-    thumbnails: list[Image.Image] = []
-    unsafe_allow_html: bool = False
+    __slots__ = (
+        "_role",
+        "_content",
+        "_num_tokens",
+        "_image_data",
+        "_thumbnail_data",
+        "_image_keys",
+        "_metadata",
+        "_spill_store",
+        "_spill_key",
+        "image_sizes",
+        "label",
+        "unsafe_allow_html",
+        "__weakref__",
+    )
+
+    _role: str
+    _content: str
+    _num_tokens: dict[tuple[str, bool], int]  # (エンコーディング名, vision)ごとのトークン数
+    _image_data: list[bytes]  # 正規化した画像 (PNG)
+    _thumbnail_data: list[bytes]  # サムネイル画像 (PNG)
+    _image_keys: list[str]  # エンコード済み画像URLのキャッシュキー
+    _metadata: list[Any]
+    _spill_store: DiskStore | None  # 退避先 (退避したデータは_SPILLEDになる)
+    _spill_key: str | None
+    image_sizes: list[tuple[int, int]]  # 正規化後の画像サイズ (幅, 高さ)
+    label: str
+    unsafe_allow_html: bool
 
     def __init__(
         self,
@@ -39,7 +87,8 @@ class ChatMessage:
             Image.Image
             | BytesIO
             | bytes
-            | list[Image.Image | BytesIO | bytes]
+            | PreparedPic
+            | list[Image.Image | BytesIO | bytes | PreparedPic]
             | None
         ) = None,
         label: str | None = None,
@@ -49,14 +98,21 @@ class ChatMessage:
         thumbnail_hight: int = 180,
         thumbnail_bg_color: tuple[int, int, int] | None = None,
     ):
+        self._num_tokens = {}
+        self._spill_store = None
+        self._spill_key = None
         self.role = role
         self.content = content
         self.label = label or ""
         self.unsafe_allow_html = unsafe_allow_html
         #
-        self.images = []
-        self.thumbnails = []
+        self._image_data = []
+        self._thumbnail_data = []
+        self._image_keys = []
+        self.image_sizes = []
         self.metadata = metadata or []
+        # メッセージが破棄されたらエンコード済み画像URLもキャッシュから削除
+        weakref.finalize(self, _discard_image_urls, self._image_keys)
         #
         if images:
             if not isinstance(images, list):
@@ -66,41 +122,215 @@ class ChatMessage:
                     image, with_thumbnail, thumbnail_hight, thumbnail_bg_color
                 )
 
+    @property
+    def role(self) -> str:
+        return self._role
+
+    @role.setter
+    def role(self, role: str):
+        self._role = role
+        self._num_tokens.clear()
+
+    @property
+    def content(self) -> str:
+        if self._content is _SPILLED:
+            return self._load("content")
+        return self._content
+
+    @content.setter
+    def content(self, content: str):
+        self._content = content
+        self._num_tokens.clear()
+
+    @property
+    def metadata(self) -> list[Any]:
+        if self._metadata is _SPILLED:
+            return self._load("metadata")
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata: list[Any]):
+        self._metadata = metadata
+
+    @property
+    def images(self) -> list[Image.Image]:
+        """正規化した画像 (参照時にPIL画像として開く)"""
+        return [Image.open(BytesIO(data)) for data in self.image_bytes]
+
+    @property
+    def thumbnails(self) -> list[Image.Image]:
+        """サムネイル画像 (参照時にPIL画像として開く)"""
+        return [Image.open(BytesIO(data)) for data in self.thumbnail_bytes]
+
+    @property
+    def image_bytes(self) -> list[bytes]:
+        """正規化した画像のPNGバイト列 (st.imageなどへデコードせずに渡せる)"""
+        if self._image_data is _SPILLED:
+            return self._load("images")
+        return list(self._image_data)
+
+    @property
+    def thumbnail_bytes(self) -> list[bytes]:
+        """サムネイル画像のPNGバイト列 (st.imageなどへデコードせずに渡せる)"""
+        if self._thumbnail_data is _SPILLED:
+            return self._load("thumbnails")
+        return list(self._thumbnail_data)
+
+    @property
+    def nbytes(self) -> int:
+        """メモリ上に保持している本文、画像、メタデータのおおよそのバイト数"""
+        nbytes = 0
+        if self._content is not _SPILLED:
+            nbytes += sys.getsizeof(self._content)
+        if self._image_data is not _SPILLED:
+            nbytes += sum(len(data) for data in self._image_data)
+        if self._thumbnail_data is not _SPILLED:
+            nbytes += sum(len(data) for data in self._thumbnail_data)
+        if self._metadata is not _SPILLED:
+            nbytes += sum(_sizeof(mdata) for mdata in self._metadata)
+        return nbytes
+
+    def spill(self, store: DiskStore) -> int:
+        """本文、画像、メタデータをディスクへ退避してメモリから解放する
+        退避したデータは参照時にディスクから読み込まれる
+        Args:
+            store (DiskStore): 退避先
+        Returns:
+            int: 解放したおおよそのバイト数
+        """
+        if self._spill_key is None:
+            self._spill_key = uuid.uuid4().hex
+            self._spill_store = store
+            # メッセージが破棄されたら退避したデータも削除
+            weakref.finalize(
+                self,
+                store.delete,
+                *[f"{self._spill_key}:{name}" for name in _SPILL_FIELDS],
+            )
+        nbytes = self.nbytes
+        if (
+            isinstance(self._content, str)
+            and len(self._content.encode("utf-8")) >= SPILL_MIN_CONTENT_BYTES
+        ):
+            store.put(f"{self._spill_key}:content", self._content)
+            self._content = _SPILLED
+        if (self._image_data is not _SPILLED) and self._image_data:
+            store.put(f"{self._spill_key}:images", self._image_data)
+            self._image_data = _SPILLED
+        if (self._thumbnail_data is not _SPILLED) and self._thumbnail_data:
+            store.put(f"{self._spill_key}:thumbnails", self._thumbnail_data)
+            self._thumbnail_data = _SPILLED
+        if (self._metadata is not _SPILLED) and self._metadata:
+            store.put(f"{self._spill_key}:metadata", self._metadata)
+            self._metadata = _SPILLED
+        return nbytes - self.nbytes
+
+    def unspill(self) -> None:
+        """ディスクへ退避したデータをメモリへ戻す"""
+        if self._content is _SPILLED:
+            self._content = self._load("content")
+        if self._image_data is _SPILLED:
+            self._image_data = self._load("images")
+        if self._thumbnail_data is _SPILLED:
+            self._thumbnail_data = self._load("thumbnails")
+        if self._metadata is _SPILLED:
+            self._metadata = self._load("metadata")
+
+    def _load(self, name: str) -> Any:
+        """ディスクへ退避したデータを読み込む"""
+        return self._spill_store.get(f"{self._spill_key}:{name}")
+
     def append_image(
         self,
-        image: Image.Image | BytesIO | bytes,
+        image: Image.Image | BytesIO | bytes | PreparedPic,
         with_thumbnail: bool = True,
         thumbnail_hight: int = 180,
         thumbnail_bg_color: tuple[int, int, int] | None = None,
     ):
         """画像データを追加する
+        画像ファイルのバイト列はワーカープロセスでデコード・縮小・エンコードする
+        変換済みの画像 (PreparedPic) は作成時のサムネイルをそのまま使う
         Args:
-            image (Image.Image): 画像データ
+            image (Image.Image | BytesIO | bytes | PreparedPic): 画像データ
         """
         if isinstance(image, BytesIO):
-            image = Image.open(image)
-        elif isinstance(image, bytes):
-            image = Image.open(BytesIO(image))
-        if not isinstance(image, Image.Image):
-            raise NotImplementedError
-        self.images.append(to_normalized_pic(image))
-        if with_thumbnail:
-            self.thumbnails.append(
-                to_thumbnail_pic(image, thumbnail_hight, thumbnail_bg_color)
+            image = image.getvalue()
+        if isinstance(image, bytes):
+            image = image_pool.run(
+                prepare_pic,
+                image,
+                thumbnail_hight if with_thumbnail else None,
+                thumbnail_bg_color,
+            )
+        elif isinstance(image, Image.Image):
+            # デコード済みの画像は転送の負荷が大きいため呼び出し元で変換する
+            image = prepare_pic(
+                image,
+                thumbnail_hight if with_thumbnail else None,
+                thumbnail_bg_color,
             )
+        if not isinstance(image, PreparedPic):
+            raise NotImplementedError
+        self.unspill()
+        self._image_data.append(image.image)
+        self.image_sizes.append(image.size)
+        self._image_keys.append(uuid.uuid4().hex)
+        self._num_tokens.clear()
+        if with_thumbnail and (image.thumbnail is not None):
+            self._thumbnail_data.append(image.thumbnail)
+
+    def num_tokens(self, encoding: tiktoken.Encoding, vision: bool = True) -> int:
+        """メッセージのトークン数を取得する (返信のプライミング分は含まない)
+        一度計算したトークン数はメッセージが変更されるまでキャッシュされる
+        Args:
+            encoding (tiktoken.Encoding): エンコーディング
+            vision (bool): 画像をトークン数に含めるかどうか
+        Returns:
+            int: トークン数
+        """
+        key = (encoding.name, vision and bool(self.image_sizes))
+        if key not in self._num_tokens:
+            num_tokens = TOKENS_PER_MESSAGE
+            num_tokens += len(encoding.encode(self.role))
+            num_tokens += len(encoding.encode(self.content))
+            if key[1]:
+                for width, height in self.image_sizes:
+                    num_tokens += num_token_from_pic(
+                        width, height, **config_pic_params
+                    )
+            self._num_tokens[key] = num_tokens
+        return self._num_tokens[key]
+
+    def remove_image(self, index: int = -1) -> None:
+        """画像データを削除する
+        Args:
+            index (int): 削除する画像の位置
+        """
+        self.unspill()
+        if len(self._thumbnail_data) == len(self._image_data):
+            del self._thumbnail_data[index]
+        del self._image_data[index]
+        del self.image_sizes[index]
+        image_url_cache.discard(self._image_keys.pop(index))
+        self._num_tokens.clear()
 
     def to_image_url(self) -> list[str]:
         """画像データをBase64エンコードしてURLに変換する
+        エンコード結果は画像ごとにキャッシュされ、2回目以降は再エンコードしない
         Returns:
             list[str]: 画像URLのリスト
         """
         contents = []
-        for image in self.images:
-            image_buffer = BytesIO()
-            image.save(image_buffer, format="png")
-            image_byte = image_buffer.getvalue()
-            image_base64 = base64.b64encode(image_byte).decode("utf-8")
-            contents.append(f"data:image/png;base64,{image_base64}")
+        image_data = self._image_data
+        for i, key in enumerate(self._image_keys):
+            image_url = image_url_cache.get(key)
+            if image_url is None:
+                if image_data is _SPILLED:
+                    image_data = self._load("images")
+                image_base64 = base64.b64encode(image_data[i]).decode("utf-8")
+                image_url = f"data:image/png;base64,{image_base64}"
+                image_url_cache.put(key, image_url)
+            contents.append(image_url)
         return contents
 
     def to_message(self, vision: bool = True) -> dict[str, Any]:
@@ -110,28 +340,52 @@ class ChatMessage:
             dict[str, list[str,str]]: 画像データがある場合
         """
         content = self.content
-        if vision and self.images:
+        if vision and self._image_keys:
             content = []
             content.append({"type": "text", "text": self.content})
-            if self.images:
-                for image_url in self.to_image_url():
-                    content.append(
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": image_url},
-                        }
-                    )
+            for image_url in self.to_image_url():
+                content.append(
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": image_url},
+                    }
+                )
         return {"role": self.role, "content": content}
 
 
+# ディスクへ退避するデータの名前
+_SPILL_FIELDS: tuple[str, ...] = ("content", "images", "thumbnails", "metadata")
+
+
+def _discard_image_urls(keys: list[str]) -> None:
+    """エンコード済み画像URLをキャッシュから削除する"""
+    image_url_cache.discard(*keys)
+
+
+def _sizeof(obj: Any) -> int:
+    """オブジェクトのおおよそのバイト数を取得する (DataFrameは中身を含む)"""
+    if hasattr(obj, "memory_usage"):
+        try:
+            return int(obj.memory_usage(deep=True).sum())
+        except TypeError:
+            pass
+    return sys.getsizeof(obj)
+
+
 class ChatMemory:
     """今までのチャットの履歴を保存するクラス
     Args:
         system_role (str): システムロールの保存/取得
         messages (list[ChatMessage]): チャットメッセージのリスト
+        max_bytes (int): メモリ上に保持するデータの上限 (超えた分は古いメッセージからディスクへ退避)
+        spill_dir (str): 退避先のディレクトリ (Noneの場合はOSの一時ディレクトリ)
     """
 
     messages: list[ChatMessage]
+    _num_tokens: dict[tuple[str, bool], int]  # (エンコーディング名, vision)ごとの合計
+    _store: DiskStore | None = None  # 退避先 (上限を超えた時に作成)
+    max_bytes: int | None = None
+    spill_dir: str | None = None
     THUMBNAIL_WIDTH: int = 180
     THUMBNAIL_BG_COLOR: tuple[int, int, int] = (220, 220, 220)
 
@@ -140,6 +394,8 @@ class ChatMemory:
         system_role: str | None = None,
         thumbnail_width: int | None = None,
         thumbnail_bg_color: tuple[int, int, int] | None = None,
+        max_bytes: int | None = None,
+        spill_dir: str | None = None,
     ):
         if (system_role is None) or (system_role is False):
             self.messages = []
@@ -150,10 +406,14 @@ class ChatMemory:
             ]
         self.THUMBNAIL_WIDTH = thumbnail_width or self.THUMBNAIL_WIDTH
         self.THUMBNAIL_BG_COLOR = thumbnail_bg_color or self.THUMBNAIL_BG_COLOR
+        self._num_tokens = {}
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
 
     def clear(self):
         """システムロール以外のメッセージを削除する"""
         self.messages = [self.messages[0]]
+        self._num_tokens.clear()
 
     @property
     def system_role(self) -> str:
@@ -162,7 +422,102 @@ class ChatMemory:
 
     @system_role.setter
     def system_role(self, system_role):
-        self.messages[0] = self.messages[0].content = system_role
+        self.messages[0].content = system_role
+        self._num_tokens.clear()
+
+    def num_tokens(
+        self,
+        encoding: tiktoken.Encoding,
+        vision: bool = True,
+        roles: list[str] | None = None,
+    ) -> int:
+        """メモリ内のメッセージのトークン数を取得する (返信のプライミング分を含む)
+        Args:
+            encoding (tiktoken.Encoding): エンコーディング
+            vision (bool): 画像をトークン数に含めるかどうか
+            roles (list[str]): 対象とするメッセージのロール
+        Returns:
+            int: トークン数
+        """
+        if (roles is not None) and (set(roles) != set(CHAT_ROLES)):
+            num_tokens = sum(
+                message.num_tokens(encoding, vision)
+                for message in self.messages
+                if message.role in roles
+            )
+            return num_tokens + TOKENS_REPLY_PRIMING
+        # 全ロール分は追加時に差分だけ加算した合計を使う
+        key = (encoding.name, vision)
+        if key not in self._num_tokens:
+            self._num_tokens[key] = sum(
+                message.num_tokens(encoding, vision)
+                for message in self.messages
+                if message.role in CHAT_ROLES
+            )
+        return self._num_tokens[key] + TOKENS_REPLY_PRIMING
+
+    def create_message(
+        self,
+        role: str,
+        content: str,
+        images=None,
+        label: str | None = None,
+        metadata: list[Any] | None = None,
+        unsafe_allow_html: bool = False,
+    ) -> ChatMessage:
+        """メモリの表示設定でメッセージを作成する (メモリには追加しない)
+        Args:
+            role (str): System, User, Assistantもしくはerror, warning, info, successのステータスを含む
+            content (str): メッセージの内容
+            images (list[Image.Image]): 画像データ
+            label (str): 画面表示するときのタグのラベル
+        Returns:
+            ChatMessage: メッセージ
+        """
+        return ChatMessage(
+            role,
+            content,
+            images=images,
+            label=label,
+            unsafe_allow_html=unsafe_allow_html,
+            metadata=metadata,
+            thumbnail_hight=self.THUMBNAIL_WIDTH,
+            thumbnail_bg_color=self.THUMBNAIL_BG_COLOR,
+        )
+
+    def append_message(self, message: ChatMessage) -> None:
+        """作成済みのメッセージを追加する
+        Args:
+            message (ChatMessage): メッセージ
+        """
+        self.messages.append(message)
+        if message.role in CHAT_ROLES:
+            for name, vision in self._num_tokens:
+                self._num_tokens[(name, vision)] += message.num_tokens(
+                    tiktoken.get_encoding(name), vision
+                )
+        self.spill()
+
+    @property
+    def nbytes(self) -> int:
+        """メモリ上に保持しているメッセージのおおよそのバイト数"""
+        return sum(message.nbytes for message in self.messages)
+
+    def spill(self) -> None:
+        """メモリ上のデータが上限を超えていれば古いメッセージからディスクへ退避する
+        システムロールと最新のメッセージは退避しない
+        """
+        if self.max_bytes is None:
+            return
+        nbytes = self.nbytes
+        if nbytes <= self.max_bytes:
+            return
+        if self._store is None:
+            self._store = DiskStore(self.spill_dir)
+        for message in self.messages[1:-1]:
+            nbytes -= message.spill(self._store)
+            if nbytes <= self.max_bytes:
+                break
 
     def fetch_messages(
         self, roles=None, vision: bool = True
@@ -212,16 +567,14 @@ class ChatMemory:
             images (list[Image.Image]): 画像データ
             label (str): 画面表示するときのタグのラベル
         """
-        self.messages.append(
-            ChatMessage(
+        self.append_message(
+            self.create_message(
                 role,
                 content,
                 images=images,
                 label=label,
-                unsafe_allow_html=unsafe_allow_html,
                 metadata=metadata,
-                thumbnail_hight=self.THUMBNAIL_WIDTH,
-                thumbnail_bg_color=self.THUMBNAIL_BG_COLOR,
+                unsafe_allow_html=unsafe_allow_html,
             )
         )
 
@@ -286,7 +639,8 @@ class ChatMemory:
             Image.Image
             | BytesIO
             | bytes
-            | list[Image.Image | BytesIO | bytes]
+            | PreparedPic
+            | list[Image.Image | BytesIO | bytes | PreparedPic]
             | None
         ) = None,
         vision: bool = True,
@@ -303,14 +657,7 @@ class ChatMemory:
             list[dict[str, str]]: OpenAI API形式のメッセージリスト"""
         roles_ = roles or ["user", "assistant", "system"]
         messages = self.fetch_messages(roles=roles_, vision=vision)
-        message = ChatMessage(
-            role,
-            prompt,
-            images,
-            metadata=metadata,
-            thumbnail_hight=self.THUMBNAIL_WIDTH,
-            thumbnail_bg_color=self.THUMBNAIL_BG_COLOR,
-        )
+        message = self.create_message(role, prompt, images, metadata=metadata)
         messages.append(message.to_message(vision=vision))
         return messages
 
@@ -322,7 +669,8 @@ class ChatMemory:
             Image.Image
             | BytesIO
             | bytes
-            | list[Image.Image | BytesIO | bytes]
+            | PreparedPic
+            | list[Image.Image | BytesIO | bytes | PreparedPic]
             | None
         ) = None,
         vision: bool = True,
@@ -339,17 +687,52 @@ class ChatMemory:
         messages = []
         messages.append(self.messages[0].to_message())
         messages.append(
-            ChatMessage(
-                role,
-                prompt,
-                images,
-                metadata=metadata,
-                thumbnail_hight=self.THUMBNAIL_WIDTH,
-                thumbnail_bg_color=self.THUMBNAIL_BG_COLOR,
-            ).to_message(vision=vision)
+            self.create_message(role, prompt, images, metadata=metadata).to_message(
+                vision=vision
+            )
         )
         return messages
 
+    def prompt_with_recent_messages(
+        self,
+        message: ChatMessage,
+        encoding: tiktoken.Encoding,
+        token_budget: int,
+        vision: bool = True,
+        roles: list[str] | None = None,
+    ) -> tuple[list[dict[str, Any]], int]:
+        """入力したメッセージにトークン予算に収まる直近の履歴をつけてChatGPTクライアントの形式で取得
+        システムロールと入力したメッセージは必ず残し、古いターンから削除する (メモリには記録しない)
+        Args:
+            message (ChatMessage): 入力したメッセージ
+            encoding (tiktoken.Encoding): エンコーディング
+            token_budget (int): 返信のプライミングを含むプロンプト全体のトークン数上限
+            vision (bool): 画像を含めるかどうか
+            roles (list[str]): 取得したいメッセージのロール
+        Returns:
+            list[dict[str, str]]: OpenAI API形式のメッセージリスト
+            int: 削除したターン数
+        """
+        roles_ = roles or CHAT_ROLES
+        history = [memory for memory in self.messages if memory.role in roles_]
+        num_head = 1 if history and history[0].role == "system" else 0
+        num_tokens = [memory.num_tokens(encoding, vision) for memory in history]
+        num_tokens.append(message.num_tokens(encoding, vision))
+        is_boundary = [
+            (i == num_head) or (memory.role == "user")
+            for i, memory in enumerate(history)
+        ]
+        is_boundary.append(True)
+        index = find_trim_index(
+            num_tokens, token_budget - TOKENS_REPLY_PRIMING, is_boundary, num_head
+        )
+        num_dropped = sum(is_boundary[num_head:index])
+        messages = [
+            memory.to_message(vision) for memory in history[:num_head] + history[index:]
+        ]
+        messages.append(message.to_message(vision))
+        return messages, num_dropped
+
     def remove_temporary_messages(self, roles: list[str] | None = None) -> None:
         """ステータス、エラー、警告メッセージを削除する
         Args:
@@ -357,6 +740,8 @@ class ChatMemory:
         """
         if roles is None:
             roles = ["status", "error", "warning"]
+        if set(roles) & set(CHAT_ROLES):
+            self._num_tokens.clear()
         self.messages = [
             message for message in self.messages if message.role not in roles
         ]
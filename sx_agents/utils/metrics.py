@@ -0,0 +1,358 @@
+"""プロセス内のメトリクスを集計するモジュール
+カウンタ・ゲージ・固定バケットのヒストグラムを保持し、Prometheusのテキスト形式で出力する
+"""
+
+import bisect
+import logging
+import math
+import threading
+from collections.abc import Iterator, Sequence
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+# ------------------------------------------------------------------------------
+#   Parameter設定
+# ------------------------------------------------------------------------------
+# 応答時間のヒストグラムのバケット (秒)
+LATENCY_BUCKETS: tuple[float, ...] = (
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+# Prometheusのテキスト形式のContent-Type
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Metric:
+    """メトリクスの基底クラス (ラベルの値ごとに値を保持する)
+    Args:
+        name (str): メトリクス名
+        documentation (str): 説明
+        labelnames (Sequence[str]): ラベル名
+    """
+
+    type_name: str = ""
+
+    def __init__(
+        self, name: str, documentation: str = "", labelnames: Sequence[str] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, Any]) -> tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} requires labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(
+        self, key: tuple[str, ...], extra: tuple[tuple[str, str], ...] = ()
+    ) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        text = ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs)
+        return "{" + text + "}"
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        """出力するサンプルを列挙する
+        Yields:
+            tuple[str, str, float]: サンプル名、ラベル、値
+        """
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._format_labels(key), value
+
+    def clear(self) -> None:
+        """全ての値を削除する"""
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        """値を加算する
+        Args:
+            amount (float): 加算する値 (0以上)
+            **labels: ラベルの値
+        """
+        if amount < 0:
+            raise ValueError("Counter can only be incremented.")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: Any) -> float:
+        """現在の値を取得する"""
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    """増減する現在値"""
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        """値を設定する"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        """値を加算する"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        """値を減算する"""
+        self.inc(-amount, **labels)
+
+    def get(self, **labels: Any) -> float:
+        """現在の値を取得する"""
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Histogram(_Metric):
+    """固定バケットのヒストグラム
+    Args:
+        name (str): メトリクス名
+        documentation (str): 説明
+        labelnames (Sequence[str]): ラベル名
+        buckets (Sequence[float]): バケットの上限 (昇順、+Infは自動で追加)
+    """
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str = "",
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: Any) -> None:
+        """値を記録する
+        Args:
+            value (float): 記録する値
+            **labels: ラベルの値
+        """
+        key = self._key(labels)
+        # 値が入るバケットだけを数え、累積は出力時に計算する
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [バケットごとの件数..., +Infの件数], 合計
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        with self._lock:
+            items = [
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            ]
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else _format_value(bound)
+                yield (
+                    f"{self.name}_bucket",
+                    self._format_labels(key, (("le", le),)),
+                    cumulative,
+                )
+            yield f"{self.name}_sum", self._format_labels(key), total
+            yield f"{self.name}_count", self._format_labels(key), cumulative
+
+
+class MetricsRegistry:
+    """メトリクスを登録して一括で出力するレジストリ (プロセス内で共有)"""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(
+        self, name: str, documentation: str = "", labelnames: Sequence[str] = ()
+    ) -> Counter:
+        """カウンタを登録する (登録済みの場合はそれを返す)"""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(
+        self, name: str, documentation: str = "", labelnames: Sequence[str] = ()
+    ) -> Gauge:
+        """ゲージを登録する (登録済みの場合はそれを返す)"""
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str = "",
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        """ヒストグラムを登録する (登録済みの場合はそれを返す)"""
+        return self._register(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as {metric.type_name}")
+            return metric
+
+    def __iter__(self) -> Iterator[_Metric]:
+        with self._lock:
+            return iter(list(self._metrics.values()))
+
+    def collect(self) -> list[dict[str, Any]]:
+        """全てのサンプルを取得する (管理画面の表示用)
+        Returns:
+            list[dict[str, Any]]: サンプル名、ラベル、値の辞書のリスト
+        """
+        return [
+            {"name": name, "labels": labels, "value": value}
+            for metric in self
+            for name, labels, value in metric.samples()
+        ]
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式で出力する
+        Returns:
+            str: Prometheusのテキスト形式
+        """
+        lines = []
+        for metric in self:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# ------------------------------------------------------------------------------
+# Prometheusの収集用エンドポイント
+# ------------------------------------------------------------------------------
+_server: ThreadingHTTPServer | None = None
+_server_error: OSError | None = None  # 起動に失敗した場合のエラー (再試行しない)
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(
+    port: int, host: str = "127.0.0.1", registry: MetricsRegistry | None = None
+) -> ThreadingHTTPServer | None:
+    """/metricsでPrometheusのテキスト形式を返すHTTPサーバを別スレッドで起動する
+    プロセス内で1度だけ起動し、2回目以降は起動済みのサーバを返す
+    ポートが使用中などで起動できない場合は1度だけログに出してNoneを返す (アプリは止めない)
+    Args:
+        port (int): ポート番号
+        host (str): 待ち受けるアドレス
+        registry (MetricsRegistry): 出力するレジストリ (Noneの場合は共有のレジストリ)
+    Returns:
+        ThreadingHTTPServer | None: 起動したサーバ (起動に失敗した場合はNone)
+    """
+    global _server, _server_error  # pylint: disable=W0603
+    registry_ = registry or metrics_registry
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=C0103
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry_.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=W0622
+            # 収集のたびにアクセスログを出さない
+            pass
+
+    with _server_lock:
+        if (_server is None) and (_server_error is None):
+            try:
+                server = ThreadingHTTPServer((host, port), Handler)
+            except OSError as e:
+                _server_error = e
+                logging.getLogger(__name__).warning(
+                    "Failed to start the metrics server on %s:%d: %s", host, port, e
+                )
+                return None
+            server.daemon_threads = True
+            threading.Thread(
+                target=server.serve_forever, name="sx_agents-metrics", daemon=True
+            ).start()
+            _server = server
+        return _server
+
+
+# ------------------------------------------------------------------------------
+# 共有のレジストリと標準のメトリクス
+# ------------------------------------------------------------------------------
+metrics_registry = MetricsRegistry()
+
+ACTIVE_SESSIONS = metrics_registry.gauge(
+    "sxgpt_active_sessions", "Number of live Streamlit sessions."
+)
+LLM_INFLIGHT = metrics_registry.gauge(
+    "sxgpt_llm_inflight", "LLM calls currently in flight.", ["model"]
+)
+LLM_CALLS = metrics_registry.counter(
+    "sxgpt_llm_calls_total", "Finished LLM calls.", ["model", "status"]
+)
+LLM_TTFT = metrics_registry.histogram(
+    "sxgpt_llm_ttft_seconds", "Time to first token of LLM calls.", ["model"]
+)
+LLM_DURATION = metrics_registry.histogram(
+    "sxgpt_llm_duration_seconds", "Duration of LLM calls.", ["model"]
+)
+LLM_TOKENS = metrics_registry.counter(
+    "sxgpt_llm_tokens_total", "Tokens used by LLM calls.", ["model", "kind"]
+)
+REQUEST_LATENCY = metrics_registry.histogram(
+    "sxgpt_request_seconds", "End-to-end latency of chat turns.", ["plugin", "model"]
+)
+CACHE_REQUESTS = metrics_registry.counter(
+    "sxgpt_cache_requests_total", "Cache lookups.", ["cache", "result"]
+)
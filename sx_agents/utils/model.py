@@ -1,11 +1,41 @@
+import asyncio
+import hashlib
+import json
 import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator
 from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import Any
 
+import httpx
 from langchain.chat_models.base import BaseChatModel
 from langchain_openai import ChatOpenAI
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
 
-from .common import num_tokens_from_messages
+from .cache import (
+    SimilarHit,
+    llm_response_cache,
+    make_cache_key,
+    similar_response_cache,
+)
+from .cassette import CassetteChatModel, CassetteConfig
+from .common import get_encoding, get_event_loop, num_tokens_from_messages
+from .memory import ChatMemory, ChatMessage
+
+# ------------------------------------------------------------------------------
+#   Parameter設定
+# ------------------------------------------------------------------------------
+# LLMクライアントのプール設定 (プロセス内の全セッションで共有)
+LLM_CLIENT_POOL_MAX_SIZE = 32  # 保持するクライアント数の上限
+LLM_CLIENT_IDLE_TIMEOUT = 1800.0  # 未使用のクライアントを破棄するまでの秒数
+# HTTPコネクションの設定 (Cloud Runの同時実行数80を想定)
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 40
+HTTP_KEEPALIVE_EXPIRY = 120.0
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
 
 
 @dataclass
@@ -20,24 +50,139 @@ class Model:
     visible: bool = True  # UI表示するかどうか
     token_limit: int | None = None
     max_response_token: int | None = None
+    response_cache: bool = False  # 同じリクエストのレスポンスを再利用するかどうか
+    similar_cache_threshold: float | None = None  # 類似プロンプトの再利用の閾値
+    rpm_limit: int | None = None  # デプロイの1分あたりのリクエスト数の上限
+    tpm_limit: int | None = None  # デプロイの1分あたりのトークン数の上限
+
+    @property
+    def token_budget(self) -> int:
+        """レスポンス分を除いたプロンプトに使えるトークン数"""
+        return self.token_limit - self.max_response_token - 1
 
-    def create_langchain_chat(self, callbacks=None, **kwargs) -> BaseChatModel:
+    def create_langchain_chat(
+        self, callbacks=None, cassette: CassetteConfig | None = None, **kwargs
+    ) -> BaseChatModel:
         """LangchainのChatGPTクライアントを生成する
         Args:
             callbacks (list[Callable]): コールバック関数
+            cassette (CassetteConfig): 応答の記録・再生の設定
+                (省略時は環境変数LLM_CASSETTE_MODEなどから読み込む)
             **kwargs: その他のパラメータ
         Returns:
             BaseChatModel: LangchainのChatGPTクライアント
         """
-        secret_keys = {k: os.getenv(v, "") for k, v in self.secret_keys.items()}
-        config_ = self.config | secret_keys
+        cassette = cassette or CassetteConfig.from_env()
+        if cassette is not None:
+            # 再生時はAPIに接続しないためクライアントを生成しない
+            inner = None
+            if cassette.mode == "record":
+                inner = self._create_langchain_chat(callbacks=callbacks, **kwargs)
+            return CassetteChatModel(
+                cassette=cassette,
+                model_name=self.config.get("model_name", self.name),
+                inner=inner,
+            )
+        return self._create_langchain_chat(callbacks=callbacks, **kwargs)
+
+    def _create_langchain_chat(self, callbacks=None, **kwargs) -> BaseChatModel:
+        config_ = self.resolve_config()
 
         if self.type == "azure":
-            client = create_langchain_chat_azure(config_, callbacks=callbacks, **kwargs)
+            client = llm_client_pool.get(
+                (self.type, config_, kwargs),
+                lambda: create_langchain_chat_azure(
+                    config_, callbacks=callbacks, **kwargs
+                ),
+            )
         else:
             raise ValueError(f"{self.type} is not supported.")
         return client
 
+    def stream_with_cache(
+        self,
+        messages: list[dict[str, Any]],
+        stream: Callable[[], Iterable[str]],
+    ) -> Iterator[str]:
+        """レスポンスのキャッシュを通してストリーミングする
+        キャッシュが有効なモデルで同じメッセージのレスポンスがあればAPIを呼ばずに返す
+        Args:
+            messages (list[dict]): OpenAI API形式のメッセージリスト
+            stream (Callable[[], Iterable[str]]): APIを呼び出してストリーミングする関数
+        Yields:
+            str: レスポンスの差分
+        """
+        if not self.response_cache:
+            yield from stream()
+            return
+        key = make_cache_key(self.type, dict(self.config), messages)
+        response = llm_response_cache.get(key)
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        for chunk in stream():
+            chunks.append(str(chunk))
+            yield chunk
+        # 最後まで受信できたレスポンスのみ保存
+        llm_response_cache.put(key, "".join(chunks))
+
+    def find_similar_response(
+        self, messages: list[dict[str, Any]]
+    ) -> SimilarHit | None:
+        """表記ゆれのある同じプロンプトのレスポンスを検索する
+        システムロールとプロンプトだけの単発のリクエストのみ対象とする
+        Args:
+            messages (list[dict]): OpenAI API形式のメッセージリスト
+        Returns:
+            SimilarHit | None: ヒットした場合はレスポンスと類似度
+        """
+        if (self.similar_cache_threshold is None) or not _is_single_turn(messages):
+            return None
+        return similar_response_cache.lookup(
+            self._similar_cache_namespace(messages),
+            messages[-1]["content"],
+            threshold=self.similar_cache_threshold,
+        )
+
+    def store_similar_response(
+        self, messages: list[dict[str, Any]], response: str
+    ) -> None:
+        """単発のリクエストのレスポンスを類似プロンプトのキャッシュに保存する
+        Args:
+            messages (list[dict]): OpenAI API形式のメッセージリスト
+            response (str): レスポンス
+        """
+        if (self.similar_cache_threshold is None) or not _is_single_turn(messages):
+            return
+        similar_response_cache.put(
+            self._similar_cache_namespace(messages), messages[-1]["content"], response
+        )
+
+    def _similar_cache_namespace(self, messages: list[dict[str, Any]]) -> str:
+        # モデルとシステムロールは完全一致が必要
+        return make_cache_key(self.type, dict(self.config), messages[0])
+
+    def resolve_config(self) -> dict[str, Any]:
+        """秘密情報を環境変数から読み込んだモデル設定を取得する
+        Returns:
+            dict[str, Any]: モデル設定
+        """
+        secret_keys = {k: os.getenv(v, "") for k, v in self.secret_keys.items()}
+        return self.config | secret_keys
+
+    def warmup(self) -> None:
+        """クライアントを生成し、APIサーバへの接続をバックグラウンドで確立しておく"""
+        try:
+            self.create_langchain_chat()
+        except Exception:  # pylint: disable=W0718
+            return
+        base_url = self.resolve_config().get("base_url")
+        if base_url:
+            threading.Thread(
+                target=warmup_connection, args=(base_url,), daemon=True
+            ).start()
+
     def count_tokens_from_message(self, messages: list[dict[str, Any]]) -> int:
         """メッセージリストからトークン数をカウントする
         Args:
@@ -60,6 +205,83 @@ class Model:
         num_token = self.count_tokens_from_message(messages)
         return num_token + self.max_response_token < self.token_limit
 
+    def count_tokens_from_memory(
+        self,
+        memory: ChatMemory,
+        message: ChatMessage | None = None,
+        with_history: bool = True,
+        vision: bool | None = None,
+    ) -> int:
+        """メモリと追加するメッセージからトークン数をカウントする
+        メモリ内のメッセージはキャッシュされたトークン数を使うため、新しいメッセージのみエンコードされる
+        Args:
+            memory (ChatMemory): チャットのメモリ
+            message (ChatMessage): 追加するメッセージ
+            with_history (bool): Falseの場合はシステムロールのみを対象とする
+            vision (bool): 画像を含めるかどうか (Noneの場合はモデルの設定に従う)
+        Returns:
+            int: トークン数
+        """
+        vision_ = self.vision if vision is None else vision
+        encoding = get_encoding(self.config.get("model_name", "gpt-3.5-turbo"))
+        roles = None if with_history else ["system"]
+        num_token = memory.num_tokens(encoding, vision_, roles=roles)
+        if message is not None:
+            num_token += message.num_tokens(encoding, vision_)
+        return num_token
+
+    def is_less_than_token_limit_from_memory(
+        self,
+        memory: ChatMemory,
+        message: ChatMessage | None = None,
+        with_history: bool = True,
+        vision: bool | None = None,
+    ) -> bool:
+        """メモリと追加するメッセージのトークン数が制限以下かどうかを判定する
+        Args:
+            memory (ChatMemory): チャットのメモリ
+            message (ChatMessage): 追加するメッセージ
+            with_history (bool): Falseの場合はシステムロールのみを対象とする
+            vision (bool): 画像を含めるかどうか (Noneの場合はモデルの設定に従う)
+        Returns:
+            bool: トークン数が制限以下かどうか
+        """
+        num_token = self.count_tokens_from_memory(
+            memory, message, with_history, vision
+        )
+        return num_token + self.max_response_token < self.token_limit
+
+    def prompt_with_memory(
+        self,
+        memory: ChatMemory,
+        message: ChatMessage,
+        vision: bool | None = None,
+    ) -> tuple[list[dict[str, Any]], int]:
+        """トークン制限に収まるように古いターンを削除した履歴をつけてメッセージを取得する
+        Args:
+            memory (ChatMemory): チャットのメモリ
+            message (ChatMessage): 追加するメッセージ
+            vision (bool): 画像を含めるかどうか (Noneの場合はモデルの設定に従う)
+        Returns:
+            list[dict[str, Any]]: OpenAI API形式のメッセージリスト
+            int: 削除したターン数
+        """
+        vision_ = self.vision if vision is None else vision
+        encoding = get_encoding(self.config.get("model_name", "gpt-3.5-turbo"))
+        return memory.prompt_with_recent_messages(
+            message, encoding, self.token_budget, vision=vision_
+        )
+
+
+def _is_single_turn(messages: list[dict[str, Any]]) -> bool:
+    """システムロールとテキストのプロンプトだけのメッセージリストかどうか"""
+    return (
+        (len(messages) == 2)
+        and (messages[0]["role"] == "system")
+        and (messages[1]["role"] == "user")
+        and isinstance(messages[1]["content"], str)
+    )
+
 
 def create_langchain_chat_azure(
     config: dict[str, Any], callbacks=None, **kwargs
@@ -74,13 +296,147 @@ def create_langchain_chat_azure(
 
     config_ = config | kwargs
 
-    temp = kwargs.get("temperature", 1.0)
+    temp = config_.pop("temperature", 1.0)
+    # ストリーミングでもトークン使用量を受け取る (コールバックでの計測用)
+    config_.setdefault("stream_usage", True)
     if config["model_name"] == "gpt-4o":
         temp = 0.3
 
+    base_url = config_.get("base_url", "")
     client = ChatOpenAI(
         temperature=temp,
         # callbacks=callbacks,
+        http_client=get_http_client(base_url),
+        http_async_client=get_async_http_client(base_url),
         **config_,
     )
     return client
+
+
+# ------------------------------------------------------------------------------
+# クライアントのプール
+# ------------------------------------------------------------------------------
+@lru_cache(maxsize=8)
+def get_http_client(base_url: str) -> httpx.Client:
+    """接続先ごとに共有するHTTPクライアントを取得する (keep-aliveで接続を再利用)
+    Args:
+        base_url (str): 接続先のURL
+    Returns:
+        httpx.Client: HTTPクライアント
+    """
+    return DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+@lru_cache(maxsize=8)
+def get_async_http_client(base_url: str) -> httpx.AsyncClient:
+    """接続先ごとに共有する非同期HTTPクライアントを取得する (astreamで使う)
+    接続プールはイベントループに紐づくため、get_event_loop()のループでのみ使う
+    Args:
+        base_url (str): 接続先のURL
+    Returns:
+        httpx.AsyncClient: 非同期HTTPクライアント
+    """
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+def warmup_connection(base_url: str) -> None:
+    """接続先へリクエストを送り、TCP/TLS接続をプールに確立しておく
+    ストリーミングは非同期クライアントを使うため、両方のプールに接続を作る
+    Args:
+        base_url (str): 接続先のURL
+    """
+    try:
+        get_http_client(base_url).head(base_url, timeout=5.0)
+        asyncio.run_coroutine_threadsafe(
+            get_async_http_client(base_url).head(base_url, timeout=5.0),
+            get_event_loop(),
+        ).result(timeout=10.0)
+    except (httpx.HTTPError, TimeoutError):
+        pass
+
+
+class LLMClientPool:
+    """設定ごとにLLMクライアントを共有するプール
+    上限を超えた場合は最も古く使われたものから、一定時間使われていないものは取得時に破棄する
+    Args:
+        max_size (int): 保持するクライアント数の上限
+        idle_timeout (float): 未使用のクライアントを破棄するまでの秒数
+    """
+
+    def __init__(
+        self,
+        max_size: int = LLM_CLIENT_POOL_MAX_SIZE,
+        idle_timeout: float = LLM_CLIENT_IDLE_TIMEOUT,
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clients: OrderedDict[str, tuple[BaseChatModel, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    @staticmethod
+    def make_key(config: Any) -> str:
+        """設定からキーを生成する (APIキーを平文で保持しないようハッシュ化)
+        Args:
+            config (Any): JSONに変換可能な設定
+        Returns:
+            str: キー
+        """
+        text = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, config: Any, factory: Callable[[], BaseChatModel]) -> BaseChatModel:
+        """設定に対応するクライアントを取得する (なければ生成してプールに追加)
+        Args:
+            config (Any): クライアントの設定
+            factory (Callable[[], BaseChatModel]): クライアントの生成関数
+        Returns:
+            BaseChatModel: LLMクライアント
+        """
+        key = self.make_key(config)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            if key in self._clients:
+                client, _ = self._clients.pop(key)
+                self._clients[key] = (client, now)
+                return client
+        client = factory()
+        with self._lock:
+            self._clients[key] = (client, now)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+        return client
+
+    def clear(self) -> None:
+        """全てのクライアントを破棄する"""
+        with self._lock:
+            self._clients.clear()
+
+    def _evict_idle(self, now: float) -> None:
+        """一定時間使われていないクライアントを破棄する"""
+        while self._clients:
+            _, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            self._clients.popitem(last=False)
+
+
+# プロセス内で共有するLLMクライアントのプール
+llm_client_pool = LLMClientPool()
@@ -0,0 +1,321 @@
+"""PDF/PPTXのページを必要な時だけ画像に変換するモジュール
+
+アップロード時には全ページを変換せず、プロンプトに使うページだけをレンダリングする
+変換した画像はファイルのハッシュとページ番号をキーにプロセス全体でキャッシュする
+トークン数はレンダリングせずに、ページの大きさから画像のサイズを計算して見積もる
+
+PDFのページはpypdfium2でレンダリングする (画像処理のワーカープロセスで実行する)
+PPTXはLibreOffice (soffice) でPDFに変換してからレンダリングする
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections.abc import Iterable
+from io import BytesIO
+from pathlib import Path
+
+import pypdfium2 as pdfium
+from pptx import Presentation
+from pypdf import PdfReader
+
+from .common import (
+    BytesLRUCache,
+    PreparedPic,
+    config_pic_params,
+    get_normalized_pic_size,
+    image_pool,
+    num_token_from_pic,
+    prepare_pic,
+)
+
+# ------------------------------------------------------------------------------
+#   Parameter設定
+# ------------------------------------------------------------------------------
+# 変換済みのページ画像のキャッシュ上限 (プロセス全体のバイト数)
+PAGE_IMAGE_CACHE_MAX_BYTES = 128 * 1024 * 1024
+# レンダリングの解像度 (正規化後のサイズを超える分は縮小してからレンダリングする)
+PAGE_RENDER_DPI = 150
+# 1回のワーカーの処理でレンダリングするページ数 (ファイルの送信回数と並列度の兼ね合い)
+PAGE_RENDER_BATCH = 8
+# PPTXをPDFに変換する時間の上限 (秒)
+PPTX_CONVERT_TIMEOUT = 120.0
+# PPTXをPDFに変換するフィルタ (非表示のスライドも出力し、スライドとページを対応させる)
+PPTX_PDF_FILTER = (
+    'pdf:impress_pdf_Export:{"ExportHiddenSlides":{"type":"boolean","value":"true"}}'
+)
+# 対応する拡張子
+PDF_SUFFIXES = (".pdf",)
+PPTX_SUFFIXES = (".pptx",)
+
+# pdfiumはスレッドセーフではないため、呼び出し元で実行する場合に備えて排他する
+_pdfium_lock = threading.Lock()
+
+
+class PagedDocument:
+    """PDF/PPTXのページを必要な時だけ画像に変換するクラス
+    Args:
+        data (bytes): ファイルのバイト列
+        filename (str): ファイル名 (拡張子で形式を判定する)
+        thumbnail_height (int | None): サムネイルの高さ (Noneの場合は作成しない)
+        thumbnail_bg_color (tuple[int, int, int]): サムネイルの背景色
+        cache (BytesLRUCache): 変換済みのページ画像のキャッシュ
+    """
+
+    def __init__(
+        self,
+        data: bytes,
+        filename: str,
+        thumbnail_height: int | None = 180,
+        thumbnail_bg_color: tuple[int, int, int] | None = None,
+        cache: BytesLRUCache | None = None,
+    ):
+        self.filename = filename
+        self.suffix = os.path.splitext(filename)[-1].lower()
+        if self.suffix not in PDF_SUFFIXES + PPTX_SUFFIXES:
+            raise ValueError(f"{self.suffix} is not supported.")
+        self.key = hashlib.sha256(data).hexdigest()
+        self.thumbnail_height = thumbnail_height
+        self.thumbnail_bg_color = thumbnail_bg_color
+        self.cache = cache if cache is not None else page_image_cache
+        self._data = data
+        self._document = None  # ページの読込時に開く (PdfReader / Presentation)
+        self._lock = threading.Lock()
+
+    @property
+    def num_pages(self) -> int:
+        """ページ数"""
+        document = self._open()
+        if self.suffix in PDF_SUFFIXES:
+            return len(document.pages)
+        return len(document.slides)
+
+    def page_size(self, page: int) -> tuple[int, int]:
+        """ページの画像のサイズ (レンダリングせずにページの大きさから計算する)
+        Args:
+            page (int): ページ番号 (0始まり)
+        Returns:
+            tuple[int, int]: 幅, 高さ
+        """
+        return render_size(*self._page_points(page))
+
+    def num_tokens(self, pages: Iterable[int]) -> int:
+        """ページの画像を送信する場合のトークン数を見積もる
+        Args:
+            pages (Iterable[int]): ページ番号 (0始まり)
+        Returns:
+            int: トークン数
+        """
+        return sum(
+            num_token_from_pic(*self.page_size(page), **config_pic_params)
+            for page in pages
+        )
+
+    def get(self, page: int) -> PreparedPic:
+        """ページの画像を取得する (キャッシュになければレンダリングする)
+        Args:
+            page (int): ページ番号 (0始まり)
+        Returns:
+            PreparedPic: 変換済みの画像
+        """
+        return self.get_many([page])[0]
+
+    def get_many(self, pages: Iterable[int]) -> list[PreparedPic]:
+        """複数ページの画像をまとめて取得する (キャッシュにないページだけレンダリングする)
+        Args:
+            pages (Iterable[int]): ページ番号 (0始まり)
+        Returns:
+            list[PreparedPic]: 変換済みの画像
+        """
+        pages = list(pages)
+        prepared = {page: self.cache.get(self._cache_key(page)) for page in pages}
+        missing = [page for page, pic in prepared.items() if pic is None]
+        if missing:
+            data = self._pdf_data()
+            # レンダリング・正規化・エンコードはワーカープロセスで並行して行う
+            batches = [
+                missing[i : i + PAGE_RENDER_BATCH]
+                for i in range(0, len(missing), PAGE_RENDER_BATCH)
+            ]
+            futures = []
+            try:
+                for batch in batches:
+                    futures.append(
+                        image_pool.submit(
+                            render_pdf_pages,
+                            data,
+                            batch,
+                            self.thumbnail_height,
+                            self.thumbnail_bg_color,
+                        )
+                    )
+                for batch, future in zip(batches, futures):
+                    for page, pic in zip(batch, future.result(image_pool.timeout)):
+                        self.cache.put(self._cache_key(page), pic)
+                        prepared[page] = pic
+            except BaseException:
+                # 開始前の処理は取り消す
+                for future in futures:
+                    future.cancel()
+                raise
+        return [prepared[page] for page in pages]
+
+    # --------------------------------------------------------------------------
+    # ファイル形式ごとの読込
+    # --------------------------------------------------------------------------
+    def _cache_key(self, page: int) -> str:
+        return f"{self.key}:{page}:{self.thumbnail_height}:{self.thumbnail_bg_color}"
+
+    def _open(self):
+        with self._lock:
+            if self._document is None:
+                # ページの中身は参照した時に読み込まれる
+                if self.suffix in PDF_SUFFIXES:
+                    self._document = PdfReader(BytesIO(self._data))
+                else:
+                    self._document = Presentation(BytesIO(self._data))
+            return self._document
+
+    def _page_points(self, page: int) -> tuple[float, float]:
+        """ページの表示上の大きさ (ポイント、回転を反映する)"""
+        document = self._open()
+        if self.suffix in PPTX_SUFFIXES:
+            # 全スライドが同じ大きさ (範囲外のページはIndexError)
+            document.slides[page]  # pylint: disable=W0104
+            return document.slide_width.pt, document.slide_height.pt
+        pdf_page = document.pages[page]
+        width, height = float(pdf_page.cropbox.width), float(pdf_page.cropbox.height)
+        if pdf_page.rotation % 180:
+            width, height = height, width
+        return width, height
+
+    def _pdf_data(self) -> bytes:
+        """レンダリングするPDFのバイト列 (PPTXはPDFに変換してキャッシュする)"""
+        if self.suffix in PDF_SUFFIXES:
+            return self._data
+        key = f"{self.key}:pdf"
+        with self._lock:
+            data = self.cache.get(key)
+            if data is None:
+                data = convert_pptx_to_pdf(self._data)
+                self.cache.put(key, data)
+        return data
+
+
+def render_size(width: float, height: float) -> tuple[int, int]:
+    """ページをレンダリングする画像のサイズ (PAGE_RENDER_DPIの大きさを正規化したサイズ)
+    Args:
+        width (float): ページの幅 (ポイント)
+        height (float): ページの高さ (ポイント)
+    Returns:
+        tuple[int, int]: 幅, 高さ
+    """
+    scale = PAGE_RENDER_DPI / 72.0
+    width_, height_ = get_normalized_pic_size(
+        max(1, round(width * scale)),
+        max(1, round(height * scale)),
+        config_pic_params["one_side_limit"],
+        config_pic_params["short_side_limit"],
+    )
+    return max(1, width_), max(1, height_)
+
+
+def render_pdf_pages(
+    data: bytes,
+    pages: list[int],
+    thumbnail_height: int | None = 180,
+    thumbnail_bg_color: tuple[int, int, int] | None = None,
+) -> list[PreparedPic]:
+    """PDFのページをレンダリングし、正規化・エンコードする (ワーカープロセスで実行する)
+    Args:
+        data (bytes): PDFのバイト列
+        pages (list[int]): ページ番号 (0始まり)
+        thumbnail_height (int | None): サムネイルの高さ (Noneの場合は作成しない)
+        thumbnail_bg_color (tuple[int, int, int]): サムネイルの背景色
+    Returns:
+        list[PreparedPic]: 変換済みの画像 (pagesの順)
+    """
+    prepared = []
+    with _pdfium_lock:
+        document = pdfium.PdfDocument(data)
+        try:
+            for page in pages:
+                pdf_page = document[page]
+                width, height = pdf_page.get_size()
+                # 正規化後のサイズで直接レンダリングし、大きな画像を作らない
+                size = render_size(width, height)
+                image = pdf_page.render(scale=size[0] / width).to_pil()
+                if image.size != size:
+                    # 端数の丸めで1px違う場合は見積もりのサイズに合わせる
+                    image = image.resize(size)
+                prepared.append(
+                    prepare_pic(image, thumbnail_height, thumbnail_bg_color)
+                )
+                pdf_page.close()
+        finally:
+            document.close()
+    return prepared
+
+
+def convert_pptx_to_pdf(data: bytes) -> bytes:
+    """PPTXをLibreOfficeでPDFに変換する
+    Args:
+        data (bytes): PPTXのバイト列
+    Returns:
+        bytes: PDFのバイト列
+    """
+    soffice = shutil.which("soffice")
+    if soffice is None:
+        raise RuntimeError("LibreOffice (soffice) is required to render .pptx pages.")
+    with tempfile.TemporaryDirectory() as dirpath:
+        filepath = os.path.join(dirpath, "slides.pptx")
+        with open(filepath, "wb") as f:
+            f.write(data)
+        # 同時に変換してもプロファイルを取り合わないよう、変換ごとに分ける
+        profile = Path(dirpath, "profile").as_uri()
+        subprocess.run(
+            [
+                soffice,
+                f"-env:UserInstallation={profile}",
+                "--headless",
+                "--convert-to",
+                PPTX_PDF_FILTER,
+                "--outdir",
+                dirpath,
+                filepath,
+            ],
+            check=True,
+            capture_output=True,
+            timeout=PPTX_CONVERT_TIMEOUT,
+        )
+        with open(os.path.join(dirpath, "slides.pdf"), "rb") as f:
+            return f.read()
+
+
+def parse_pages(text: str, num_pages: int) -> list[int]:
+    """ページ指定の文字列をページ番号のリストに変換する
+    例: "1-3, 5" -> [0, 1, 2, 4] (範囲外のページと、"-1"や"a"などの解釈できない指定は除く)
+    Args:
+        text (str): ページ指定 (1始まり、カンマ区切り、範囲はハイフン)
+        num_pages (int): ページ数
+    Returns:
+        list[int]: ページ番号 (0始まり、重複なし、昇順)
+    """
+    pages = set()
+    for part in re.split(r"[,、\s]+", text.strip()):
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", part)
+        if match is None:
+            continue
+        start, end = int(match[1]), int(match[2] or match[1])
+        pages.update(range(max(1, start), min(num_pages, end) + 1))
+    return [page - 1 for page in sorted(pages)]
+
+
+# PagedDocument用のキャッシュ
+page_image_cache = BytesLRUCache(PAGE_IMAGE_CACHE_MAX_BYTES)
@@ -0,0 +1,112 @@
+"""ローカルディスクへのデータ退避用モジュール"""
+
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import weakref
+from typing import Any
+
+
+class DiskStore:
+    """SQLiteのファイルを使ったキーバリューストア
+    filepathを指定しない場合は一時ファイルを作成し、破棄時にファイルも削除する
+    (セッションのメモリ上限を超えたデータの退避先として使う)
+    Args:
+        dirpath (str): 一時ファイルの保存先 (Noneの場合はOSの一時ディレクトリ)
+        filepath (str): 永続化するファイルのパス (プロセス間で共有するキャッシュなど)
+    """
+
+    filepath: str
+
+    def __init__(self, dirpath: str | None = None, filepath: str | None = None):
+        is_temporary = filepath is None
+        if is_temporary:
+            fd, filepath = tempfile.mkstemp(
+                prefix="sx_agents_", suffix=".sqlite3", dir=dirpath
+            )
+            os.close(fd)
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        # Streamlitは再実行ごとに別スレッドから呼ばれるためスレッドチェックを外してロックで保護
+        self._conn = sqlite3.connect(
+            self.filepath, check_same_thread=False, isolation_level=None
+        )
+        if is_temporary:
+            self._conn.execute("PRAGMA journal_mode=OFF")
+            self._conn.execute("PRAGMA synchronous=OFF")
+        else:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS payload (key TEXT PRIMARY KEY, value BLOB)"
+        )
+        self._finalizer = weakref.finalize(
+            self,
+            _close_and_remove if is_temporary else _close,
+            self._conn,
+            self.filepath,
+        )
+
+    def put(self, key: str, value: Any) -> int:
+        """値を保存する
+        Args:
+            key (str): キー
+            value (Any): 値 (pickle可能なオブジェクト)
+        Returns:
+            int: 保存したバイト数
+        """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO payload (key, value) VALUES (?, ?)",
+                (key, data),
+            )
+        return len(data)
+
+    def get(self, key: str) -> Any:
+        """値を取得する
+        Args:
+            key (str): キー
+        Returns:
+            Any: 値
+        Raises:
+            KeyError: キーが存在しない場合
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM payload WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def delete(self, *keys: str) -> None:
+        """値を削除する (存在しないキーは無視)
+        Args:
+            *keys (str): キー
+        """
+        if not self._finalizer.alive:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM payload WHERE key = ?", [(key,) for key in keys]
+            )
+
+    def close(self) -> None:
+        """接続を閉じる (一時ファイルの場合はファイルも削除する)"""
+        self._finalizer()
+
+
+def _close(conn: sqlite3.Connection, filepath: str) -> None:
+    """接続を閉じる"""
+    conn.close()
+
+
+def _close_and_remove(conn: sqlite3.Connection, filepath: str) -> None:
+    """接続を閉じて一時ファイルを削除する"""
+    conn.close()
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
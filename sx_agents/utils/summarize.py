@@ -0,0 +1,291 @@
+"""長い文章を分割して要約するモジュール (map-reduce)
+
+文章を文の区切り (。！？など) でトークン数に合わせたチャンクに分割し、チャンクごとの要約を同時に実行する
+要約をまとめる処理は、トークン制限に収まる単位で段階的に繰り返し、最後に1つの要約にする
+
+チャンクの要約はチャンクのハッシュとプロンプトをキーにキャッシュする
+チャンクの区切りは文の内容から決めるため、文章を一部編集しても他のチャンクの区切りは変わらず、
+編集したチャンクだけ再要約される
+
+実行例:
+    summarizer = MapReduceSummarizer(model)
+    summary = summarizer.summarize(text)
+"""
+
+import hashlib
+import os
+import re
+from collections.abc import Callable
+from typing import Any
+
+import tiktoken
+
+from .batch import BatchExecutor
+from .cache import RESPONSE_CACHE_DIR, ResponseCache, make_cache_key
+from .common import get_encoding
+from .model import Model
+
+# ------------------------------------------------------------------------------
+#   Parameter設定
+# ------------------------------------------------------------------------------
+# チャンクのトークン数の上限 (モデルのトークン制限が小さい場合はそちら)
+SUMMARY_CHUNK_TOKENS = 3000
+SUMMARY_MIN_CHUNK_RATIO = 0.75  # チャンクを区切り始めるトークン数の割合
+SUMMARY_BOUNDARY_MODULUS = 8  # 文のハッシュがこの数で割り切れる位置で区切る
+SUMMARY_MAX_CONCURRENCY = 8  # 同時に要約するチャンク数
+SUMMARY_MAX_DEPTH = 8  # 要約をまとめる段数の上限
+# チャンクの要約のキャッシュ設定
+SUMMARY_CACHE_MAX_ENTRIES = 4096
+SUMMARY_CACHE_TTL = 7 * 24 * 3600.0
+SUMMARY_CACHE_DIR = os.getenv("SUMMARY_CACHE_DIR", RESPONSE_CACHE_DIR)
+# プロンプト ({text}に文章が入る)
+DEFAULT_MAP_PROMPT = (
+    "次の文章は長い文書の一部です。重要な事実・数値・結論を漏らさずに日本語で要約してください。\n\n"
+    "{text}"
+)
+DEFAULT_REDUCE_PROMPT = (
+    "次の文章は長い文書を分割して要約したものです。"
+    "重複を除いて1つの要約に日本語でまとめてください。\n\n{text}"
+)
+SUMMARY_SEPARATOR = "\n\n"
+
+# 文の区切り (句点・感嘆符・疑問符と閉じ括弧、英文のピリオド+空白、改行)
+_re_sentence = re.compile(
+    r"[^。！？!?\n]*?(?:[。！？!?]+[」』）)]*|\.(?=\s)|\n+)\s*|[^。！？!?\n]+$"
+)
+
+
+def split_sentences(text: str) -> list[str]:
+    """文章を文に分割する (区切り文字は前の文に含め、結合すると元の文章に戻る)
+    Args:
+        text (str): 文章
+    Returns:
+        list[str]: 文のリスト
+    """
+    return [m.group(0) for m in _re_sentence.finditer(text) if m.group(0)]
+
+
+def chunk_text(
+    text: str,
+    encoding: tiktoken.Encoding,
+    max_tokens: int,
+    min_ratio: float = SUMMARY_MIN_CHUNK_RATIO,
+) -> list[str]:
+    """文の区切りでトークン数の上限に収まるチャンクに分割する
+    上限の割合 (min_ratio) を超えた後は、ハッシュが条件を満たす文の後で区切る
+    (区切りが文の内容で決まるため、前の部分を編集しても後ろのチャンクの区切りは変わらない)
+    Args:
+        text (str): 文章
+        encoding (tiktoken.Encoding): エンコーディング
+        max_tokens (int): チャンクのトークン数の上限
+        min_ratio (float): 区切り始めるトークン数の割合
+    Returns:
+        list[str]: チャンクのリスト
+    """
+    min_tokens = int(max_tokens * min_ratio)
+    chunks: list[str] = []
+    current: list[str] = []
+    num_tokens = 0
+    for sentence in split_sentences(text):
+        for piece, n in _split_long(sentence, encoding, max_tokens):
+            if current and (num_tokens + n > max_tokens):
+                chunks.append("".join(current))
+                current, num_tokens = [], 0
+            current.append(piece)
+            num_tokens += n
+            if (num_tokens >= min_tokens) and _is_boundary(piece):
+                chunks.append("".join(current))
+                current, num_tokens = [], 0
+    if current:
+        chunks.append("".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def _split_long(
+    sentence: str, encoding: tiktoken.Encoding, max_tokens: int
+) -> list[tuple[str, int]]:
+    """上限を超える文を文字数で半分ずつに分ける (トークンの途中で文字を壊さないため)"""
+    n = len(encoding.encode(sentence, disallowed_special=()))
+    if (n <= max_tokens) or (len(sentence) <= 1):
+        return [(sentence, n)]
+    half = len(sentence) // 2
+    return _split_long(sentence[:half], encoding, max_tokens) + _split_long(
+        sentence[half:], encoding, max_tokens
+    )
+
+
+def _is_boundary(sentence: str) -> bool:
+    digest = hashlib.sha256(sentence.strip().encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % SUMMARY_BOUNDARY_MODULUS == 0
+
+
+class MapReduceSummarizer:
+    """長い文章を分割して要約するクラス
+    Args:
+        model (Model): モデル設定
+        map_prompt (str): チャンクを要約するプロンプト ({text}にチャンクが入る)
+        reduce_prompt (str): 要約をまとめるプロンプト ({text}に要約が入る)
+        system_role (str | None): システムロール
+        chunk_tokens (int): チャンクのトークン数の上限
+        max_concurrency (int): 同時に要約するチャンク数
+        cache (ResponseCache | None): チャンクの要約のキャッシュ
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        map_prompt: str = DEFAULT_MAP_PROMPT,
+        reduce_prompt: str = DEFAULT_REDUCE_PROMPT,
+        system_role: str | None = None,
+        chunk_tokens: int = SUMMARY_CHUNK_TOKENS,
+        max_concurrency: int = SUMMARY_MAX_CONCURRENCY,
+        cache: ResponseCache | None = None,
+    ):
+        self.model = model
+        self.map_prompt = map_prompt
+        self.reduce_prompt = reduce_prompt
+        self.system_role = system_role
+        self.max_concurrency = max_concurrency
+        self.cache = cache if cache is not None else chunk_summary_cache
+        self.encoding = get_encoding(model.config.get("model_name", "gpt-3.5-turbo"))
+        self.chunk_tokens = min(chunk_tokens, self.input_budget(map_prompt))
+        self.hits = 0  # キャッシュを使ったチャンク数 (直近の要約)
+        self.misses = 0  # 要約したチャンク数 (直近の要約)
+
+    def input_budget(self, prompt: str) -> int:
+        """プロンプトに入れる文章に使えるトークン数
+        Args:
+            prompt (str): プロンプト
+        Returns:
+            int: トークン数
+        """
+        overhead = self.model.count_tokens_from_message(self._messages(prompt, ""))
+        return self.model.token_budget - overhead
+
+    def split(self, text: str) -> list[str]:
+        """文章をチャンクに分割する
+        Args:
+            text (str): 文章
+        Returns:
+            list[str]: チャンクのリスト
+        """
+        return chunk_text(text, self.encoding, self.chunk_tokens)
+
+    def summarize(
+        self,
+        text: str,
+        on_progress: Callable[[str, float], None] | None = None,
+    ) -> str:
+        """文章を要約する
+        Args:
+            text (str): 文章
+            on_progress (Callable[[str, float], None]): 進捗の通知 (段階名, 0.0〜1.0)
+        Returns:
+            str: 要約
+        """
+        self.hits = self.misses = 0
+        chunks = self.split(text)
+        if not chunks:
+            return ""
+        summaries = self._summarize_all(
+            self.map_prompt, chunks, "map", on_progress=on_progress
+        )
+        # トークン制限に収まる単位でまとめ、1つになるまで繰り返す
+        budget = self.input_budget(self.reduce_prompt)
+        for depth in range(SUMMARY_MAX_DEPTH):
+            if (len(summaries) == 1) and (len(chunks) == 1):
+                return summaries[0]
+            groups = self._group(summaries, budget)
+            # まとめられる要約がなく、分割した要約もない場合は段数を重ねても縮まない
+            if (len(groups) == len(summaries) > 1) and all(
+                len(group) == 1 for group in groups
+            ):
+                raise ValueError("Summaries are too long to fit in the token limit.")
+            summaries = self._summarize_all(
+                self.reduce_prompt,
+                [SUMMARY_SEPARATOR.join(group) for group in groups],
+                f"reduce{depth + 1}",
+                on_progress=on_progress,
+            )
+            if len(summaries) == 1:
+                return summaries[0]
+        raise ValueError("Too many reduce steps to summarize.")
+
+    # --------------------------------------------------------------------------
+    # 内部処理
+    # --------------------------------------------------------------------------
+    def _messages(self, prompt: str, text: str) -> list[dict[str, Any]]:
+        messages = [{"role": "user", "content": prompt.format(text=text)}]
+        if self.system_role:
+            messages.insert(0, {"role": "system", "content": self.system_role})
+        return messages
+
+    def _cache_key(self, prompt: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return make_cache_key(
+            self.model.type, dict(self.model.config), self.system_role, prompt, digest
+        )
+
+    def _group(self, summaries: list[str], budget: int) -> list[list[str]]:
+        """要約をトークン数の上限に収まるグループにまとめる
+        (1つで上限を超える要約は、上限に収まるチャンクに分割してからまとめる)
+        """
+        sep_tokens = len(self.encoding.encode(SUMMARY_SEPARATOR))
+        pieces: list[str] = []
+        for summary in summaries:
+            n = len(self.encoding.encode(summary, disallowed_special=())) + sep_tokens
+            if n > budget:
+                pieces += chunk_text(summary, self.encoding, budget - sep_tokens)
+            else:
+                pieces.append(summary)
+        groups: list[list[str]] = []
+        num_tokens = 0
+        for piece in pieces:
+            n = len(self.encoding.encode(piece, disallowed_special=())) + sep_tokens
+            if groups and (num_tokens + n <= budget):
+                groups[-1].append(piece)
+                num_tokens += n
+            else:
+                groups.append([piece])
+                num_tokens = n
+        return groups
+
+    def _summarize_all(
+        self,
+        prompt: str,
+        texts: list[str],
+        stage: str,
+        on_progress: Callable[[str, float], None] | None = None,
+    ) -> list[str]:
+        """文章ごとの要約を同時に実行する (キャッシュにある要約は再利用する)"""
+        keys = [self._cache_key(prompt, text) for text in texts]
+        results: list[str | None] = [self.cache.get(key) for key in keys]
+        missing = {i: texts[i] for i, result in enumerate(results) if result is None}
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            executor = BatchExecutor(
+                self.model,
+                system_role=self.system_role,
+                max_concurrency=self.max_concurrency,
+            )
+            prompts = {i: prompt.format(text=text) for i, text in missing.items()}
+            for result in executor.run(prompts):
+                if result.error is not None:
+                    executor.cancel()
+                    raise RuntimeError(f"Failed to summarize: {result.error}")
+                results[result.index] = result.output
+                self.cache.put(keys[result.index], result.output)
+                if on_progress is not None:
+                    on_progress(stage, executor.progress)
+        return results
+
+
+# チャンクの要約のキャッシュ (プロセス内で共有)
+chunk_summary_cache = ResponseCache(
+    max_entries=SUMMARY_CACHE_MAX_ENTRIES,
+    ttl=SUMMARY_CACHE_TTL,
+    dirpath=SUMMARY_CACHE_DIR,
+    name="summary",
+    filename="summary_cache.sqlite3",
+)
@@ -0,0 +1,209 @@
+"""sx_agentsのホットパスのベンチマーク用の設定
+
+実行方法:
+    pytest tests/benchmarks                       # ベースラインと比較 (なければ比較しない)
+    pytest tests/benchmarks --benchmark-save      # 今回の結果をベースラインとして保存
+    pytest tests/benchmarks --benchmark-fail      # 許容範囲を超えて遅くなった場合は失敗にする
+
+結果は各ベンチマークの実行時間 (中央値・最小・平均) と最大メモリ使用量をJSONで記録する
+最大メモリはtracemallocで計測するため、Pythonのヒープのみが対象 (PILの画素データは含まない)
+"""
+
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Any
+
+import pytest
+
+BENCHMARK_DIR = os.path.dirname(__file__)
+# ベースラインの保存先
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baseline.json")
+# 最新の結果の保存先
+LATEST_RESULT_PATH = os.path.join(BENCHMARK_DIR, ".results", "latest.json")
+
+_results: dict[str, dict[str, Any]] = {}
+_report_key = pytest.StashKey[tuple]()
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--benchmark-baseline",
+        default=DEFAULT_BASELINE_PATH,
+        help="比較するベースラインのJSONファイル",
+    )
+    group.addoption(
+        "--benchmark-save",
+        action="store_true",
+        help="今回の結果をベースラインとして保存する",
+    )
+    group.addoption(
+        "--benchmark-rounds",
+        type=int,
+        default=5,
+        help="1ベンチマークあたりの計測回数",
+    )
+    group.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=0.2,
+        help="遅くなったと判定する中央値の増加率",
+    )
+    group.addoption(
+        "--benchmark-fail",
+        action="store_true",
+        help="許容範囲を超えて遅くなった場合にテストを失敗にする",
+    )
+
+
+@pytest.fixture
+def benchmark(request) -> Callable[..., Any]:
+    """関数の実行時間と最大メモリ使用量を計測するフィクスチャ
+
+    benchmark(func, *args, setup=None, number=1, **kwargs)
+        setup: 毎回の計測前に呼ぶ関数 (計測には含めない)
+        number: 1回の計測で繰り返す回数 (時間は1回あたりに換算)
+    """
+    rounds = request.config.getoption("--benchmark-rounds")
+
+    def run(
+        func: Callable[..., Any],
+        *args: Any,
+        setup: Callable[[], Any] | None = None,
+        number: int = 1,
+        **kwargs: Any,
+    ) -> Any:
+        # ウォームアップ (キャッシュの作成など初回のみの処理を除く)
+        if setup is not None:
+            setup()
+        result = func(*args, **kwargs)
+
+        times = []
+        for _ in range(rounds):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            for _ in range(number):
+                func(*args, **kwargs)
+            times.append((time.perf_counter() - start) / number)
+
+        # tracemallocは実行を遅くするため時間の計測とは別に1回だけ実行
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        _results[request.node.name] = {
+            "median": statistics.median(times),
+            "min": min(times),
+            "mean": statistics.fmean(times),
+            "rounds": rounds,
+            "number": number,
+            "peak_memory": peak,
+        }
+        return result
+
+    return run
+
+
+def pytest_sessionfinish(session, exitstatus):
+    """結果を保存してベースラインと比較する"""
+    if not _results:
+        return
+    config = session.config
+    baseline_path = config.getoption("--benchmark-baseline")
+    tolerance = config.getoption("--benchmark-tolerance")
+    baseline = _load(baseline_path)
+
+    rows = []
+    regressions = []
+    for name, result in sorted(_results.items()):
+        base = baseline.get("results", {}).get(name)
+        time_ratio = mem_ratio = None
+        if base:
+            time_ratio = result["median"] / base["median"] if base["median"] else 1.0
+            if base["peak_memory"]:
+                mem_ratio = result["peak_memory"] / base["peak_memory"]
+            if time_ratio > 1.0 + tolerance:
+                regressions.append((name, time_ratio))
+        rows.append((name, result, time_ratio, mem_ratio))
+
+    data = {"machine": _machine_info(), "results": _results}
+    _dump(LATEST_RESULT_PATH, data)
+    # ソースツリーを汚さないよう、ベースラインは明示した場合のみ保存する
+    saved = config.getoption("--benchmark-save")
+    if saved:
+        _dump(baseline_path, data)
+    config.stash[_report_key] = (rows, regressions, baseline_path if saved else None)
+    if regressions and config.getoption("--benchmark-fail"):
+        session.exitstatus = pytest.ExitCode.TESTS_FAILED
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    report = config.stash.get(_report_key, None)
+    if report is None:
+        return
+    rows, regressions, saved_path = report
+    tr = terminalreporter
+    tr.section("benchmark")
+    tr.write_line(
+        f"{'name':<56} {'median':>10} {'peak mem':>10} {'vs base':>9} {'mem':>8}"
+    )
+    for name, result, time_ratio, mem_ratio in rows:
+        time_text = f"{time_ratio:.2f}x" if time_ratio is not None else ""
+        mem_text = f"{mem_ratio:.2f}x" if mem_ratio is not None else ""
+        tr.write_line(
+            f"{name:<56} {_format_time(result['median']):>10} "
+            f"{_format_bytes(result['peak_memory']):>10} {time_text:>9} {mem_text:>8}"
+        )
+    if saved_path:
+        tr.write_line(f"baseline saved: {saved_path}")
+    for name, ratio in regressions:
+        tr.write_line(f"REGRESSION {name}: {ratio:.2f}x slower than baseline", red=True)
+
+
+def _machine_info() -> dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _load(path: str) -> dict[str, Any]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _dump(path: str, data: dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+def _format_time(sec: float) -> str:
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if sec >= scale:
+            return f"{sec / scale:.2f}{unit}"
+    return f"{sec / 1e-9:.0f}ns"
+
+
+def _format_bytes(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GiB"
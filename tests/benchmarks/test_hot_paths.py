@@ -0,0 +1,170 @@
+"""1ターンごとに呼ばれる処理のベンチマーク"""
+
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageChops, ImageOps, ImageStat
+
+from sx_agents.utils import ChatMemory, ChatMessage, load_jsonc
+from sx_agents.utils.common import (
+    get_encoding,
+    get_normalized_pic_size,
+    image_url_cache,
+    num_tokens_from_messages,
+    to_normalized_pic,
+    to_thumbnail_pic,
+)
+
+CONFIG_PATH = os.path.join(
+    os.path.dirname(__file__), "../../app/streamlit/config.jsonc"
+)
+MODEL_NAME = "gpt-4o"
+TEXTS = {
+    "en": (
+        "The consultant reviewed the quarterly report and summarized the key risks, "
+        "the budget allocation for next year, and the open issues of each division. "
+    ),
+    "ja": (
+        "本日の会議では来期の事業計画と予算配分について議論し、"
+        "各部門の課題とリスクを整理したうえで次回までの対応方針を決めました。"
+    ),
+}
+IMAGE_SIZES = {"4k": (3840, 2160), "12mp": (4000, 3000)}
+
+
+# ------------------------------------------------------------------------------
+# 入力データ
+# ------------------------------------------------------------------------------
+@pytest.fixture(scope="session")
+def encoding():
+    # tiktokenのエンコーディングはキャッシュ済みの場合のみ利用できる (オフライン実行のため)
+    try:
+        return get_encoding(MODEL_NAME)
+    except Exception as e:  # pylint: disable=W0718
+        pytest.skip(f"tiktoken encoding is not available: {e}")
+
+
+def make_image(size: tuple[int, int]) -> Image.Image:
+    """写真に近い圧縮率になるよう、グラデーションにノイズを加えた画像を作成する"""
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 24)
+    return Image.merge("RGB", (gradient, noise, Image.blend(gradient, noise, 0.5)))
+
+
+@pytest.fixture(scope="module", params=list(IMAGE_SIZES))
+def large_image(request) -> Image.Image:
+    return make_image(IMAGE_SIZES[request.param])
+
+
+@pytest.fixture(scope="module")
+def large_jpeg(large_image) -> bytes:
+    """スマートフォンの写真に近いJPEGのバイト列"""
+    buffer = BytesIO()
+    large_image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_history(lang: str, num_messages: int) -> list[dict[str, str]]:
+    """システムロールとユーザ・アシスタントが交互に続く会話履歴を作成する"""
+    messages = [{"role": "system", "content": TEXTS[lang]}]
+    for i in range(num_messages - 1):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": f"{i}: " + TEXTS[lang] * 3})
+    return messages
+
+
+def make_memory(num_messages: int, with_images: bool) -> ChatMemory:
+    """会話履歴のメモリを作成する (画像ありの場合は10件に1件のユーザ発話に画像を付ける)"""
+    memory = ChatMemory(TEXTS["ja"])
+    image = make_image((1024, 768)) if with_images else None
+    for i in range(num_messages - 1):
+        if i % 2 == 0:
+            images = image if (image is not None) and (i % 10 == 0) else None
+            memory.append("user", f"{i}: " + TEXTS["ja"] * 3, images=images)
+        else:
+            memory.append_assistant(f"{i}: " + TEXTS["ja"] * 3)
+    return memory
+
+
+# ------------------------------------------------------------------------------
+# トークン数の計算
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("num_messages", [10, 100, 1000])
+@pytest.mark.parametrize("lang", ["ja", "en"])
+def test_num_tokens_from_messages(benchmark, encoding, lang, num_messages):
+    messages = make_history(lang, num_messages)
+    num_tokens = benchmark(num_tokens_from_messages, messages, model=MODEL_NAME)
+    assert num_tokens > num_messages
+
+
+# ------------------------------------------------------------------------------
+# メモリからのメッセージ取得
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("with_images", [False, True], ids=["text", "images"])
+def test_fetch_messages(benchmark, with_images):
+    memory = make_memory(100, with_images)
+    messages = benchmark(memory.fetch_messages, vision=True)
+    assert len(messages) == 100
+
+
+# ------------------------------------------------------------------------------
+# 画像の処理
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("cached", [False, True], ids=["cold", "warm"])
+def test_to_image_url(benchmark, large_image, cached):
+    message = ChatMessage("user", "この画像を説明してください。", images=large_image)
+
+    def setup():
+        if not cached:
+            image_url_cache.clear()
+
+    urls = benchmark(message.to_image_url, setup=setup)
+    assert urls[0].startswith("data:image/")
+
+
+def test_to_normalized_pic(benchmark, large_image):
+    image = benchmark(to_normalized_pic, large_image)
+    assert max(image.size) <= 2048
+
+
+def test_append_image(benchmark, large_jpeg):
+    """アップロードされたJPEGから送信用の画像とサムネイルを作成するまで"""
+
+    def append() -> ChatMessage:
+        message = ChatMessage("user", "この画像を説明してください。")
+        message.append_image(large_jpeg)
+        return message
+
+    message = benchmark(append)
+    assert max(message.image_sizes[0]) <= 2048
+    assert message.thumbnail_bytes
+
+
+def test_to_normalized_pic_matches_fit(large_jpeg):
+    """縮小デコードと整数倍の縮小を使っても全体をLANCZOSで縮小した結果とほぼ同じ"""
+    source = Image.open(BytesIO(large_jpeg))
+    source.load()
+    expected = ImageOps.fit(
+        source,
+        get_normalized_pic_size(*source.size),
+        method=Image.Resampling.LANCZOS,
+    )
+    image = to_normalized_pic(Image.open(BytesIO(large_jpeg)), draft=True)
+    assert image.size == expected.size
+    # 画素値の平均の差が1%程度 (ノイズの多い画像のため写真より差が出やすい)
+    diff = ImageStat.Stat(ImageChops.difference(image, expected)).mean
+    assert max(diff) < 3.0
+
+
+def test_to_thumbnail_pic(benchmark, large_image):
+    image = benchmark(to_thumbnail_pic, large_image)
+    assert image.height == 180
+
+
+# ------------------------------------------------------------------------------
+# 設定ファイルの読込
+# ------------------------------------------------------------------------------
+def test_load_jsonc(benchmark):
+    config = benchmark(load_jsonc, CONFIG_PATH, number=20)
+    assert "MODEL_CONFIG" in config
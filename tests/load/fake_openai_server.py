@@ -0,0 +1,325 @@
+"""負荷試験用のOpenAI互換 (Azure OpenAI) チャットAPIのスタブサーバ
+
+{base_url}/chat/completions へのリクエストに対して、設定した待ち時間と速度でトークンを返す
+エラー (500) とレート制限 (429) を指定した割合で発生させる
+
+実行方法:
+    python tests/load/fake_openai_server.py --port 8001 --ttft 0.8 --tokens-per-sec 40
+    AZURE_API_BASE=http://127.0.0.1:8001/v1 AZURE_API_KEY1=dummy make run
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+# 応答に使う単語 (日本語と英語を混ぜてトークン化の負荷を実際に近づける)
+WORDS = (
+    "本日は",
+    "ご質問",
+    "ありがとう",
+    "ございます。",
+    "結論から",
+    "申し上げると、",
+    "the ",
+    "report ",
+    "shows ",
+    "that ",
+    "売上",
+    "は",
+    "前年比",
+    "で",
+    "増加",
+    "しています。\n",
+)
+
+
+@dataclass
+class FakeServerConfig:
+    """スタブサーバの応答設定"""
+
+    ttft: float = 0.5  # 最初のトークンまでの待ち時間 (秒)
+    ttft_jitter: float = 0.2  # 待ち時間のばらつき (秒、一様分布)
+    tokens_per_sec: float = 50.0  # トークンの送信速度
+    response_tokens: int = 200  # 1回の応答のトークン数 (max_tokensが小さい場合はそちら)
+    error_rate: float = 0.0  # 500エラーを返す割合
+    rate_limit_rate: float = 0.0  # 429エラーを返す割合
+    retry_after: float = 1.0  # 429エラーのRetry-After (秒)
+
+
+@dataclass
+class FakeServerStats:
+    """スタブサーバの受信統計"""
+
+    requests: int = 0
+    completed: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    disconnected: int = 0  # 送信途中でクライアントが切断した数 (キャンセル)
+    inflight: int = 0
+    max_inflight: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def to_dict(self) -> dict[str, int]:
+        return {
+            f.name: getattr(self, f.name)
+            for f in fields(self)
+            if not f.name.startswith("_")
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-aliveで接続を再利用させる
+    server: "FakeOpenAIServer"
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+    def do_HEAD(self):  # pylint: disable=C0103
+        # 接続の事前確立 (Model.warmup) 用
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):  # pylint: disable=C0103
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "code": "404"}})
+            return
+        config, stats = self.server.config, self.server.stats
+        with stats._lock:  # pylint: disable=W0212
+            stats.requests += 1
+            stats.inflight += 1
+            stats.max_inflight = max(stats.max_inflight, stats.inflight)
+        try:
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                self._count("rate_limited")
+                self._send_json(
+                    429,
+                    {
+                        "error": {
+                            "message": "Rate limit is exceeded.",
+                            "type": "requests",
+                            "code": "429",
+                        }
+                    },
+                    {"Retry-After": str(config.retry_after)},
+                )
+                return
+            if roll < config.rate_limit_rate + config.error_rate:
+                self._count("errors")
+                self._send_json(
+                    500,
+                    {"error": {"message": "Internal server error.", "code": "500"}},
+                )
+                return
+            time.sleep(max(0.0, config.ttft + random.uniform(0, config.ttft_jitter)))
+            max_tokens = (
+                body.get("max_completion_tokens")
+                or body.get("max_tokens")
+                or config.response_tokens
+            )
+            num_tokens = min(config.response_tokens, max_tokens)
+            if body.get("stream"):
+                self._stream(body, num_tokens)
+            else:
+                self._complete(body, num_tokens)
+            self._count("completed")
+        except (BrokenPipeError, ConnectionResetError):
+            self._count("disconnected")
+            self.close_connection = True
+        finally:
+            with stats._lock:  # pylint: disable=W0212
+                stats.inflight -= 1
+
+    def _count(self, name: str) -> None:
+        stats = self.server.stats
+        with stats._lock:  # pylint: disable=W0212
+            setattr(stats, name, getattr(stats, name) + 1)
+
+    def _send_json(
+        self, status: int, data: dict[str, Any], headers: dict[str, str] | None = None
+    ) -> None:
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _complete(self, body: dict[str, Any], num_tokens: int) -> None:
+        time.sleep(num_tokens / self.server.config.tokens_per_sec)
+        text = "".join(WORDS[i % len(WORDS)] for i in range(num_tokens))
+        self._send_json(
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": _usage(body, num_tokens),
+            },
+        )
+
+    def _stream(self, body: dict[str, Any], num_tokens: int) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+        }
+        interval = 1.0 / self.server.config.tokens_per_sec
+        next_time = time.monotonic()
+        for i in range(num_tokens):
+            delta = {"content": WORDS[i % len(WORDS)]}
+            if i == 0:
+                delta["role"] = "assistant"
+            self._write_event(
+                base
+                | {"choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            )
+            next_time += interval
+            time.sleep(max(0.0, next_time - time.monotonic()))
+        self._write_event(
+            base | {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        )
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._write_event(base | {"choices": [], "usage": _usage(body, num_tokens)})
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_event(self, data: dict[str, Any]) -> None:
+        self._write_chunk(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def _usage(body: dict[str, Any], completion_tokens: int) -> dict[str, int]:
+    # プロンプトのトークン数は文字数からの概算
+    prompt_chars = len(json.dumps(body.get("messages", []), ensure_ascii=False))
+    prompt_tokens = prompt_chars // 3
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """OpenAI互換のチャットAPIのスタブサーバ
+    Args:
+        host (str): 待ち受けるアドレス
+        port (int): ポート番号 (0の場合は空いているポート)
+        config (FakeServerConfig): 応答設定
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        config: FakeServerConfig | None = None,
+    ):
+        super().__init__((host, port), _Handler)
+        self.config = config or FakeServerConfig()
+        self.stats = FakeServerStats()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        """クライアントに設定するbase_url"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        """別スレッドで起動する"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """停止する"""
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    """スタブサーバの応答設定のコマンドライン引数を追加する"""
+    defaults = FakeServerConfig()
+    parser.add_argument("--ttft", type=float, default=defaults.ttft)
+    parser.add_argument("--ttft-jitter", type=float, default=defaults.ttft_jitter)
+    parser.add_argument(
+        "--tokens-per-sec", type=float, default=defaults.tokens_per_sec
+    )
+    parser.add_argument(
+        "--response-tokens", type=int, default=defaults.response_tokens
+    )
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=defaults.rate_limit_rate
+    )
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+
+
+def server_config_from_args(args: argparse.Namespace) -> FakeServerConfig:
+    """コマンドライン引数から応答設定を作成する"""
+    return FakeServerConfig(
+        ttft=args.ttft,
+        ttft_jitter=args.ttft_jitter,
+        tokens_per_sec=args.tokens_per_sec,
+        response_tokens=args.response_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = FakeOpenAIServer(args.host, args.port, server_config_from_args(args))
+    print(f"fake OpenAI server: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats.to_dict()))
+
+
+if __name__ == "__main__":
+    main()
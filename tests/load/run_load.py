@@ -0,0 +1,329 @@
+"""1インスタンスで同時に会話するセッション数の負荷試験
+
+スタブサーバ (fake_openai_server.py) を起動し、N個のセッションが並行して複数ターンの会話を行う
+各ターンのTTFTと応答完了までの時間、プロセスのCPU時間とRSSを集計する
+
+モード:
+    headless : プラグインと同じ処理 (ChatMemory → Model → astream) をStreamlitなしで実行
+    streamlit: streamlit.testing.v1.AppTestでmain.pyをセッションごとに実行
+               (画面描画を含めた応答時間のみ計測し、画像の送信とTTFTは対象外)
+
+実行方法:
+    python tests/load/run_load.py --sessions 80 --turns 5 --image-ratio 0.2
+    python tests/load/run_load.py --mode streamlit --sessions 20 --rate-limit-rate 0.05
+
+カセット (sx_agents/utils/cassette.py) で実際のAPIの応答を記録し、ネットワークなしで再生する
+(再生時は記録時と同じセッション数・ターン数を指定する):
+    AZURE_API_BASE=... python tests/load/run_load.py --cassette-mode record --sessions 20
+    python tests/load/run_load.py --cassette-mode replay --cassette-speed 0 --sessions 20
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(__file__))
+
+# pylint: disable=C0413
+from fake_openai_server import (  # noqa: E402
+    FakeOpenAIServer,
+    add_server_arguments,
+    server_config_from_args,
+)
+
+CONFIG_PATH = os.path.join(ROOT_DIR, "app/streamlit/config.jsonc")
+MAIN_PATH = os.path.join(ROOT_DIR, "app/streamlit/main.py")
+PROMPTS = (
+    "来期の事業計画のポイントを3つに整理してください。",
+    "Summarize the main risks in the quarterly report.",
+    "先ほどの回答を踏まえて、追加で確認すべき事項はありますか？",
+    "この内容を役員向けに短くまとめ直してください。",
+)
+
+
+@dataclass
+class TurnResult:
+    """1ターンの計測結果"""
+
+    session: int
+    turn: int
+    with_image: bool
+    ttft: float | None = None  # 送信から最初の差分の受信まで
+    latency: float | None = None  # 送信から応答完了まで
+    error: str | None = None
+
+
+@dataclass
+class ResourceSampler:
+    """プロセスのRSSを定期的に記録するスレッド"""
+
+    interval: float = 0.2
+    peak_rss: int = 0
+    samples: list[int] = field(default_factory=list)
+    _stop: threading.Event = field(default_factory=threading.Event)
+
+    def start(self) -> "ResourceSampler":
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            self.samples.append(rss)
+            self.peak_rss = max(self.peak_rss, rss)
+
+
+def current_rss() -> int:
+    """現在のRSS (バイト)"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Linux以外は最大RSSで代用
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpu_seconds() -> float:
+    """プロセスのCPU時間 (ユーザ + システム)"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """線形補間のパーセンタイル"""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+# ------------------------------------------------------------------------------
+# セッションの実行
+# ------------------------------------------------------------------------------
+def run_headless_session(
+    index: int, args: argparse.Namespace, results: list[TurnResult]
+) -> None:
+    """プラグインと同じ処理でStreamlitなしに会話する"""
+    # pylint: disable=C0415
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+    from PIL import Image
+
+    from sx_agents.utils import ChatMemory, Model, load_jsonc
+    from sx_agents.utils.common import AsyncStream, coalesce_stream
+
+    config = load_jsonc(CONFIG_PATH)
+    model = Model(name=args.model, **config["MODEL_CONFIG"][args.model])
+    memory = ChatMemory(config["SYSTEM_ROLE"])
+    rng = random.Random(index)
+    for turn in range(args.turns):
+        with_image = model.vision and (rng.random() < args.image_ratio)
+        # カセットのキーが一致するよう画像はセッションごとに同じ内容にする
+        image = (
+            Image.frombytes("RGB", (1280, 960), rng.randbytes(1280 * 960 * 3))
+            if with_image
+            else None
+        )
+        prompt = PROMPTS[(index + turn) % len(PROMPTS)]
+        result = TurnResult(index, turn, with_image)
+        start = time.perf_counter()
+        try:
+            message = memory.create_message("user", prompt, image)
+            messages, _ = model.prompt_with_memory(memory, message, vision=with_image)
+            chain = (
+                ChatPromptTemplate.from_messages(messages)
+                | model.create_langchain_chat()
+                | StrOutputParser()
+            )
+            chunks = []
+            for chunk in coalesce_stream(AsyncStream(lambda: chain.astream({}))):
+                if result.ttft is None:
+                    result.ttft = time.perf_counter() - start
+                chunks.append(chunk)
+            result.latency = time.perf_counter() - start
+            memory.append_message(message)
+            memory.append_assistant("".join(chunks))
+        except Exception as e:  # pylint: disable=W0718
+            result.error = type(e).__name__
+        results.append(result)
+        time.sleep(rng.uniform(0, args.think_time))
+
+
+def run_streamlit_session(
+    index: int, args: argparse.Namespace, results: list[TurnResult]
+) -> None:
+    """AppTestでmain.pyを実行して会話する"""
+    from streamlit.testing.v1 import AppTest  # pylint: disable=C0415
+
+    app = AppTest.from_file(MAIN_PATH, default_timeout=args.timeout)
+    app.run()
+    rng = random.Random(index)
+    for turn in range(args.turns):
+        prompt = PROMPTS[(index + turn) % len(PROMPTS)]
+        result = TurnResult(index, turn, with_image=False)
+        start = time.perf_counter()
+        try:
+            app.chat_input[0].set_value(prompt).run()
+            if app.exception:
+                raise RuntimeError(app.exception[0].message)
+            result.latency = time.perf_counter() - start
+        except Exception as e:  # pylint: disable=W0718
+            result.error = type(e).__name__
+        results.append(result)
+        time.sleep(rng.uniform(0, args.think_time))
+
+
+# ------------------------------------------------------------------------------
+# 集計
+# ------------------------------------------------------------------------------
+def summarize(
+    results: list[TurnResult],
+    args: argparse.Namespace,
+    elapsed: float,
+    cpu: float,
+    rss_before: int,
+    sampler: ResourceSampler,
+    server_stats: dict[str, int],
+) -> dict[str, Any]:
+    ok = [r for r in results if r.error is None]
+
+    def stats(values: list[float]) -> dict[str, float | None]:
+        return {f"p{q}": percentile(values, q) for q in (50, 95, 99)}
+
+    return {
+        "mode": args.mode,
+        "model": args.model,
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "elapsed_sec": elapsed,
+        "turns_ok": len(ok),
+        "turns_failed": len(results) - len(ok),
+        "errors": dict(Counter(r.error for r in results if r.error)),
+        "turns_per_sec": len(ok) / elapsed if elapsed else None,
+        "ttft_sec": stats([r.ttft for r in ok if r.ttft is not None]),
+        "latency_sec": stats([r.latency for r in ok if r.latency is not None]),
+        "latency_with_image_sec": stats(
+            [r.latency for r in ok if r.with_image and r.latency is not None]
+        ),
+        "cpu_sec_total": cpu,
+        "cpu_sec_per_session": cpu / args.sessions,
+        "rss_before_mib": rss_before / 2**20,
+        "rss_peak_mib": sampler.peak_rss / 2**20,
+        "rss_per_session_mib": max(0, sampler.peak_rss - rss_before)
+        / 2**20
+        / args.sessions,
+        "server": server_stats,
+    }
+
+
+def print_report(report: dict[str, Any]) -> None:
+    def fmt(value: float | None, scale: float = 1000.0, unit: str = "ms") -> str:
+        return "-" if value is None else f"{value * scale:.0f}{unit}"
+
+    print(
+        f"\n{report['mode']} / {report['model']}: {report['sessions']} sessions x "
+        f"{report['turns_per_session']} turns in {report['elapsed_sec']:.1f}s"
+    )
+    print(
+        f"turns ok {report['turns_ok']}, failed {report['turns_failed']} "
+        f"{report['errors'] or ''}"
+    )
+    print(f"{'':<18}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for key in ("ttft_sec", "latency_sec", "latency_with_image_sec"):
+        values = report[key]
+        print(
+            f"{key:<18}{fmt(values['p50']):>10}{fmt(values['p95']):>10}"
+            f"{fmt(values['p99']):>10}"
+        )
+    print(
+        f"CPU {report['cpu_sec_total']:.1f}s "
+        f"({report['cpu_sec_per_session']:.2f}s/session), "
+        f"RSS peak {report['rss_peak_mib']:.0f}MiB "
+        f"(+{report['rss_per_session_mib']:.1f}MiB/session)"
+    )
+    print(f"server {report['server']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["headless", "streamlit"], default="headless")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--image-ratio", type=float, default=0.0)
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="全セッション開始までの秒数")
+    parser.add_argument("--think-time", type=float, default=1.0, help="ターン間の最大待ち時間")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument(
+        "--cassette-mode",
+        choices=["record", "replay"],
+        help="応答をカセットに記録する / カセットから再生する",
+    )
+    parser.add_argument("--cassette-dir", default="tests/load/cassettes")
+    parser.add_argument(
+        "--cassette-speed", type=float, default=1.0, help="再生速度の倍率 (0: 待ち時間なし)"
+    )
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(config=server_config_from_args(args)).start()
+    # config.jsoncのsecret_keysが参照する環境変数をスタブサーバに向ける
+    # (カセットの記録時にAZURE_API_BASEが設定されている場合は実際のAPIを使う)
+    if args.cassette_mode != "record" or "AZURE_API_BASE" not in os.environ:
+        os.environ["AZURE_API_BASE"] = server.base_url
+    os.environ.setdefault("AZURE_API_KEY1", "dummy")
+    os.environ.setdefault("AZURE_API_KEY2", "dummy")
+    if args.cassette_mode:
+        # Model.create_langchain_chatが環境変数から読み込む
+        os.environ["LLM_CASSETTE_MODE"] = args.cassette_mode
+        os.environ["LLM_CASSETTE_DIR"] = args.cassette_dir
+        os.environ["LLM_CASSETTE_SPEED"] = str(args.cassette_speed)
+
+    target = run_headless_session if args.mode == "headless" else run_streamlit_session
+    results: list[TurnResult] = []
+    threads = [
+        threading.Thread(target=target, args=(i, args, results), daemon=True)
+        for i in range(args.sessions)
+    ]
+    rss_before = current_rss()
+    sampler = ResourceSampler().start()
+    cpu_before = cpu_seconds()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+        time.sleep(args.ramp_up / max(1, args.sessions))
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu_before
+    sampler.stop()
+    server.stop()
+
+    report = summarize(
+        results, args, elapsed, cpu, rss_before, sampler, server.stats.to_dict()
+    )
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""行ごとのプロンプトのバッチ実行 (RateLimiter / BatchExecutor) のテスト"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+import openai
+import pandas as pd
+import pytest
+from langchain_core.messages import AIMessage
+
+from sx_agents.utils import Model, load_jsonc
+from sx_agents.utils import batch as batch_module
+from sx_agents.utils.batch import BatchExecutor, RateLimiter, _backoff
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+sys.path.insert(0, os.path.join(ROOT_DIR, "tests/load"))
+
+# pylint: disable=C0413
+from fake_openai_server import FakeOpenAIServer, FakeServerConfig  # noqa: E402
+
+CONFIG_PATH = os.path.join(ROOT_DIR, "app/streamlit/config.jsonc")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.monotonic()とasyncio.sleep()を実際に待たずに進める時計"""
+    now = [1_000.0]
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(batch_module.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(batch_module.asyncio, "sleep", sleep)
+    return now, sleeps
+
+
+# ------------------------------------------------------------------------------
+# RateLimiter
+# ------------------------------------------------------------------------------
+def test_rate_limiter_waits_for_requests(clock):
+    _, sleeps = clock
+    limiter = RateLimiter(rpm=2)
+
+    async def acquire_three():
+        for _ in range(3):
+            await limiter.acquire(0)
+
+    asyncio.run(acquire_three())
+    # 3回目は1リクエスト分が貯まる30秒を待つ
+    assert sleeps == [pytest.approx(30.0)]
+
+
+def test_rate_limiter_wait_time_for_tokens(clock):
+    now, _ = clock
+    limiter = RateLimiter(tpm=600)
+    asyncio.run(limiter.acquire(600))
+    assert limiter._wait_time(300) == pytest.approx(30.0)  # pylint: disable=W0212
+    now[0] += 10.0
+    assert limiter._wait_time(300) == pytest.approx(20.0)  # pylint: disable=W0212
+    # 上限を超えるリクエストは上限まで貯まれば通す
+    asyncio.run(limiter.acquire(10_000))
+    assert limiter._tokens == pytest.approx(0.0)  # pylint: disable=W0212
+
+
+def test_rate_limiter_refund(clock):
+    limiter = RateLimiter(tpm=600)
+    asyncio.run(limiter.acquire(600))
+    limiter.refund(300)
+    assert limiter._wait_time(300) == 0.0  # pylint: disable=W0212
+    # 見積もりより多く使った場合は追加で消費する
+    limiter.refund(-300)
+    assert limiter._wait_time(300) == pytest.approx(30.0)  # pylint: disable=W0212
+    # 上限を超えては戻さない
+    limiter.refund(10_000)
+    assert limiter._tokens == 600  # pylint: disable=W0212
+
+
+def test_rate_limiter_penalize_blocks_for_seconds(clock):
+    limiter = RateLimiter(rpm=60, tpm=600)
+    asyncio.run(limiter.acquire(100))
+    limiter.penalize(10.0)
+    # バケットが空になり、指定の秒数が経ってから1リクエスト分が貯まる
+    assert limiter._wait_time(0) == pytest.approx(11.0)  # pylint: disable=W0212
+    assert limiter._wait_time(100) == pytest.approx(20.0)  # pylint: disable=W0212
+
+
+# ------------------------------------------------------------------------------
+# _backoff
+# ------------------------------------------------------------------------------
+def rate_limit_error(headers: dict[str, str]) -> openai.RateLimitError:
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return openai.RateLimitError(
+        "Rate limit is exceeded.", response=response, body=None
+    )
+
+
+def test_backoff_follows_retry_after():
+    assert _backoff(0, rate_limit_error({"Retry-After": "3"})) == 3.0
+    assert _backoff(0, rate_limit_error({"Retry-After": "3600"})) == 60.0
+
+
+def test_backoff_is_exponential_with_jitter():
+    for attempt in range(4):
+        delay = _backoff(attempt, rate_limit_error({"Retry-After": "soon"}))
+        assert 2**attempt * 0.5 <= delay <= 2**attempt
+    assert _backoff(20, ValueError()) <= 60.0
+
+
+# ------------------------------------------------------------------------------
+# BatchExecutor
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def model(monkeypatch) -> Model:
+    config = load_jsonc(CONFIG_PATH)
+    monkeypatch.setenv("AZURE_API_KEY1", "dummy")
+    monkeypatch.delenv("LLM_CASSETTE_MODE", raising=False)
+    return Model(name="gpt-4o", **config["MODEL_CONFIG"]["gpt-4o"])
+
+
+def serve(monkeypatch, **config) -> FakeOpenAIServer:
+    defaults = {"ttft": 0.0, "ttft_jitter": 0.0, "response_tokens": 5}
+    server = FakeOpenAIServer(config=FakeServerConfig(**(defaults | config)))
+    server.start()
+    monkeypatch.setenv("AZURE_API_BASE", server.base_url)
+    return server
+
+
+def make_df(rows: int = 60, unique: int = 20) -> pd.DataFrame:
+    return pd.DataFrame({"質問": [f"質問{i % unique}" for i in range(rows)]})
+
+
+def test_runs_each_unique_prompt_once(monkeypatch, model, tmp_path):
+    server = serve(monkeypatch)
+    try:
+        executor = BatchExecutor(model, checkpoint_path=str(tmp_path / "sheet.ckpt"))
+        df = make_df()
+        results = list(executor.run_dataframe(df, "{質問}に答えてください", "回答"))
+    finally:
+        server.stop()
+    assert len(results) == 60
+    assert sorted(r.index for r in results) == list(range(60))
+    assert all(r.error is None and r.output for r in results)
+    # 同じプロンプトの行は1回だけ送信し、残りは同じ結果を使う
+    assert server.stats.requests == 20
+    assert sum(not r.cached for r in results) == 20
+    assert df["回答"].notna().all()
+    assert executor.progress == 1.0
+
+
+def test_rerun_restores_from_checkpoint(monkeypatch, model, tmp_path):
+    checkpoint_path = str(tmp_path / "sheet.ckpt")
+    server = serve(monkeypatch)
+    try:
+        first = make_df()
+        list(
+            BatchExecutor(model, checkpoint_path=checkpoint_path).run_dataframe(
+                first, "{質問}に答えてください", "回答"
+            )
+        )
+        second = make_df()
+        results = list(
+            BatchExecutor(model, checkpoint_path=checkpoint_path).run_dataframe(
+                second, "{質問}に答えてください", "回答"
+            )
+        )
+    finally:
+        server.stop()
+    assert server.stats.requests == 20
+    assert len(results) == 60
+    assert all(r.cached for r in results)
+    assert second["回答"].equals(first["回答"])
+
+
+def test_client_parameters_are_part_of_the_key(monkeypatch, model, tmp_path):
+    checkpoint_path = str(tmp_path / "sheet.ckpt")
+    server = serve(monkeypatch)
+    try:
+        for temperature in (0.0, 1.0):
+            executor = BatchExecutor(
+                model, checkpoint_path=checkpoint_path, temperature=temperature
+            )
+            results = list(executor.run({0: "こんにちは"}))
+    finally:
+        server.stop()
+    assert server.stats.requests == 2
+    assert not results[0].cached
+
+
+def test_failed_rows_are_written_as_errors(monkeypatch, model, tmp_path):
+    server = serve(monkeypatch, error_rate=1.0)
+    csv_path = str(tmp_path / "out.csv")
+    try:
+        executor = BatchExecutor(
+            model, checkpoint_path=str(tmp_path / "sheet.ckpt"), max_retries=0
+        )
+        df = make_df(rows=4, unique=2)
+        results = list(executor.run_dataframe(df, "{質問}", "回答", csv_path))
+    finally:
+        server.stop()
+    assert all(r.output is None and r.error for r in results)
+    assert df["回答"].str.startswith("ERROR: InternalServerError").all()
+    assert pd.read_csv(csv_path, index_col=0, encoding="utf-8-sig")["回答"].equals(
+        df["回答"]
+    )
+    # 失敗した行はチェックポイントに残さない
+    server = serve(monkeypatch)
+    try:
+        results = list(
+            BatchExecutor(model, checkpoint_path=str(tmp_path / "sheet.ckpt")).run(
+                {0: "質問0"}
+            )
+        )
+    finally:
+        server.stop()
+    assert results[0].error is None
+    assert not results[0].cached
+
+
+def test_unexpected_error_fails_only_its_row(monkeypatch, model, tmp_path):
+    class BrokenChat:
+        """特定のプロンプトだけ想定外のエラーを送出するクライアント"""
+
+        async def ainvoke(self, messages):
+            if "壊れた" in messages[-1]["content"]:
+                raise KeyError("choices")
+            return AIMessage(content="回答")
+
+    monkeypatch.setattr(Model, "create_langchain_chat", lambda *_, **__: BrokenChat())
+    executor = BatchExecutor(model, checkpoint_path=str(tmp_path / "sheet.ckpt"))
+    prompts = {0: "質問0", 1: "壊れた質問", 2: "質問2", 3: "壊れた質問"}
+    results = sorted(executor.run(prompts), key=lambda r: r.index)
+    assert [r.output for r in results] == ["回答", None, "回答", None]
+    assert results[1].error == results[3].error == "KeyError: 'choices'"
+    assert executor.progress == 1.0
@@ -0,0 +1,140 @@
+"""レスポンスのキャッシュ (ResponseCache / SimilarResponseCache) のテスト"""
+
+import pytest
+
+from sx_agents.utils import cache as cache_module
+from sx_agents.utils.cache import (
+    ResponseCache,
+    SimilarResponseCache,
+    make_cache_key,
+    normalize_prompt,
+)
+from sx_agents.utils.metrics import CACHE_REQUESTS
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.time()を進められる時計"""
+    now = [1_000_000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    return now
+
+
+# ------------------------------------------------------------------------------
+# ResponseCache
+# ------------------------------------------------------------------------------
+def test_make_cache_key_is_stable():
+    a = make_cache_key("azure", {"b": 1, "a": 2}, [{"role": "user", "content": "x"}])
+    b = make_cache_key("azure", {"a": 2, "b": 1}, [{"role": "user", "content": "x"}])
+    assert a == b
+    assert a != make_cache_key("azure", {"a": 2, "b": 1}, [])
+
+
+def test_response_cache_expires_after_ttl(clock):
+    cache = ResponseCache(ttl=10.0)
+    cache.put("key", "value")
+    clock[0] += 9.0
+    assert cache.get("key") == "value"
+    clock[0] += 2.0
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+def test_response_cache_evicts_least_recently_used(clock):
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"  # aを最近使ったものにする
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+def test_response_cache_counts_hits_and_misses(clock):
+    cache = ResponseCache()
+    cache.get("missing")
+    cache.put("key", "value")
+    cache.get("key")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_response_cache_reads_from_disk(tmp_path, clock):
+    ResponseCache(dirpath=str(tmp_path)).put("key", "value")
+    # 別のインスタンス (再起動後のプロセス) からも読める
+    assert ResponseCache(dirpath=str(tmp_path)).get("key") == "value"
+
+
+def test_named_cache_has_own_file_and_metrics_label(tmp_path, clock):
+    def count(cache: str, result: str) -> float:
+        labels = f'{{cache="{cache}",result="{result}"}}'
+        return {label: value for _, label, value in CACHE_REQUESTS.samples()}.get(
+            labels, 0
+        )
+
+    before = count("summary", "hit"), count("summary", "miss"), count("response", "hit")
+    cache = ResponseCache(
+        dirpath=str(tmp_path), name="summary", filename="summary_cache.sqlite3"
+    )
+    cache.put("key", "value")
+    cache.get("key")
+    cache.get("missing")
+    assert (tmp_path / "summary_cache.sqlite3").exists()
+    assert not (tmp_path / "response_cache.sqlite3").exists()
+    assert ResponseCache(dirpath=str(tmp_path)).get("key") is None
+    after = count("summary", "hit"), count("summary", "miss"), count("response", "hit")
+    assert after == (before[0] + 1, before[1] + 1, before[2])
+
+
+# ------------------------------------------------------------------------------
+# SimilarResponseCache
+# ------------------------------------------------------------------------------
+PROMPT = "東京の今日の天気と、明日の天気の見通しを詳しく教えてください。"
+
+
+def test_normalize_prompt_ignores_width_case_and_punctuation():
+    assert normalize_prompt("ＡＢＣ、 abc！") == normalize_prompt("abc abc")
+
+
+def test_similar_cache_hits_on_variant_wording(clock):
+    cache = SimilarResponseCache(threshold=0.5)
+    cache.put("ns", PROMPT, "晴れです")
+    hit = cache.lookup(
+        "ns", "東京の今日の天気と、明日の天気の見通しを詳しく教えて下さい"
+    )
+    assert hit is not None
+    assert hit.response == "晴れです"
+    assert 0.5 <= hit.similarity < 1.0
+
+
+def test_similar_cache_exact_match_after_normalization(clock):
+    cache = SimilarResponseCache()
+    cache.put("ns", PROMPT, "晴れです")
+    hit = cache.lookup("ns", PROMPT.replace("、", " "))
+    assert hit is not None
+    assert hit.similarity == 1.0
+
+
+def test_similar_cache_respects_threshold(clock):
+    cache = SimilarResponseCache(threshold=0.5)
+    cache.put("ns", PROMPT, "晴れです")
+    variant = "東京の今日の天気と、明日の天気の見通しを詳しく教えて下さい"
+    similarity = cache.lookup("ns", variant).similarity
+    assert cache.lookup("ns", variant, threshold=similarity + 0.01) is None
+
+
+def test_similar_cache_misses_unrelated_prompt_and_namespace(clock):
+    cache = SimilarResponseCache()
+    cache.put("ns", PROMPT, "晴れです")
+    assert cache.lookup("ns", "Pythonでリストを逆順に並べ替える方法は？") is None
+    assert cache.lookup("other", PROMPT) is None
+    assert cache.hit_rate == 0.0
+
+
+def test_similar_cache_expires_and_evicts(clock):
+    cache = SimilarResponseCache(max_entries=1, ttl=10.0)
+    cache.put("ns", PROMPT, "1")
+    clock[0] += 11.0
+    assert cache.lookup("ns", PROMPT) is None
+    cache.put("ns", "別の質問です。大阪の天気を教えてください。", "2")
+    assert len(cache) == 1
@@ -0,0 +1,82 @@
+"""LLMの応答の記録・再生 (CassetteChatModel) のテスト"""
+
+import asyncio
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+
+from sx_agents.utils.cassette import CassetteChatModel, CassetteConfig
+
+MESSAGES = [HumanMessage(content="こんにちは")]
+
+
+class RecordingHandler(BaseCallbackHandler):
+    """呼び出されたコールバックを記録する"""
+
+    def __init__(self):
+        self.starts = []
+        self.tokens = []
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.starts.append(kwargs.get("invocation_params") or {})
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        self.tokens.append(token)
+
+
+def make_model(tmp_path, mode: str, inner_handler=None) -> CassetteChatModel:
+    inner = None
+    if mode == "record":
+        inner = GenericFakeChatModel(
+            messages=iter([AIMessage(content="晴れ のち 曇り")]),
+            callbacks=[inner_handler] if inner_handler else None,
+        )
+    return CassetteChatModel(
+        cassette=CassetteConfig(mode, dirpath=str(tmp_path), speed=0),
+        model_name="gpt-4o",
+        inner=inner,
+    )
+
+
+def test_record_and_replay(tmp_path):
+    inner_handler, handler = RecordingHandler(), RecordingHandler()
+    recorder = make_model(tmp_path, "record", inner_handler)
+    chunks = [
+        c.content for c in recorder.stream(MESSAGES, config={"callbacks": [handler]})
+    ]
+    assert "".join(chunks) == "晴れ のち 曇り"
+    # 実際のクライアントは公開APIで呼ばれ、そのコールバックも動く
+    assert len(inner_handler.starts) == 1
+    assert "".join(inner_handler.tokens) == "晴れ のち 曇り"
+    # 呼び出し元のコールバックには1回の呼び出しとして通知し、モデル名で集計できる
+    assert [params["model_name"] for params in handler.starts] == ["gpt-4o"]
+    assert "".join(handler.tokens) == "晴れ のち 曇り"
+
+    player = make_model(tmp_path, "replay")
+    assert [c.content for c in player.stream(MESSAGES)] == chunks
+    assert player.invoke(MESSAGES).content == "晴れ のち 曇り"
+
+
+def test_async_record_saves_off_the_event_loop(tmp_path, monkeypatch):
+    save = CassetteChatModel._save  # pylint: disable=W0212
+    threads = []
+
+    def record_thread(self, key, chunks):
+        threads.append(threading.get_ident())
+        save(self, key, chunks)
+
+    monkeypatch.setattr(CassetteChatModel, "_save", record_thread)
+
+    async def main():
+        recorder = make_model(tmp_path, "record")
+        text = "".join([c.content async for c in recorder.astream(MESSAGES)])
+        return text, threading.get_ident()
+
+    text, loop_thread = asyncio.run(main())
+    assert text == "晴れ のち 曇り"
+    assert threads and threads[0] != loop_thread
+
+    player = make_model(tmp_path, "replay")
+    assert asyncio.run(player.ainvoke(MESSAGES)).content == "晴れ のち 曇り"
@@ -0,0 +1,110 @@
+"""メッセージのディスク退避 (ChatMessage.spill / unspill, DiskStore) のテスト"""
+
+import gc
+import os
+
+import pandas as pd
+from PIL import Image
+
+from sx_agents.utils import ChatMemory, ChatMessage
+from sx_agents.utils.memory import SPILL_MIN_CONTENT_BYTES
+from sx_agents.utils.storage import DiskStore
+
+LONG_TEXT = "長い本文です。" * SPILL_MIN_CONTENT_BYTES
+
+
+def make_message() -> ChatMessage:
+    image = Image.new("RGB", (64, 48), (200, 100, 50))
+    metadata = [pd.DataFrame({"a": [1, 2, 3]})]
+    return ChatMessage("user", LONG_TEXT, images=image, metadata=metadata)
+
+
+def test_spill_and_unspill_round_trip(tmp_path):
+    store = DiskStore(str(tmp_path))
+    message = make_message()
+    images = message.image_bytes
+    thumbnails = message.thumbnail_bytes
+    nbytes = message.nbytes
+
+    freed = message.spill(store)
+    assert freed > 0
+    assert message.nbytes < nbytes
+    # 退避中も参照するとディスクから読み込まれる
+    assert message.content == LONG_TEXT
+    assert message.image_bytes == images
+    assert message.thumbnail_bytes == thumbnails
+    assert message.metadata[0].equals(pd.DataFrame({"a": [1, 2, 3]}))
+
+    message.unspill()
+    assert message.nbytes == nbytes
+    assert message.content == LONG_TEXT
+    assert message.image_bytes == images
+    store.close()
+
+
+def test_short_content_stays_in_memory(tmp_path):
+    store = DiskStore(str(tmp_path))
+    message = ChatMessage("user", "短い本文")
+    assert message.spill(store) == 0
+    assert message.content == "短い本文"
+    store.close()
+
+
+def test_spill_threshold_counts_utf8_bytes(tmp_path):
+    store = DiskStore(str(tmp_path))
+    # 文字数は閾値の半分でも、UTF-8では閾値を超える日本語の本文は退避する
+    japanese = ChatMessage("user", "あ" * (SPILL_MIN_CONTENT_BYTES // 2))
+    ascii_ = ChatMessage("user", "a" * (SPILL_MIN_CONTENT_BYTES // 2))
+    assert japanese.spill(store) > 0
+    assert ascii_.spill(store) == 0
+    assert japanese.content == "あ" * (SPILL_MIN_CONTENT_BYTES // 2)
+    store.close()
+
+
+def test_spilled_data_is_deleted_with_message(tmp_path):
+    store = DiskStore(str(tmp_path))
+    message = make_message()
+    message.spill(store)
+    key = message._spill_key  # pylint: disable=W0212
+    store.get(f"{key}:content")
+    del message
+    gc.collect()
+    for name in ("content", "images", "thumbnails", "metadata"):
+        try:
+            store.get(f"{key}:{name}")
+        except KeyError:
+            continue
+        raise AssertionError(f"{name} was not deleted")
+    store.close()
+
+
+def test_memory_spills_old_messages_over_limit(tmp_path):
+    memory = ChatMemory(system_role="system", max_bytes=1024, spill_dir=str(tmp_path))
+    for i in range(3):
+        memory.append_user(f"{i}{LONG_TEXT}")
+    # 古いメッセージの本文は退避され、最新のメッセージはメモリに残る
+    assert memory.messages[1].nbytes < len(LONG_TEXT)
+    assert memory.messages[-1].nbytes > len(LONG_TEXT)
+    # システムロールと最新のメッセージは退避しない
+    assert memory.messages[0].content == "system"
+    assert [m.content[0] for m in memory.messages[1:]] == ["0", "1", "2"]
+
+
+def test_temporary_store_file_is_removed_by_finalizer(tmp_path):
+    store = DiskStore(str(tmp_path))
+    filepath = store.filepath
+    store.put("key", {"value": 1})
+    assert store.get("key") == {"value": 1}
+    assert os.path.exists(filepath)
+    del store
+    gc.collect()
+    assert not os.path.exists(filepath)
+
+
+def test_persistent_store_file_is_kept(tmp_path):
+    filepath = str(tmp_path / "store.sqlite3")
+    store = DiskStore(filepath=filepath)
+    store.put("key", "value")
+    store.close()
+    assert os.path.exists(filepath)
+    assert DiskStore(filepath=filepath).get("key") == "value"
@@ -0,0 +1,100 @@
+"""メトリクス (Counter / Gauge / Histogram / render) のテスト"""
+
+import socket
+import urllib.request
+
+import pytest
+
+from sx_agents.utils import metrics
+from sx_agents.utils.metrics import (
+    PROMETHEUS_CONTENT_TYPE,
+    Histogram,
+    MetricsRegistry,
+)
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    samples = {(name, labels): value for name, labels, value in histogram.samples()}
+    assert samples[("latency_seconds_bucket", '{le="0.1"}')] == 2
+    assert samples[("latency_seconds_bucket", '{le="1"}')] == 3
+    assert samples[("latency_seconds_bucket", '{le="+Inf"}')] == 4
+    assert samples[("latency_seconds_count", "")] == 4
+    assert samples[("latency_seconds_sum", "")] == pytest.approx(2.65)
+
+
+def test_render_prometheus_text_format():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests.", ["plugin"])
+    gauge = registry.gauge("inflight", "In-flight requests.")
+    histogram = registry.histogram(
+        "latency_seconds", "Latency.", ["plugin"], buckets=(0.5,)
+    )
+    counter.inc(plugin='chat"1"')
+    counter.inc(2, plugin='chat"1"')
+    gauge.set(1.5)
+    histogram.observe(0.25, plugin="chat")
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{plugin="chat\\"1\\""} 3',
+        "# HELP inflight In-flight requests.",
+        "# TYPE inflight gauge",
+        "inflight 1.5",
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{plugin="chat",le="0.5"} 1',
+        'latency_seconds_bucket{plugin="chat",le="+Inf"} 1',
+        'latency_seconds_sum{plugin="chat"} 0.25',
+        'latency_seconds_count{plugin="chat"} 1',
+    ]
+
+
+def test_labels_must_match():
+    counter = MetricsRegistry().counter("requests_total", labelnames=["plugin"])
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(-1, plugin="chat")
+
+
+def test_register_returns_existing_metric():
+    registry = MetricsRegistry()
+    assert registry.counter("a") is registry.counter("a")
+    with pytest.raises(ValueError):
+        registry.gauge("a")
+
+
+@pytest.fixture
+def fresh_server_state(monkeypatch):
+    monkeypatch.setattr(metrics, "_server", None)
+    monkeypatch.setattr(metrics, "_server_error", None)
+
+
+def test_metrics_server_serves_registry(fresh_server_state):
+    registry = MetricsRegistry()
+    registry.counter("hits_total").inc()
+    server = metrics.start_metrics_server(0, registry=registry)
+    try:
+        host, port = server.server_address[:2]
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+            assert response.headers["Content-Type"] == PROMETHEUS_CONTENT_TYPE
+            assert "hits_total 1" in response.read().decode()
+        assert metrics.start_metrics_server(0) is server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_server_bind_failure_is_not_fatal(fresh_server_state):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        assert metrics.start_metrics_server(port) is None
+        # 失敗を覚えて再試行しない
+        assert metrics.start_metrics_server(port) is None
+        assert isinstance(metrics._server_error, OSError)  # pylint: disable=W0212
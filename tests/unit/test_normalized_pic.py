@@ -0,0 +1,49 @@
+"""送信用の画像の正規化 (to_normalized_pic / prepare_pic) のテスト"""
+
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from sx_agents.utils.common import prepare_pic, to_normalized_pic
+
+
+@pytest.fixture(scope="module")
+def jpeg() -> bytes:
+    buf = BytesIO()
+    Image.linear_gradient("L").resize((4000, 3000)).convert("RGB").save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def test_does_not_modify_callers_image(jpeg):
+    source = Image.open(BytesIO(jpeg))
+    image = to_normalized_pic(source)
+    assert source.size == (4000, 3000)
+    assert image.size == (1024, 768)
+
+
+def test_draft_decodes_jpeg_at_reduced_size(jpeg):
+    source = Image.open(BytesIO(jpeg))
+    image = to_normalized_pic(source, draft=True)
+    assert image.size == (1024, 768)
+    # 縮小デコードされたのは関数内で開いた画像として渡した場合のみ
+    assert source.size == (2000, 1500)
+
+
+def test_prepare_pic_keeps_callers_image(jpeg):
+    source = Image.open(BytesIO(jpeg))
+    prepared = prepare_pic(source, thumbnail_height=None)
+    assert source.size == (4000, 3000)
+    assert prepared.size == (1024, 768)
+    assert prepared.thumbnail is None
+    assert prepare_pic(jpeg).size == (1024, 768)
+
+
+def test_applies_exif_orientation_once(jpeg):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # 90度回転
+    buf = BytesIO()
+    Image.open(BytesIO(jpeg)).save(buf, "JPEG", exif=exif.tobytes())
+    image = to_normalized_pic(Image.open(buf), draft=True)
+    assert image.size == (768, 1024)
+    assert "exif" not in image.info
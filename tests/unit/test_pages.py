@@ -0,0 +1,175 @@
+"""PDF/PPTXのページの画像への変換 (PagedDocument) のテスト"""
+
+from io import BytesIO
+
+import pytest
+from PIL import Image
+from pptx import Presentation
+from pptx.util import Inches
+from pypdf import PdfReader, PdfWriter
+
+from sx_agents.utils import pages as pages_module
+from sx_agents.utils.common import (
+    BytesLRUCache,
+    config_pic_params,
+    image_pool,
+    num_token_from_pic,
+)
+from sx_agents.utils.pages import PagedDocument, parse_pages, render_size
+
+
+@pytest.fixture(autouse=True)
+def inline_pool(monkeypatch):
+    """ワーカープロセスを起動せずに呼び出し元で実行する"""
+    monkeypatch.setattr(image_pool, "max_workers", 0)
+
+
+@pytest.fixture
+def render_calls(monkeypatch) -> list[list[int]]:
+    """レンダリングしたページを記録する"""
+    calls = []
+    render = pages_module.render_pdf_pages
+
+    def record(data, pages, *args):
+        calls.append(list(pages))
+        return render(data, pages, *args)
+
+    monkeypatch.setattr(pages_module, "render_pdf_pages", record)
+    return calls
+
+
+def make_pdf(num_blank_pages: int = 0) -> bytes:
+    """1ページ目は赤い画像 (400x300pt)、2ページ目はA4の白紙、3ページ目は90度回転したA4のPDF"""
+    buf = BytesIO()
+    Image.new("RGB", (400, 300), (255, 0, 0)).save(buf, "PDF")
+    writer = PdfWriter()
+    writer.add_page(PdfReader(BytesIO(buf.getvalue())).pages[0])
+    writer.add_blank_page(width=595, height=842)
+    writer.add_blank_page(width=595, height=842).rotate(90)
+    for _ in range(num_blank_pages):
+        writer.add_blank_page(width=595, height=842)
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+@pytest.fixture(scope="module")
+def pdf() -> bytes:
+    return make_pdf()
+
+
+# ------------------------------------------------------------------------------
+# parse_pages
+# ------------------------------------------------------------------------------
+def test_parse_pages_ranges_and_duplicates():
+    assert parse_pages("1-3, 5", 10) == [0, 1, 2, 4]
+    assert parse_pages("3、1 2-3", 10) == [0, 1, 2]
+    assert parse_pages("", 10) == []
+
+
+def test_parse_pages_clips_out_of_range():
+    assert parse_pages("0, 4-20", 5) == [3, 4]
+    assert parse_pages("7", 5) == []
+
+
+def test_parse_pages_skips_invalid_parts():
+    assert parse_pages("-1, a, 2, 3-, 1-2-3, 4", 5) == [1, 3]
+
+
+# ------------------------------------------------------------------------------
+# render_size
+# ------------------------------------------------------------------------------
+def test_render_size_is_normalized():
+    # A4 (150dpiで1240x1754) は短辺768に縮小してからレンダリングする
+    assert render_size(595, 842) == (768, 1086)
+    assert render_size(842, 595) == (1086, 768)
+    # 小さいページは150dpiのまま
+    assert render_size(144, 72) == (300, 150)
+
+
+# ------------------------------------------------------------------------------
+# PagedDocument
+# ------------------------------------------------------------------------------
+def test_unsupported_suffix_raises_value_error():
+    with pytest.raises(ValueError):
+        PagedDocument(b"", "notes.docx")
+
+
+def test_pdf_pages_are_rendered(pdf):
+    document = PagedDocument(pdf, "doc.pdf", cache=BytesLRUCache(1 << 24))
+    assert document.num_pages == 3
+    assert document.page_size(0) == render_size(400, 300)
+    assert document.page_size(2) == render_size(842, 595)
+
+    prepared = document.get_many(range(3))
+    # レンダリングした画像は見積もりに使ったサイズと一致する
+    assert [p.size for p in prepared] == [document.page_size(p) for p in range(3)]
+    image = Image.open(BytesIO(prepared[0].image)).convert("RGB")
+    red, green, blue = image.getpixel((image.width // 2, image.height // 2))
+    assert red > 240 and green < 16 and blue < 16
+    # 文字や図形だけのページも画像になる
+    blank = Image.open(BytesIO(prepared[1].image)).convert("RGB")
+    assert blank.getpixel((10, 10)) == (255, 255, 255)
+    assert Image.open(BytesIO(prepared[0].thumbnail)).height == 180
+
+    expected = sum(num_token_from_pic(*p.size, **config_pic_params) for p in prepared)
+    assert document.num_tokens(range(3)) == expected
+
+
+def test_only_missing_pages_are_rendered(pdf, render_calls):
+    cache = BytesLRUCache(1 << 24)
+    document = PagedDocument(pdf, "doc.pdf", cache=cache)
+    first = document.get(1)
+    assert document.get(1) is first
+    document.get_many([0, 1, 2])
+    assert render_calls == [[1], [0, 2]]
+    # 同じファイルは別のインスタンス (別のセッション) でもキャッシュを使う
+    PagedDocument(pdf, "copy.pdf", cache=cache).get_many(range(3))
+    assert len(render_calls) == 2
+
+
+def test_large_document_is_not_rendered_until_requested(render_calls):
+    document = PagedDocument(make_pdf(197), "deck.pdf", cache=BytesLRUCache(1 << 24))
+    assert document.num_pages == 200
+    num_tokens = document.num_tokens(range(3, 200))
+    assert num_tokens == 197 * num_token_from_pic(768, 1086, **config_pic_params)
+    assert render_calls == []
+    assert len(document.get_many(range(10, 30))) == 20
+    # ワーカーへはPAGE_RENDER_BATCHページずつ渡す
+    assert [len(call) for call in render_calls] == [8, 8, 4]
+
+
+@pytest.fixture(scope="module")
+def pptx() -> bytes:
+    presentation = Presentation()
+    presentation.slide_width, presentation.slide_height = Inches(10), Inches(7.5)
+    for _ in range(2):
+        presentation.slides.add_slide(presentation.slide_layouts[6])
+    buf = BytesIO()
+    presentation.save(buf)
+    return buf.getvalue()
+
+
+def test_pptx_is_converted_to_pdf_once(pptx, monkeypatch):
+    converted = []
+
+    def convert(data):
+        converted.append(data)
+        return make_pdf()
+
+    monkeypatch.setattr(pages_module, "convert_pptx_to_pdf", convert)
+    document = PagedDocument(pptx, "slides.pptx", cache=BytesLRUCache(1 << 24))
+    assert document.num_pages == 2
+    assert document.page_size(1) == render_size(720, 540)
+    assert converted == []
+    document.get(0)
+    document.get(1)
+    assert converted == [pptx]
+
+
+def test_pptx_requires_libreoffice(pptx, monkeypatch):
+    monkeypatch.setattr(pages_module.shutil, "which", lambda _: None)
+    document = PagedDocument(pptx, "slides.pptx", cache=BytesLRUCache(1 << 24))
+    assert document.num_tokens(range(2)) > 0
+    with pytest.raises(RuntimeError):
+        document.get(0)
@@ -0,0 +1,60 @@
+"""画像のヘッダーからサイズを読む処理 (get_pic_size_from_header) のテスト"""
+
+import base64
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from sx_agents.utils.common import get_pic_size_from_header, get_pic_size_from_url
+
+
+def encode(size: tuple[int, int], format: str, **kwargs) -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", size, (10, 20, 30)).save(buf, format=format, **kwargs)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("format", ["PNG", "GIF", "JPEG"])
+def test_reads_size_from_header(format):
+    data = encode((321, 123), format)
+    assert get_pic_size_from_header(data) == (321, 123)
+
+
+def test_reads_progressive_jpeg_sof():
+    # プログレッシブJPEGはSOF2マーカー
+    data = encode((640, 480), "JPEG", progressive=True)
+    assert get_pic_size_from_header(data) == (640, 480)
+
+
+def test_skips_jpeg_segments_before_sof():
+    # EXIFなどのAPPセグメントの後ろにあるSOFまで読み進める
+    exif = Image.Exif()
+    exif[0x010E] = "x" * 2000  # ImageDescription
+    data = encode((200, 100), "JPEG", exif=exif.tobytes())
+    assert get_pic_size_from_header(data) == (200, 100)
+
+
+@pytest.mark.parametrize("format", ["PNG", "GIF", "JPEG"])
+def test_returns_none_for_truncated_header(format):
+    data = encode((321, 123), format)
+    assert get_pic_size_from_header(data[:8]) is None
+
+
+def test_returns_none_for_unsupported_format():
+    assert get_pic_size_from_header(encode((10, 10), "BMP")) is None
+
+
+def test_url_reads_past_truncated_prefix():
+    # 最初の読み込みでSOFまで届かない場合は読み込む範囲を広げる
+    exif = Image.Exif()
+    exif[0x010E] = "x" * 2000
+    data = encode((200, 100), "JPEG", exif=exif.tobytes())
+    url = "data:image/jpeg;base64," + base64.b64encode(data).decode()
+    assert get_pic_size_from_url(url, chunk_size=8) == (200, 100)
+
+
+def test_url_falls_back_to_pil_for_unsupported_format():
+    data = encode((30, 20), "BMP")
+    url = "data:image/bmp;base64," + base64.b64encode(data).decode()
+    assert get_pic_size_from_url(url) == (30, 20)
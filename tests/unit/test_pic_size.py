@@ -0,0 +1,42 @@
+"""画像の送信サイズとトークン数 (get_normalized_pic_size / num_token_from_pic) のテスト"""
+
+import pytest
+
+from sx_agents.utils.common import get_normalized_pic_size, num_token_from_pic
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [
+        ((4000, 3000), (1024, 768)),  # 横長
+        ((3000, 4000), (768, 1024)),  # 縦長
+        ((4000, 4000), (768, 768)),  # 正方形
+        ((800, 600), (800, 600)),  # 上限以下は拡大しない
+        ((600, 800), (600, 800)),
+        ((4096, 512), (2048, 256)),  # 長辺の上限で縮小する
+        ((512, 4096), (256, 2048)),
+    ],
+)
+def test_normalized_pic_size(size, expected):
+    assert get_normalized_pic_size(*size) == expected
+
+
+def test_landscape_and_portrait_are_symmetric():
+    for width, height in [(4000, 3000), (1920, 1080), (5000, 800), (1000, 999)]:
+        w, h = get_normalized_pic_size(width, height)
+        assert get_normalized_pic_size(height, width) == (h, w)
+        assert (w <= 2048) and (h <= 2048) and (min(w, h) <= 768)
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [
+        ((4000, 3000), 85 + 170 * 2 * 2),
+        ((3000, 4000), 85 + 170 * 2 * 2),
+        ((4000, 4000), 85 + 170 * 2 * 2),
+        ((512, 512), 85),
+        ((4096, 512), 85 + 170 * 4 * 1),
+    ],
+)
+def test_num_token_from_pic(size, expected):
+    assert num_token_from_pic(*size) == expected
@@ -0,0 +1,172 @@
+"""長い文章の分割と要約 (split_sentences / chunk_text / MapReduceSummarizer) のテスト"""
+
+import random
+
+import pytest
+
+from sx_agents.utils import Model
+from sx_agents.utils import summarize as summarize_module
+from sx_agents.utils.batch import BatchResult
+from sx_agents.utils.cache import ResponseCache
+from sx_agents.utils.common import get_encoding
+from sx_agents.utils.summarize import (
+    DEFAULT_REDUCE_PROMPT,
+    MapReduceSummarizer,
+    chunk_text,
+    split_sentences,
+)
+
+
+@pytest.fixture(scope="module")
+def encoding():
+    # tiktokenのエンコーディングはキャッシュ済みの場合のみ利用できる (オフライン実行のため)
+    try:
+        return get_encoding("gpt-4o")
+    except Exception as e:  # pylint: disable=W0718
+        pytest.skip(f"tiktoken encoding is not available: {e}")
+
+
+def make_document(num_sentences: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = ["売上", "利益", "計画", "顧客", "市場", "製品", "費用", "結果"]
+    sentences = []
+    for i in range(num_sentences):
+        body = "の".join(rng.choice(words) for _ in range(rng.randint(3, 8)))
+        sentences.append(f"第{i}項: {body}を確認した。")
+    return "".join(sentences)
+
+
+# ------------------------------------------------------------------------------
+# split_sentences / chunk_text
+# ------------------------------------------------------------------------------
+def test_split_sentences_round_trip():
+    text = (
+        "今日は晴れ。「本当？」と聞いた。すごい！\n\n"
+        "Next paragraph. It has two sentences.\nLast line without end"
+    )
+    sentences = split_sentences(text)
+    assert "".join(sentences) == text
+    assert sentences[:3] == ["今日は晴れ。", "「本当？」", "と聞いた。"]
+    assert "Next paragraph. " in sentences
+    assert sentences[-1] == "Last line without end"
+
+
+def test_split_sentences_keeps_decimals_and_closing_brackets():
+    sentences = split_sentences("価格は3.5%上がった。「はい。」次へ。")
+    assert sentences == ["価格は3.5%上がった。", "「はい。」", "次へ。"]
+
+
+def test_chunk_text_respects_max_tokens(encoding):
+    text = make_document(500)
+    chunks = chunk_text(text, encoding, 200)
+    assert "".join(chunks) == text
+    assert all(len(encoding.encode(chunk)) <= 200 for chunk in chunks)
+    # 1文で上限を超える場合も分割する
+    assert all(
+        len(encoding.encode(c)) <= 20 for c in chunk_text("あ" * 200, encoding, 20)
+    )
+
+
+def test_chunk_text_is_stable_after_edit(encoding):
+    text = make_document(3000)
+    chunks = chunk_text(text, encoding, 300)
+    sentences = split_sentences(text)
+    middle = len(sentences) // 2
+    edited = "".join(sentences[:middle] + ["追加した文です。"] + sentences[middle:])
+    new_chunks = chunk_text(edited, encoding, 300)
+    changed = set(new_chunks) - set(chunks)
+    assert len(chunks) > 50
+    # 編集した位置を含むチャンクだけが変わる
+    assert 1 <= len(changed) <= 2
+
+
+# ------------------------------------------------------------------------------
+# MapReduceSummarizer
+# ------------------------------------------------------------------------------
+class FakeExecutor:
+    """プロンプトの代わりに決まった長さの要約を返すBatchExecutor"""
+
+    calls: list[list[str]] = []
+    map_tokens = 100  # チャンクの要約の長さ
+    reduce_tokens = 100  # 要約をまとめた要約の長さ
+
+    def __init__(self, model, **kwargs):
+        self.model = model
+        self.progress = 0.0
+
+    def run(self, prompts):
+        FakeExecutor.calls.append(list(prompts.values()))
+        for i, (index, prompt) in enumerate(prompts.items()):
+            self.progress = (i + 1) / len(prompts)
+            number = sum(len(call) for call in FakeExecutor.calls) + i
+            tokens = self.map_tokens if len(self.calls) == 1 else self.reduce_tokens
+            output = f"要約{number}。" + "要点。" * (tokens // 2)
+            yield BatchResult(index, output)
+
+    def cancel(self):
+        return False
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    monkeypatch.setattr(summarize_module, "BatchExecutor", FakeExecutor)
+    monkeypatch.setattr(FakeExecutor, "calls", [])
+    return FakeExecutor
+
+
+@pytest.fixture
+def model() -> Model:
+    return Model(
+        name="test",
+        type="azure",
+        config={"model_name": "gpt-4o"},
+        token_limit=1200,
+        max_response_token=200,
+    )
+
+
+def test_reduce_until_one_summary(executor, model, encoding):
+    stages = []
+    summarizer = MapReduceSummarizer(model, cache=ResponseCache())
+    summary = summarizer.summarize(
+        make_document(500), on_progress=lambda stage, _: stages.append(stage)
+    )
+    assert summary.startswith("要約")
+    map_call, *reduce_calls = executor.calls
+    assert len(map_call) > 8
+    # 各段の要約は前の段より少なく、最後は1つになる
+    sizes = [len(call) for call in executor.calls]
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[-1] == 1
+    assert len(reduce_calls) >= 2
+    assert stages[0] == "map"
+    assert stages[-1] == f"reduce{len(reduce_calls)}"
+    for prompt in sum(executor.calls, []):
+        messages = [{"role": "user", "content": prompt}]
+        assert model.is_less_than_token_limit(messages)
+
+
+def test_summarize_reuses_cached_chunks(executor, model, encoding):
+    summarizer = MapReduceSummarizer(model, cache=ResponseCache())
+    summarizer.summarize(make_document(500))
+    num_chunks = len(executor.calls[0])
+    summarizer.summarize(make_document(500))
+    assert summarizer.hits >= num_chunks
+    assert summarizer.misses == 0
+
+
+def test_oversized_summaries_are_split_to_fit(executor, model, encoding, monkeypatch):
+    # チャンクの要約がまとめる側のトークン制限より長い場合
+    # (別のモデルで作ったキャッシュの要約や、応答のトークン数の設定が大きい場合)
+    monkeypatch.setattr(FakeExecutor, "map_tokens", 1500)
+    summarizer = MapReduceSummarizer(model, cache=ResponseCache())
+    budget = summarizer.input_budget(DEFAULT_REDUCE_PROMPT)
+    summaries = ["長い要約。" * 600, "短い要約。", "長い要約。" * 600]
+    for group in summarizer._group(summaries, budget):  # pylint: disable=W0212
+        text = summarize_module.SUMMARY_SEPARATOR.join(group)
+        assert len(encoding.encode(text)) <= budget
+
+    assert summarizer.summarize(make_document(300)).startswith("要約")
+    for prompt in sum(executor.calls[1:], []):
+        messages = [{"role": "user", "content": prompt}]
+        assert model.is_less_than_token_limit(messages)
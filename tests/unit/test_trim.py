@@ -0,0 +1,83 @@
+"""会話履歴の切り取り (find_trim_index / trim_messages) のテスト"""
+
+import pytest
+
+from sx_agents.utils.common import find_trim_index, get_encoding, trim_messages
+
+MODEL_NAME = "gpt-4o"
+
+
+@pytest.fixture(scope="module")
+def encoding():
+    # tiktokenのエンコーディングはキャッシュ済みの場合のみ利用できる (オフライン実行のため)
+    try:
+        return get_encoding(MODEL_NAME)
+    except Exception as e:  # pylint: disable=W0718
+        pytest.skip(f"tiktoken encoding is not available: {e}")
+
+
+# ------------------------------------------------------------------------------
+# find_trim_index
+# ------------------------------------------------------------------------------
+def test_find_trim_index_keeps_everything_within_budget():
+    assert find_trim_index([10, 5, 5, 5, 5], token_budget=100) == 1
+
+
+def test_find_trim_index_drops_oldest_messages():
+    # 先頭10 + 末尾から5, 5 で予算20に収まる
+    assert find_trim_index([10, 5, 5, 5, 5], token_budget=20) == 3
+
+
+def test_find_trim_index_cuts_only_at_boundaries():
+    num_tokens = [10, 5, 5, 5, 5]
+    is_boundary = [True, True, False, True, False]
+    # 予算内の最も古い位置は3 (境界)、2は境界ではない
+    assert find_trim_index(num_tokens, 25, is_boundary) == 3
+    # 位置3・4だけでは収まるが、4は境界ではないため3になる
+    assert find_trim_index(num_tokens, 20, is_boundary) == 3
+
+
+def test_find_trim_index_always_keeps_latest_message():
+    # 最新のメッセージだけで予算を超えていても残す
+    assert find_trim_index([10, 5, 100], token_budget=20) == 2
+
+
+def test_find_trim_index_without_head():
+    assert find_trim_index([5, 5, 5], token_budget=10, num_head=0) == 1
+
+
+# ------------------------------------------------------------------------------
+# trim_messages
+# ------------------------------------------------------------------------------
+def make_messages(num_turns: int, text: str = "これはテストの文章です。" * 20):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(num_turns):
+        messages.append({"role": "user", "content": f"質問{i}: {text}"})
+        messages.append({"role": "assistant", "content": f"回答{i}: {text}"})
+    return messages
+
+
+def test_trim_messages_keeps_short_history(encoding):
+    messages = make_messages(2)
+    trimmed, num_dropped = trim_messages(messages, MODEL_NAME, token_limit=100000)
+    assert trimmed == messages
+    assert num_dropped == 0
+
+
+def test_trim_messages_drops_whole_turns(encoding):
+    messages = make_messages(20)
+    trimmed, num_dropped = trim_messages(
+        messages, MODEL_NAME, token_limit=4000, max_response_token=500
+    )
+    assert num_dropped > 0
+    # システムロールを残し、ユーザの発話からターン単位で残る
+    assert trimmed[0] == messages[0]
+    assert trimmed[1]["role"] == "user"
+    assert trimmed[-1] == messages[-1]
+    assert len(trimmed) == len(messages) - 2 * num_dropped
+
+
+def test_trim_messages_keeps_latest_message_over_budget(encoding):
+    messages = make_messages(1, text="長い文章です。" * 2000)
+    trimmed, _ = trim_messages(messages, MODEL_NAME, token_limit=1000)
+    assert trimmed == [messages[0], messages[-1]]
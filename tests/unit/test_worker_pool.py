@@ -0,0 +1,44 @@
+"""別プロセスで処理を実行するプール (ProcessWorkerPool) のテスト"""
+
+import math
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from sx_agents.utils.common import ProcessWorkerPool
+
+
+@pytest.fixture
+def pool():
+    pool = ProcessWorkerPool(max_workers=1, max_pending=1, timeout=60.0)
+    yield pool
+    if pool._executor is not None:  # pylint: disable=W0212
+        pool._executor.shutdown(cancel_futures=True)  # pylint: disable=W0212
+
+
+def test_run_in_worker_process(pool):
+    assert pool.run(os.getpid) != os.getpid()
+    assert pool.run(math.sqrt, 16.0) == 4.0
+
+
+def test_recovers_after_worker_is_killed(pool):
+    pool.run(math.sqrt, 1.0)
+    broken = pool._executor  # pylint: disable=W0212
+    # ワーカーが異常終了すると実行中の処理はBrokenProcessPoolになる
+    future = pool.submit(os._exit, 1)  # pylint: disable=W0212
+    with pytest.raises(BrokenProcessPool):
+        future.result(timeout=60.0)
+    # 次の登録ではプールを作り直して実行する (枠も解放されている)
+    assert pool.submit(math.sqrt, 9.0).result(timeout=60.0) == 3.0
+    assert pool._executor is not broken  # pylint: disable=W0212
+    with pytest.raises(BrokenProcessPool):
+        pool.run(os._exit, 1)  # pylint: disable=W0212
+    assert pool.run(math.sqrt, 16.0) == 4.0
+
+
+def test_inline_when_no_workers():
+    pool = ProcessWorkerPool(max_workers=0, max_pending=1, timeout=1.0)
+    assert pool.run(os.getpid) == os.getpid()
+    with pytest.raises(ValueError):
+        pool.run(math.sqrt, -1.0)